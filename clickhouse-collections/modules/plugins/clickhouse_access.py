@@ -0,0 +1,398 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_access
+short_description: выгрузка и пакетное восстановление пользователей, ролей, прав, профилей, квот и именованных коллекций clickhouse
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description: >-
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description: >-
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description: >-
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description: >-
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    mode:
+        description: >-
+            'export' - выгрузить состояние системы прав в файл path,
+            'restore' - применить файл path к серверу или ко всем репликам кластера
+        required: true
+        choices: [export, restore]
+        type: str
+    path:
+        description: >-
+            путь к файлу выгрузки на целевом хосте. Файл содержит хэши паролей и секреты именованных
+            коллекций и создаётся с правами 0600. Если сервер скрывает секреты ([HIDDEN] в SHOW ACCESS,
+            нужны display_secrets_in_show_and_select в конфигурации и право displaySecretsInShowAndSelect),
+            то выгрузка завершается ошибкой.
+        required: true
+        type: path
+    cluster:
+        description: >-
+            название кластера clickhouse. При восстановлении файл применяется параллельно ко всем репликам кластера,
+            по одной сессии на реплику. Если не указан, то файл применяется только к целевой ноде.
+        required: false
+        type: str
+    replace:
+        description: >-
+            при восстановлении пересоздавать существующие пользователи, роли, профили, квоты и политики строк
+            (CREATE ... OR REPLACE), если их определение отличается от выгрузки. По умолчанию существующие объекты
+            не изменяются. Объекты из хранилищ только для чтения (users.xml, ldap), например пользователь default,
+            не выгружаются и не изменяются при восстановлении.
+        default: false
+        type: bool
+'''
+
+EXAMPLES = r'''
+- name: выгрузить систему прав действующего кластера
+    clickhouse_access:
+      mode: export
+      path: /var/backups/clickhouse_access.json
+
+- name: восстановить систему прав на всех репликах нового кластера
+    clickhouse_access:
+      mode: restore
+      path: /var/backups/clickhouse_access.json
+      cluster: new_cluster
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+statements:
+    description:
+        количество выгруженных запросов по типам объектов
+    returned: export
+    type: dict
+replicas:
+    description:
+        для каждой реплики - количество выполненных запросов, пропущенных как уже существующих,
+        пропущенных объектов из хранилищ только для чтения (readonly) и запросы, которые не удалось выполнить, с ошибками
+    returned: restore
+    type: list
+'''
+
+import json
+import os
+import re
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import get_replicas, on_replicas
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import quote
+
+
+FORMAT_VERSION = 1
+SECRETS = {"format_display_secrets_in_show_and_select": 1}
+
+# порядок создания объектов: профили и роли нужны пользователям, пользователи - квотам и политикам строк.
+# Ссылки в обратную сторону (профиль TO пользователь) разрешаются повторными проходами
+KINDS = ["NAMED COLLECTION", "SETTINGS PROFILE", "ROLE", "USER", "QUOTA", "ROW POLICY"]
+CREATE = re.compile(r"^CREATE (" + "|".join(KINDS) + r")\s+(?:IF NOT EXISTS\s+|OR REPLACE\s+)?(.*)$", re.DOTALL)
+GRANT = re.compile(r"^GRANT (.+) TO (\S+?)( WITH (?:GRANT|ADMIN) OPTION)?$", re.DOTALL)
+DEFAULT_ROLE = re.compile(r" DEFAULT ROLE (.+?)(?= SETTINGS | GRANTEES |$)", re.DOTALL)
+NAME = re.compile(r"^(`(?:[^`\\]|\\.)*`|[^\s,]+)(.*)$", re.DOTALL)
+# объекты, создаваемые одним запросом для нескольких имён: CREATE ROLE IF NOT EXISTS r1, r2 SETTINGS ...
+BATCHED_KINDS = ["SETTINGS PROFILE", "ROLE", "USER", "QUOTA"]
+ENTITY_TABLES = {"USER": "users", "ROLE": "roles", "SETTINGS PROFILE": "settings_profiles",
+                 "QUOTA": "quotas", "ROW POLICY": "row_policies"}
+HIDDEN = "[HIDDEN]"
+
+
+def kind(statement):
+    match = CREATE.match(statement)
+    return match.group(1) if match else statement.split(' ')[0]
+
+
+def show_access(ch_client):
+    return [r[0] for r in ch_client.query("SHOW ACCESS", settings=SECRETS).result_rows]
+
+
+def unquote(name):
+    return name[1:-1].replace('\\`', '`') if name.startswith('`') else name
+
+
+def entities(ch_client, condition="1"):
+    # имена пользователей, ролей, профилей, квот и политик строк по типам объектов
+    return {name: {r[0] for r in ch_client.query(f"SELECT name FROM system.{table} WHERE {condition}").result_rows}
+            for name, table in ENTITY_TABLES.items()}
+
+
+def readonly_entities(ch_client):
+    # объекты из users.xml и ldap нельзя создать или изменить запросом, поэтому они не переносятся
+    storages = {r[0] for r in ch_client.query(
+        "SELECT name FROM system.user_directories WHERE type IN ('users_xml', 'users.xml', 'ldap')").result_rows}
+    storages.add("users_xml")
+    return entities(ch_client, f"storage IN ({', '.join(quote(storage) for storage in sorted(storages))})")
+
+
+def named_in(name, body, names):
+    if name == "ROW POLICY":
+        # имя политики строк в system.row_policies - 'name ON db.table'
+        return any(body.replace('`', '').startswith(n) for n in names)
+    return unquote(NAME.match(body).group(1)) in names
+
+
+def is_readonly(statement, readonly):
+    match = CREATE.match(statement)
+    if match:
+        return named_in(match.group(1), match.group(2), readonly.get(match.group(1), ()))
+    grantee = GRANT.match(statement)
+    if grantee:
+        return unquote(grantee.group(2)) in readonly["USER"] | readonly["ROLE"]
+    if " FROM " in statement:
+        return unquote(statement.rsplit(" FROM ", 1)[1].strip()) in readonly["USER"] | readonly["ROLE"]
+    return False
+
+
+def named_collections(ch_client):
+    rows = ch_client.query("SELECT name, collection FROM system.named_collections ORDER BY name", settings=SECRETS).result_rows
+    return [f"CREATE NAMED COLLECTION {name} AS " + ", ".join(f"{key} = {quote(value)}" for key, value in sorted(collection.items()))
+            for name, collection in rows]
+
+
+def export_access(ch_client, module, path):
+    try:
+        readonly = readonly_entities(ch_client)
+        statements = [s for s in named_collections(ch_client) + show_access(ch_client) if not is_readonly(s, readonly)]
+        server_version = ch_client.command("SELECT version()")
+    except Exception as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: SHOW ACCESS"}))
+    hidden = [kind(s) for s in statements if HIDDEN in s]
+    if hidden:
+        # выгрузка со скрытыми паролями и секретами не восстанавливается
+        return module.fail_json(msg=f"{len(hidden)} access statements contain {HIDDEN} secrets, enable "
+                                    "display_secrets_in_show_and_select on the server and grant displaySecretsInShowAndSelect")
+    counts = {}
+    for statement in statements:
+        counts[kind(statement)] = counts.get(kind(statement), 0) + 1
+    previous = None
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                previous = json.load(f).get("statements")
+        except (IOError, OSError, ValueError, AttributeError):
+            previous = None
+    if previous == statements:
+        return {"changed": False, "statements": counts, "msg": f"Access export {path} is up to date"}
+    dump = {"format_version": FORMAT_VERSION, "server_version": server_version,
+            "exported_at": time.strftime("%Y-%m-%d %H:%M:%S"), "statements": statements}
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(dump, f, indent=2)
+    return {"changed": True, "statements": counts, "msg": f"{len(statements)} access statements exported to {path}"}
+
+
+def batch_grants(statements):
+    # GRANT одного получателя с одинаковой опцией объединяются в один запрос:
+    # GRANT SELECT ON a.*, INSERT ON b.t TO user; назначения ролей - GRANT r1, r2 TO user
+    batches = {}
+    other = []
+    for statement in statements:
+        match = GRANT.match(statement)
+        if not match:
+            other.append(statement)
+            continue
+        is_role = " ON " not in match.group(1)
+        batches.setdefault((is_role, match.group(2), match.group(3) or ""), []).append(match.group(1))
+    grants = [f"GRANT {', '.join(bodies)} TO {grantee}{option}" for (_, grantee, option), bodies in
+              sorted(batches.items(), key=lambda item: not item[0][0])]
+    return grants, other
+
+
+def batch_creates(creates):
+    # CREATE объектов одного типа, отличающихся только именем, объединяются в один запрос
+    batches = {}
+    other = []
+    for name, mode, body in creates:
+        match = NAME.match(body)
+        if name not in BATCHED_KINDS or not match:
+            other.append((f"CREATE {name} {mode} {body}", [f"CREATE {name} {mode} {body}"]))
+            continue
+        batches.setdefault((name, mode, match.group(2)), []).append(match.group(1))
+    batched = [(f"CREATE {name} {mode} {', '.join(names)}{rest}", [f"CREATE {name} {mode} {n}{rest}" for n in names])
+               for (name, mode, rest), names in batches.items()]
+    # порядок типов объектов сохраняется: профили и роли создаются раньше пользователей
+    return sorted(batched + other, key=lambda item: KINDS.index(kind(item[0])))
+
+
+def split_default_role(body):
+    # роль по умолчанию можно задать только после назначения роли пользователю,
+    # поэтому она выносится в ALTER USER, выполняемый после GRANT
+    match = DEFAULT_ROLE.search(body)
+    if not match:
+        return body, None
+    return body[:match.start()] + body[match.end():], f"ALTER USER {body.split(' ')[0]} DEFAULT ROLE {match.group(1)}"
+
+
+def apply_passes(ch_client, statements):
+    # запросы, упавшие из-за ещё не созданных объектов, откладываются и повторяются,
+    # пока очередной проход выполняет хотя бы один запрос
+    executed = 0
+    pending = list(statements)
+    while pending:
+        failed = []
+        for statement in pending:
+            try:
+                ch_client.command(statement)
+                executed += 1
+            except Exception as e:
+                failed.append((statement, str(e)))
+        if len(failed) == len(pending):
+            return executed, [{"statement": s, "error": e} for s, e in failed]
+        pending = [s for s, _ in failed]
+    return executed, []
+
+
+def restore_replica(ch_client, statements, replace):
+    readonly = readonly_entities(ch_client)
+    writable = [s for s in statements if not is_readonly(s, readonly)]
+    readonly_skipped = len(statements) - len(writable)
+    statements = writable
+    current = set(show_access(ch_client))
+    existing = entities(ch_client)
+    existing["NAMED COLLECTION"] = {r[0] for r in ch_client.query("SELECT name FROM system.named_collections").result_rows}
+    creates = []
+    default_roles = []
+    skipped = 0
+    for name in KINDS:
+        for statement in statements:
+            match = CREATE.match(statement)
+            if not match or match.group(1) != name:
+                continue
+            body = match.group(2)
+            # без replace существующий объект не изменяется, даже если его определение отличается от выгрузки
+            exists = named_in(name, body, existing[name])
+            if statement in current or (exists and (not replace or name == "NAMED COLLECTION")):
+                skipped += 1
+                continue
+            if name == "USER":
+                body, default_role = split_default_role(body)
+                if default_role:
+                    default_roles.append(default_role)
+            creates.append((name, "OR REPLACE" if replace and name != "NAMED COLLECTION" else "IF NOT EXISTS", body))
+    batches = batch_creates(creates)
+    executed, errors = apply_passes(ch_client, [statement for statement, _ in batches])
+    if errors:
+        # пакеты, которые не удалось применить, повторяются по одному запросу, чтобы найти ошибочный
+        failed = {e["statement"] for e in errors}
+        done, errors = apply_passes(ch_client, [s for statement, single in batches if statement in failed for s in single])
+        executed += done
+
+    # пересоздание объектов сбрасывает их права, поэтому права сравниваются с состоянием после создания
+    current = set(show_access(ch_client))
+    rights = [s for s in statements if not CREATE.match(s)]
+    skipped += sum(1 for s in rights if s in current)
+    grants, revokes = batch_grants([s for s in rights if s not in current])
+    done, failed = apply_passes(ch_client, grants)
+    if failed:
+        # пакет, который не удалось применить, повторяется по одному запросу, чтобы найти ошибочный
+        retry = [s for s in rights if s not in current and GRANT.match(s)]
+        done, failed = apply_passes(ch_client, retry)
+    executed += done
+    errors += failed
+    done, failed = apply_passes(ch_client, revokes + default_roles)
+    return {"executed": executed + done, "skipped": skipped, "readonly": readonly_skipped, "errors": errors + failed}
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "mode": {"type": "str", "required": True, "choices": ["export", "restore"]},
+        "path": {"type": "path", "required": True},
+        "cluster": {"type": "str", "required": False},
+        "replace": {"type": "bool", "default": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    mode = module.params["mode"]
+    path = module.params["path"]
+    cluster = module.params["cluster"]
+    replace = module.params["replace"]
+    retry = retry_params(module.params)
+    conn = {"username": login_user, "password": login_password, "port": port, "retry": retry}
+
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+        if cluster:
+            replicas = get_replicas(ch_client, cluster)
+        else:
+            replicas = [{"shard_num": None, "replica_num": None, "host": host or "localhost", "is_local": True}]
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    if mode == "export":
+        module.exit_json(**export_access(ch_client, module, path))
+
+    try:
+        with open(path) as f:
+            dump = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        return module.fail_json(msg=f"Cannot read access export {path}: {to_native(e)}")
+    if not isinstance(dump, dict) or dump.get("format_version") != FORMAT_VERSION:
+        return module.fail_json(msg=f"Unsupported access export format version {dump.get('format_version') if isinstance(dump, dict) else None} in {path}")
+
+    restored = on_replicas(replicas, lambda client, replica: restore_replica(client, dump["statements"], replace), conn)
+    result = {"changed": any(r.get("executed") for r in restored), "replicas": restored}
+    failed = [r for r in restored if r.get("error") or r.get("errors")]
+    if failed:
+        return module.fail_json(msg=f"Access restore failed on {len(failed)} replicas", **result)
+    result["msg"] = f"{sum(r['executed'] for r in restored)} access statements applied on {len(restored)} replicas"
+    result.update(ch_client.ddl_queue_report())
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
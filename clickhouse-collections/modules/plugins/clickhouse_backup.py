@@ -0,0 +1,350 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_backup
+short_description: асинхронное создание и восстановление резервных копий баз данных clickhouse
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description: >-
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description: >-
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description: >-
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description: >-
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    state:
+        description: >-
+            'backup' - запустить создание резервной копии, 'restore' - запустить восстановление из резервной копии,
+            'status' - получить состояние ранее запущенной операции по backup_id.
+        default: backup
+        choices: [backup, restore, status]
+        type: str
+    databases:
+        description: >-
+            базы данных, которые копируются или восстанавливаются целиком
+        required: false
+        aliases: [db]
+        type: list
+    tables:
+        description: >-
+            отдельные таблицы в виде 'db_name.table_name', которые копируются или восстанавливаются
+        required: false
+        type: list
+    name:
+        description: >-
+            имя резервной копии - имя файла или каталога на диске резервных копий, например 'nightly_2024_01_01.zip'
+        required: false
+        type: str
+    disk:
+        description: >-
+            имя диска для резервных копий из конфигурации сервера clickhouse (секция backups.allowed_disk).
+            Обязательно должен быть указан либо этот параметр, либо параметр 'path'.
+        required: false
+        type: str
+    path:
+        description: >-
+            каталог локальной файловой системы сервера clickhouse для резервных копий
+            (должен быть разрешён в секции backups.allowed_path)
+        required: false
+        type: str
+    base_backup:
+        description: >-
+            имя базовой резервной копии на том же диске или в том же каталоге. Если задано, то создаётся
+            инкрементальная резервная копия, в которую попадают только изменившиеся с базовой копии куски.
+        required: false
+        type: str
+    backup_id:
+        description: >-
+            идентификатор операции, возвращённый модулем при запуске, для state = 'status' или ожидания
+        required: false
+        type: str
+    cluster:
+        description: >-
+            название кластера clickhouse, на котором будут выполнены операции. Если не указан,
+            то операции будут выполнены только на целевой ноде, указанной при запуске ansible-playbook.
+        required: false
+        type: str
+    settings:
+        description: >-
+            дополнительные настройки BACKUP или RESTORE, например allow_non_empty_tables или compression_level
+        required: false
+        type: dict
+    wait:
+        description: >-
+            дождаться завершения операции, опрашивая system.backups. По умолчанию модуль только запускает
+            операцию и возвращает её идентификатор, не задерживая выполнение плейбука.
+        default: false
+        type: bool
+    timeout:
+        description: >-
+            максимальное время ожидания завершения операции в секундах при wait = true
+        default: 86400
+        type: int
+    poll_interval:
+        description: >-
+            интервал опроса system.backups в секундах при wait = true
+        default: 10
+        type: int
+notes:
+    - Повторный запуск state = 'backup' не создаёт копию заново, если операция с тем же именем уже выполняется
+      или завершилась (по system.backups), либо если сервер отвечает, что копия уже существует
+      (BACKUP_ALREADY_EXISTS, обнаруживается при wait = true). system.backups хранится только в памяти сервера
+      и очищается при его перезапуске, поэтому без wait = true повторный запуск после перезапуска
+      сообщит об изменении, а операция завершится ошибкой BACKUP_ALREADY_EXISTS.
+    - state = 'restore' не идемпотентен - операция запускается при каждом вызове. Повторное восстановление
+      в непустые таблицы завершается ошибкой сервера, а с allow_non_empty_tables дублирует данные.
+'''
+
+EXAMPLES = r'''
+- name: запустить инкрементальную резервную копию базы test_db от вчерашней копии
+    clickhouse_backup:
+      databases:
+        - test_db
+      disk: backups
+      name: "test_db_{{ ansible_date_time.date }}.zip"
+      base_backup: "test_db_{{ yesterday }}.zip"
+  register: backup
+
+- name: проверить состояние резервного копирования
+    clickhouse_backup:
+      state: status
+      backup_id: "{{ backup.id }}"
+
+- name: восстановить таблицу events из резервной копии в локальном каталоге и дождаться завершения
+    clickhouse_backup:
+      state: restore
+      tables:
+        - test_db.events
+      path: /var/lib/clickhouse/backups
+      name: test_db_2024_01_01
+      wait: true
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+id:
+    description:
+        идентификатор операции в system.backups
+    returned: success
+    type: str
+status:
+    description:
+        состояние операции из system.backups, например CREATING_BACKUP, BACKUP_CREATED, RESTORING, RESTORED
+    returned: success
+    type: str
+progress:
+    description:
+        прогресс операции - количество файлов, размеры, прочитанные файлы и байты,
+        длительность в секундах и пропускная способность в байтах в секунду
+    returned: success
+    type: dict
+'''
+
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import format_setting
+
+
+FINAL_STATUSES = {"BACKUP_CREATED", "RESTORED"}
+FAILED_STATUSES = {"BACKUP_FAILED", "RESTORE_FAILED", "BACKUP_CANCELLED", "RESTORE_CANCELLED"}
+
+
+def destination(disk, path, name):
+    if disk:
+        return f"Disk('{disk}', '{name}')"
+    return f"File('{path.rstrip('/')}/{name}')"
+
+
+def backup_elements(databases, tables):
+    elements = [f"DATABASE {db}" for db in databases or []]
+    elements += [f"TABLE {table}" for table in tables or []]
+    return ', '.join(elements)
+
+
+def backup_status(ch_client, backup_id):
+    rows = ch_client.query(
+        "SELECT id, name, status, error, num_files, total_size, uncompressed_size, compressed_size, files_read, bytes_read, "
+        "dateDiff('second', start_time, if(end_time > start_time, end_time, now())) "
+        f"FROM system.backups WHERE id = '{backup_id}'").result_rows
+    if not rows:
+        raise Exception(f"Backup operation '{backup_id}' is not found in system.backups")
+    row = rows[0]
+    duration = row[10]
+    progress = {"num_files": row[4], "total_size": row[5], "uncompressed_size": row[6], "compressed_size": row[7],
+                "files_read": row[8], "bytes_read": row[9], "duration": duration,
+                "bytes_per_second": int(row[9] / duration) if duration else None}
+    return {"id": row[0], "name": row[1], "status": row[2], "error": row[3], "progress": progress}
+
+
+def is_backup_created(ch_client, target):
+    name = target.replace("'", "\\'")
+    return ch_client.command(
+        f"SELECT count() FROM system.backups WHERE name = '{name}' AND status IN ('CREATING_BACKUP', 'BACKUP_CREATED')") > 0
+
+
+def start_operation(ch_client, state, databases, tables, target, base_backup, cluster, settings):
+    query_fragments = ["BACKUP" if state == 'backup' else "RESTORE", backup_elements(databases, tables)]
+    if cluster:
+        query_fragments.append(f"ON CLUSTER {cluster}")
+    query_fragments.append(f"{'TO' if state == 'backup' else 'FROM'} {target}")
+    settings_kit = [f"{k} = {format_setting(v)}" for k, v in (settings or {}).items()]
+    if base_backup:
+        settings_kit.append(f"base_backup = {base_backup}")
+    if settings_kit:
+        query_fragments.append("SETTINGS " + ", ".join(settings_kit))
+    query_fragments.append("ASYNC")
+    query = ' '.join(query_fragments)
+    row = ch_client.query(query, idempotent=False).result_rows[0]
+    return row[0]
+
+
+def wait_operation(ch_client, backup_id, timeout, poll_interval):
+    deadline = time.monotonic() + timeout
+    while True:
+        status = backup_status(ch_client, backup_id)
+        if status["status"] in FINAL_STATUSES or status["status"] in FAILED_STATUSES:
+            return status
+        if time.monotonic() + poll_interval > deadline:
+            return status
+        time.sleep(poll_interval)
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "state": {"type": "str", "default": "backup", "choices": ["backup", "restore", "status"]},
+        "databases": {"type": "list", "required": False, "aliases": ["db"]},
+        "tables": {"type": "list", "required": False},
+        "name": {"type": "str", "required": False},
+        "disk": {"type": "str", "required": False},
+        "path": {"type": "str", "required": False},
+        "base_backup": {"type": "str", "required": False},
+        "backup_id": {"type": "str", "required": False},
+        "cluster": {"type": "str", "required": False},
+        "settings": {"type": "dict", "required": False},
+        "wait": {"type": "bool", "default": False},
+        "timeout": {"type": "int", "default": 86400},
+        "poll_interval": {"type": "int", "default": 10}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        mutually_exclusive=[["disk", "path"]],
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    state = module.params["state"]
+    databases = module.params["databases"]
+    tables = module.params["tables"]
+    name = module.params["name"]
+    disk = module.params["disk"]
+    path = module.params["path"]
+    base_backup = module.params["base_backup"]
+    backup_id = module.params["backup_id"]
+    cluster = module.params["cluster"]
+    settings = module.params["settings"]
+    wait = module.params["wait"]
+    timeout = module.params["timeout"]
+    poll_interval = module.params["poll_interval"]
+
+    retry = retry_params(module.params)
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    if state == 'status':
+        if not backup_id:
+            return module.fail_json("'backup_id' parameter needs.")
+        try:
+            result = backup_status(ch_client, backup_id)
+            if wait:
+                result = wait_operation(ch_client, backup_id, timeout, poll_interval)
+        except Exception as e:
+            return module.fail_json(to_native(e))
+        module.exit_json(changed=False, **result)
+
+    if not name or not (disk or path):
+        return module.fail_json("'name' and 'disk' or 'path' parameters needs.")
+    if not (databases or tables):
+        return module.fail_json("'databases' or 'tables' parameter needs.")
+
+    target = destination(disk, path, name)
+    if state == 'backup' and is_backup_created(ch_client, target):
+        module.exit_json(changed=False, msg=f"Backup {target} alredy exists")
+
+    base = destination(disk, path, base_backup) if base_backup else None
+    try:
+        backup_id = start_operation(ch_client, state, databases, tables, target, base, cluster, settings)
+        if wait:
+            result = wait_operation(ch_client, backup_id, timeout, poll_interval)
+        else:
+            result = backup_status(ch_client, backup_id)
+    except Exception as e:
+        return module.fail_json(msg=f"{to_native(e)}: Error on {state} {target}", changed=bool(backup_id))
+
+    if state == 'backup' and result["status"] == "BACKUP_FAILED" and "BACKUP_ALREADY_EXISTS" in (result["error"] or ""):
+        module.exit_json(changed=False, msg=f"Backup {target} alredy exists", **result)
+    result["changed"] = True
+    if result["status"] in FAILED_STATUSES:
+        return module.fail_json(msg=f"{state} {target} failed: {result['error']}", **result)
+    if wait and result["status"] not in FINAL_STATUSES:
+        return module.fail_json(msg=f"Timeout waiting for {state} {target}", **result)
+    result["msg"] = f"{state} {target}: {result['status']}"
+    result.update(ch_client.ddl_queue_report())
+
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_copy
+short_description: возобновляемое копирование данных таблицы clickhouse по партициям, в том числе между кластерами
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse, в который выполняется копирование,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    source:
+        description:
+            исходная таблица в виде 'db_name.table_name'
+        required: true
+        type: str
+    destination:
+        description:
+            таблица назначения в виде 'db_name.table_name' на сервере host. Должна иметь ту же структуру
+            и тот же ключ партиционирования, что и исходная таблица.
+        required: true
+        type: str
+    source_host:
+        description:
+            адрес исходного сервера clickhouse в виде 'host:port' (нативный порт, обычно 9000), данные
+            читаются табличной функцией remote(). Если не указан, то исходная таблица находится на сервере host.
+            Один адрес - это один шард, поэтому для шардированной исходной таблицы нужно перечислить по адресу
+            каждого шарда через запятую ('ch-1:9000,ch-2:9000') или указать source_cluster.
+        required: false
+        type: str
+    source_user:
+        description:
+            имя пользователя на исходном сервере clickhouse
+        default: default
+        type: str
+    source_password:
+        description:
+            пароль пользователя на исходном сервере clickhouse
+        default: ''
+        type: str
+    source_named_collection:
+        description:
+            именованная коллекция с параметрами подключения к исходному серверу (addresses_expr, user, password),
+            используемая в remote() вместо source_host, source_user и source_password, чтобы пароль не попадал
+            в текст запросов.
+        required: false
+        type: str
+    source_cluster:
+        description:
+            кластер из конфигурации сервера host (remote_servers), на шардах которого находится исходная таблица.
+            Данные читаются табличной функцией cluster() с одной реплики каждого шарда. Исходная таблица
+            на движке Distributed не копируется - нужно указать её локальную таблицу и source_cluster.
+        required: false
+        type: str
+    partitions:
+        description:
+            идентификаторы партиций (partition_id), которые нужно скопировать. По умолчанию копируются все партиции.
+        required: false
+        type: list
+    workers:
+        description:
+            количество партиций, копируемых одновременно
+        default: 4
+        type: int
+    max_insert_threads:
+        description:
+            значение настройки max_insert_threads для запросов INSERT ... SELECT
+        default: 4
+        type: int
+    checkpoint_table:
+        description:
+            таблица в виде 'db_name.table_name', в которую записываются скопированные и проверенные партиции.
+            Создаётся автоматически, если не существует. При повторном запуске записанные партиции пропускаются.
+        default: default.copy_checkpoints
+        type: str
+    verify:
+        description:
+            сравнить количество строк и контрольную сумму каждой партиции в исходной таблице и в таблице назначения
+        default: true
+        type: bool
+    reset:
+        description:
+            удалить из checkpoint_table записи для пары source и destination и скопировать все партиции заново
+        default: false
+        type: bool
+notes:
+    - При использовании source_host пароль source_password передаётся в тексте запроса remote() и может попасть
+      в system.query_log, system.processes и логи сервера. Для копирования с серверов с паролем лучше создать
+      именованную коллекцию и передать её в source_named_collection.
+    - Перед копированием партиции, не записанной в checkpoint_table, эта партиция удаляется из таблицы назначения,
+      чтобы повторный запуск после сбоя не дублировал частично скопированные данные.
+'''
+
+EXAMPLES = r'''
+- name: скопировать таблицу events со старого кластера, 8 партиций одновременно
+    clickhouse_copy:
+      source: test_db.events
+      destination: test_db.events
+      source_host: 'old-ch-1.example.com:9000'
+      source_user: copier
+      source_password: '1111'
+      workers: 8
+      max_insert_threads: 8
+
+- name: скопировать таблицу, не передавая пароль в тексте запроса
+    clickhouse_copy:
+      source: test_db.events
+      destination: test_db.events
+      source_named_collection: old_cluster
+      workers: 8
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+copied:
+    description:
+        скопированные за этот запуск партиции - partition_id, количество строк, время копирования в секундах
+        и результат проверки или ошибка
+    returned: success
+    type: list
+skipped:
+    description:
+        партиции, скопированные при предыдущих запусках и записанные в checkpoint_table
+    returned: success
+    type: list
+'''
+
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import run_bounded
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+
+
+def table_source(source_host, source_user, source_password, database, table, named_collection=None, source_cluster=None):
+    if source_cluster:
+        return f"cluster('{source_cluster}', {database}, {table})"
+    if named_collection:
+        return f"remote({named_collection}, database = '{database}', table = '{table}')"
+    if source_host:
+        return f"remote('{source_host}', {database}, {table}, '{source_user}', '{source_password}')"
+    return f"{database}.{table}"
+
+
+def source_partitions(ch_client, system_parts, system_tables, database, table, partitions):
+    tables = ch_client.query(
+        f"SELECT partition_key, engine FROM {system_tables} WHERE database = '{database}' AND name = '{table}'").result_rows
+    if not tables:
+        raise Exception(f"Source table '{database}.{table}' does not exist")
+    partition_key, engine = tables[0]
+    if engine == "Distributed":
+        # у Distributed нет кусков в system.parts, а чтение с одного адреса не покрывает все шарды
+        raise Exception(f"Source table '{database}.{table}' is Distributed: copy its local table with source_cluster")
+    rows = ch_client.query(
+        f"SELECT partition_id, any(partition), sum(rows) FROM {system_parts} "
+        f"WHERE database = '{database}' AND table = '{table}' AND active GROUP BY partition_id ORDER BY partition_id").result_rows
+    result = [{"partition_id": r[0], "partition": r[1], "rows": r[2]} for r in rows
+              if not partitions or r[0] in partitions]
+    return partition_key, result
+
+
+def create_checkpoints(ch_client, checkpoint_table):
+    ch_client.command(
+        f"CREATE TABLE IF NOT EXISTS {checkpoint_table} (source String, destination String, partition_id String, "
+        "rows UInt64, checksum UInt64, finished_at DateTime DEFAULT now()) "
+        "ENGINE = MergeTree ORDER BY (source, destination, partition_id)")
+
+
+def read_checkpoints(ch_client, checkpoint_table, checkpoint_key):
+    return {row[0] for row in ch_client.query(
+        f"SELECT partition_id FROM {checkpoint_table} "
+        f"WHERE source = '{checkpoint_key[0]}' AND destination = '{checkpoint_key[1]}'").result_rows}
+
+
+def partition_stats(ch_client, table_expr, condition):
+    row = ch_client.query(f"SELECT count(), sum(cityHash64(*)) FROM {table_expr} WHERE {condition}").result_rows[0]
+    return row[0], row[1]
+
+
+def copy_partitions(host, conn, source_expr, destination, partition_key, pending, checkpoint_table, checkpoint_key,
+                    workers, max_insert_threads, verify):
+    def copy(ch_client, task):
+        # партиция выбирается по выражению ключа партиционирования, так как виртуальный столбец
+        # _partition_id недоступен при чтении через remote()
+        condition = f"({partition_key}) = {task['partition']}" if partition_key else "1"
+        started = time.monotonic()
+        ch_client.command(f"ALTER TABLE {destination} DROP PARTITION ID '{task['partition_id']}'")
+        ch_client.command(f"INSERT INTO {destination} SELECT * FROM {source_expr} WHERE {condition}",
+                          settings={"max_insert_threads": max_insert_threads}, idempotent=False)
+        rows, checksum = partition_stats(ch_client, destination, condition)
+        result = {"rows": rows, "duration": round(time.monotonic() - started, 3)}
+        if verify:
+            source_rows, source_checksum = partition_stats(ch_client, source_expr, condition)
+            if (rows, checksum) != (source_rows, source_checksum):
+                return dict(result, verified=False,
+                            error=f"Partition mismatch: {source_rows} rows in source, {rows} rows in destination")
+            result["verified"] = True
+        ch_client.command(
+            f"INSERT INTO {checkpoint_table} (source, destination, partition_id, rows, checksum) VALUES "
+            f"('{checkpoint_key[0]}', '{checkpoint_key[1]}', '{task['partition_id']}', {rows}, {checksum or 0})")
+        return result
+
+    tasks = [dict(p, host=host) for p in pending]
+    copied = run_bounded(tasks, copy, conn, workers, workers)
+    return [{k: v for k, v in c.items() if k != "host"} for c in copied]
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "source": {"type": "str", "required": True},
+        "destination": {"type": "str", "required": True},
+        "source_host": {"type": "str", "required": False},
+        "source_user": {"type": "str", "default": "default"},
+        "source_password": {"type": "str", "default": "", "no_log": True},
+        "source_named_collection": {"type": "str", "required": False},
+        "source_cluster": {"type": "str", "required": False},
+        "partitions": {"type": "list", "required": False},
+        "workers": {"type": "int", "default": 4},
+        "max_insert_threads": {"type": "int", "default": 4},
+        "checkpoint_table": {"type": "str", "default": "default.copy_checkpoints"},
+        "verify": {"type": "bool", "default": True},
+        "reset": {"type": "bool", "default": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        mutually_exclusive=[["source_named_collection", "source_host", "source_cluster"]],
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    source = module.params["source"]
+    destination = module.params["destination"]
+    source_host = module.params["source_host"]
+    source_user = module.params["source_user"]
+    source_password = module.params["source_password"]
+    named_collection = module.params["source_named_collection"]
+    source_cluster = module.params["source_cluster"]
+    partitions = module.params["partitions"]
+    workers = module.params["workers"]
+    max_insert_threads = module.params["max_insert_threads"]
+    checkpoint_table = module.params["checkpoint_table"]
+    verify = module.params["verify"]
+    reset = module.params["reset"]
+    retry = retry_params(module.params)
+    conn = {"username": login_user, "password": login_password, "port": port, "retry": retry}
+
+    if '.' not in source or '.' not in destination:
+        return module.fail_json("'source' and 'destination' must be set as 'db_name.table_name'")
+    database, table = source.split('.', 1)
+    source_expr = table_source(source_host, source_user, source_password, database, table, named_collection, source_cluster)
+    checkpoint_key = (f"{named_collection or source_cluster or source_host or 'local'}/{source}", destination)
+
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+        create_checkpoints(ch_client, checkpoint_table)
+        if reset:
+            ch_client.command(f"DELETE FROM {checkpoint_table} "
+                              f"WHERE source = '{checkpoint_key[0]}' AND destination = '{checkpoint_key[1]}'")
+        partition_key, source_parts = source_partitions(
+            ch_client,
+            table_source(source_host, source_user, source_password, "system", "parts", named_collection, source_cluster),
+            table_source(source_host, source_user, source_password, "system", "tables", named_collection, source_cluster),
+            database, table, partitions)
+        done = read_checkpoints(ch_client, checkpoint_table, checkpoint_key)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    pending = [p for p in source_parts if p["partition_id"] not in done]
+    skipped = [p["partition_id"] for p in source_parts if p["partition_id"] in done]
+    copied = copy_partitions(host or "localhost", conn, source_expr, destination, partition_key, pending,
+                             checkpoint_table, checkpoint_key, workers, max_insert_threads, verify)
+    result = {"changed": bool(copied), "copied": copied, "skipped": skipped}
+    failed = [c for c in copied if c.get("error")]
+    if failed:
+        return module.fail_json(msg=f"Copy of {len(failed)} partitions failed, rerun to resume", **result)
+    result["msg"] = f"Copied {len(copied)} partitions, {len(skipped)} partitions alredy copied"
+
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ DOCUMENTATION = r'''
 ---
 module: clickhouse_db
 short_description: создание и удаление баз данных в clickhouse
+extends_documentation_fragment: ch.modules.clickhouse_retry
 options:
     login_user:
         description:
@@ -62,6 +63,61 @@ options:
             параметры подключения, при использовании движка базы данных для внешних источников
         requeried: false
         type: dict
+    named_collection:
+        description:
+            имя коллекции кред, созданной модулем clickhouse_pgcol. Используется с движками
+            'PostgreSQL' и 'MaterializedPostgreSQL' вместо параметра engine_settings.
+        required: false
+        type: str
+    tables:
+        description:
+            список таблиц postgresql, которые будут реплицироваться движком 'MaterializedPostgreSQL'
+            (настройка materialized_postgresql_tables_list). Если не задан, то реплицируются все таблицы схемы.
+        required: false
+        type: list
+    db_settings:
+        description:
+            настройки движка базы данных, передаваемые в секции SETTINGS, например
+            materialized_postgresql_max_block_size, materialized_postgresql_backoff_min_ms,
+            materialized_postgresql_backoff_max_ms, materialized_postgresql_backoff_factor
+        required: false
+        type: dict
+    zk_path:
+        description:
+            путь в zookeeper/keeper для базы данных на движке 'Replicated'.
+            По умолчанию используется '/clickhouse/databases/<db_name>'.
+        required: false
+        type: str
+    shard_name:
+        description:
+            имя шарда для движка 'Replicated', по умолчанию используется макрос '{shard}'
+        default: '{shard}'
+        type: str
+    replica_name:
+        description:
+            имя реплики для движка 'Replicated', по умолчанию используется макрос '{replica}'
+        default: '{replica}'
+        type: str
+    convergence_timeout:
+        description:
+            время в секундах, в течение которого после создания базы данных на движке 'Replicated'
+            ожидается, что все реплики кластера догонят лог репликации базы данных
+        default: 60
+        type: int
+    status:
+        description:
+            вернуть состояние репликации базы данных на движке 'MaterializedPostgreSQL' - прогресс
+            первоначального снимка таблиц и количество строк в clickhouse и postgresql.
+            Количество строк в postgresql - оценка из статистики pg_stat_user_tables, получаемая одним
+            запросом к каталогу, таблицы postgresql при этом не сканируются. Схема таблиц берётся из настройки
+            materialized_postgresql_schema, параметров движка или параметра schema именованной коллекции.
+            Отставание репликации возвращается по слотам из pg_replication_slots в байтах WAL от отправленной
+            позиции до подтверждённой clickhouse. Текущая позиция WAL (pg_current_wal_lsn()) через табличную
+            функцию postgresql() недоступна, поэтому ещё не отправленный WAL в отставание не входит.
+            Возвращает результат в __имя_переменной__.tables, __имя_переменной__.snapshot_progress
+            и __имя_переменной__.replication_slots.
+        default: false
+        type: bool
 '''
 
 EXAMPLES = r'''
@@ -82,6 +138,38 @@ EXAMPLES = r'''
         'password': '4r5t6y7u'
       cluster: my_cluster
 
+- name: создать реплицируемую базу данных test_repl на всех репликах кластера
+    clickhouse_db:
+      db_name: test_repl
+      engine: Replicated
+      zk_path: /clickhouse/databases/test_repl
+      cluster: my_cluster
+
+- name: создать реплику базы данных pg_test_db на движке MaterializedPostgreSQL
+    clickhouse_db:
+      db_name: pg_replica
+      engine: MaterializedPostgreSQL
+      named_collection: test_collection
+      tables:
+        - orders
+        - customers
+      db_settings:
+        materialized_postgresql_max_block_size: 65536
+        materialized_postgresql_backoff_min_ms: 200
+        materialized_postgresql_backoff_max_ms: 10000
+        materialized_postgresql_backoff_factor: 2
+
+- name: получить состояние репликации базы данных pg_replica
+    clickhouse_db:
+      db_name: pg_replica
+      engine: MaterializedPostgreSQL
+      named_collection: test_collection
+      tables:
+        - orders
+        - customers
+      status: true
+  register: replica_status
+
 - name: удаление базы данных test_db
    clickhouse_db:
      db_name: test_db
@@ -100,18 +188,57 @@ msg:
         короткое сообщение, указывающее по произошедшие изменеия
     returned: success
     type: str
+tables:
+    description:
+        состояние репликации по каждой таблице - загружена ли таблица в clickhouse, ch_rows - количество строк
+        в clickhouse (включая ещё не схлопнутые версии и удалённые строки, поэтому разница с postgresql не является
+        отставанием) и pg_rows_estimate - оценка количества строк в postgresql по статистике
+    returned: status
+    type: list
+converged:
+    description:
+        все ли реплики кластера создали базу данных на движке 'Replicated' и догнали её лог репликации
+    returned: engine Replicated
+    type: bool
+replicas:
+    description:
+        состояние базы данных на движке 'Replicated' по каждой реплике - движок, активность реплики,
+        отставание от лога репликации, количество таблиц и загружаемых кусков
+    returned: engine Replicated
+    type: list
+snapshot_progress:
+    description:
+        доля таблиц, для которых завершён первоначальный снимок данных
+    returned: status
+    type: float
+replication_slots:
+    description:
+        слоты логической репликации базы данных в postgresql - slot_name, active, confirmed_flush_lsn, sent_lsn
+        и lag_bytes - отставание в байтах WAL (null, если отправитель не активен или позиция недоступна
+        пользователю без роли pg_read_all_stats). Пустой список, если каталог postgresql недоступен.
+    returned: status
+    type: list
+ddl_queue:
+    description:
+        глубина очереди распределённого DDL кластера и суммарное время ожидания её освобождения в секундах
+    returned: ddl_queue_high_water
+    type: dict
 '''
 
+import time
+
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_native
-from clickhouse_connect import get_client
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import get_replicas, on_replicas
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import format_setting, quote
 
 
 def is_db_exist(ch_client, db_name):
     return ch_client.command(f"SELECT count(*) FROM system.databases WHERE name = '{db_name}'") > 0
 
 
-def create_db(ch_client, db_name, cluster, engine, engine_settings):
+def create_db(ch_client, db_name, cluster, engine, engine_settings, named_collection, tables, db_settings):
     if is_db_exist(ch_client, db_name):
         return {"changed": False, "msg": f"Database '{db_name}' alredy exists"}
     query_fragments = [f"CREATE DATABASE {db_name}"]
@@ -119,15 +246,184 @@ def create_db(ch_client, db_name, cluster, engine, engine_settings):
         query_fragments.append(f"ON CLUSTER {cluster}")
     if engine:
         query_fragments.append(f"ENGINE = {engine}")
-        if engine_settings:
+        if named_collection:
+            query_fragments.append(f"({named_collection})")
+        elif engine_settings:
             settings = [ f"'{setting}'" for setting in engine_settings.values() ]
             query_fragments.append(f"({', '.join(settings)})")
+    db_settings = dict(db_settings or {})
+    if tables:
+        db_settings["materialized_postgresql_tables_list"] = ','.join(tables)
+    if db_settings:
+        settings_kit = [f"{k} = {format_setting(v)}" for k, v in db_settings.items()]
+        query_fragments.append("SETTINGS " + ", ".join(settings_kit))
     query = ' '.join(query_fragments)
     # raise Exception(query)
-    ch_client.command(query)
+    query_settings = {}
+    if engine == "MaterializedPostgreSQL":
+        query_settings["allow_experimental_database_materialized_postgresql"] = 1
+    ch_client.command(query, settings=query_settings)
     return {"changed": True, "msg": f"Database '{db_name}' created"}
 
 
+def replicated_engine(db_name, zk_path, shard_name, replica_name):
+    zk_path = zk_path or f"/clickhouse/databases/{db_name}"
+    return f"Replicated('{zk_path}', '{shard_name}', '{replica_name}')"
+
+
+def replica_db_status(ch_client, db_name):
+    status = {"engine": None, "is_active": None, "replication_lag": None, "tables": 0, "fetches": 0}
+    engine = ch_client.query(f"SELECT engine FROM system.databases WHERE name = '{db_name}'").result_rows
+    if not engine:
+        return status
+    status["engine"] = engine[0][0]
+    status["tables"] = ch_client.command(f"SELECT count() FROM system.tables WHERE database = '{db_name}'")
+    status["fetches"] = ch_client.command(f"SELECT count() FROM system.replicated_fetches WHERE database = '{db_name}'")
+    try:
+        # is_active и replication_lag есть в system.clusters только в новых версиях clickhouse
+        rows = ch_client.query(
+            "SELECT is_active, replication_lag FROM system.clusters "
+            f"WHERE cluster = '{db_name}' AND is_local").result_rows
+        if rows:
+            status["is_active"], status["replication_lag"] = rows[0][0], rows[0][1]
+    except Exception:
+        pass
+    return status
+
+
+def is_converged(replicas):
+    if any(r.get("error") or r["engine"] != "Replicated" for r in replicas):
+        return False
+    if any(r["is_active"] == 0 or r["replication_lag"] or r["fetches"] for r in replicas):
+        return False
+    return len({r["tables"] for r in replicas}) == 1
+
+
+def create_replicated_db(ch_client, module, conn, db_name, cluster, host, zk_path, shard_name, replica_name, timeout):
+    # DDL внутри базы данных идёт через её собственный лог репликации, поэтому сама база создаётся
+    # на каждой реплике напрямую, минуя очередь распределённого DDL (ON CLUSTER)
+    if cluster:
+        replicas = get_replicas(ch_client, cluster)
+    else:
+        replicas = [{"shard_num": None, "replica_num": None, "host": host or "localhost", "is_local": True}]
+    query = f"CREATE DATABASE IF NOT EXISTS {db_name} ENGINE = {replicated_engine(db_name, zk_path, shard_name, replica_name)}"
+
+    def create(replica_client, replica):
+        if is_db_exist(replica_client, db_name):
+            return {"created": False}
+        replica_client.command(query)
+        return {"created": True}
+
+    created = on_replicas(replicas, create, conn)
+    errors = [r for r in created if r.get("error")]
+    if errors:
+        return module.fail_json(msg=f"Error on query: {query}", changed=any(r.get("created") for r in created), replicas=errors)
+    changed = any(r["created"] for r in created)
+
+    deadline = time.monotonic() + timeout
+    while True:
+        statuses = on_replicas(replicas, lambda replica_client, replica: replica_db_status(replica_client, db_name), conn)
+        converged = is_converged(statuses)
+        if converged or time.monotonic() >= deadline:
+            break
+        time.sleep(2)
+    result = {"changed": changed, "converged": converged, "replicas": statuses}
+    if not converged:
+        return module.fail_json(msg=f"Database '{db_name}' replicas did not converge in {timeout}s", **result)
+    result["msg"] = f"Database '{db_name}' {'created' if changed else 'alredy exists'} on {len(statuses)} replicas"
+    return result
+
+
+def pg_catalog_source(named_collection, engine_settings, view):
+    # представление view схемы pg_catalog через табличную функцию postgresql()
+    if named_collection:
+        return f"postgresql({named_collection}, table = {quote(view)}, schema = 'pg_catalog')"
+    if not engine_settings:
+        return None
+    # позиционные параметры движка: 'host:port', 'database', 'user', 'password'[, 'schema']
+    values = list(engine_settings.values())
+    args = [values[0], values[1], view] + values[2:4] + ['pg_catalog']
+    return "postgresql(" + ", ".join(quote(v) for v in args) + ")"
+
+
+def pg_schema(ch_client, named_collection, engine_settings, db_settings):
+    # схема реплицируемых таблиц: настройка materialized_postgresql_schema, пятый параметр движка
+    # или параметр schema именованной коллекции
+    schema = (db_settings or {}).get("materialized_postgresql_schema")
+    if schema:
+        return str(schema).strip("'")
+    if not named_collection:
+        values = list((engine_settings or {}).values())
+        return values[4] if len(values) > 4 else None
+    try:
+        rows = ch_client.query(
+            f"SELECT collection['schema'] FROM system.named_collections WHERE name = {quote(named_collection)}").result_rows
+    except Exception:
+        return None
+    # без show_named_collections_secrets значения коллекции скрыты
+    return rows[0][0] if rows and rows[0][0] not in ("", "[HIDDEN]") else None
+
+
+def pg_rows_estimate(ch_client, named_collection, engine_settings, schema, tables):
+    # одна выборка из каталога вместо count() по каждой таблице на основном сервере postgresql
+    source = pg_catalog_source(named_collection, engine_settings, 'pg_stat_user_tables')
+    if not source or not tables:
+        return {}
+    query = (f"SELECT relname, n_live_tup FROM {source} WHERE relname IN ({', '.join(quote(t) for t in tables)})"
+             + (f" AND schemaname = {quote(schema)}" if schema else ""))
+    try:
+        return {row[0]: row[1] for row in ch_client.query(query).result_rows}
+    except Exception:
+        return {}
+
+
+def lsn(value):
+    # позиция WAL postgresql вида 'X/Y'
+    high, low = value.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def replication_slots(ch_client, named_collection, engine_settings, db_settings):
+    # отставание слота - байты WAL между отправленной позицией (sent_lsn из pg_stat_replication) и подтверждённой
+    # clickhouse позицией confirmed_flush_lsn. pg_current_wal_lsn() через табличную функцию postgresql()
+    # не вызвать, поэтому WAL, ещё не прочитанный отправителем, в отставание не входит
+    slots_source = pg_catalog_source(named_collection, engine_settings, 'pg_replication_slots')
+    if not slots_source:
+        return []
+    # имя слота задаётся настройкой materialized_postgresql_replication_slot, иначе clickhouse создаёт слот
+    # с суффиксом _ch_replication_slot
+    slot = str((db_settings or {}).get("materialized_postgresql_replication_slot") or "").strip("'")
+    condition = f"slot_name = {quote(slot)}" if slot else "slot_name LIKE '%ch_replication_slot'"
+    try:
+        slots = ch_client.query(
+            f"SELECT slot_name, active, active_pid, confirmed_flush_lsn FROM {slots_source} WHERE {condition}").result_rows
+        senders = dict(ch_client.query(
+            f"SELECT pid, sent_lsn FROM {pg_catalog_source(named_collection, engine_settings, 'pg_stat_replication')}").result_rows)
+    except Exception:
+        return []
+    result = []
+    for name, active, pid, confirmed in slots:
+        sent = senders.get(pid)
+        result.append({"slot_name": name, "active": bool(active), "confirmed_flush_lsn": confirmed, "sent_lsn": sent,
+                       "lag_bytes": lsn(sent) - lsn(confirmed) if sent and confirmed else None})
+    return result
+
+
+def materialized_pg_status(ch_client, db_name, named_collection, engine_settings, db_settings, tables):
+    loaded = {row[0]: row[1] for row in ch_client.query(
+        f"SELECT name, total_rows FROM system.tables WHERE database = '{db_name}'").result_rows}
+    expected = tables or sorted(loaded)
+    schema = pg_schema(ch_client, named_collection, engine_settings, db_settings)
+    pg_rows = pg_rows_estimate(ch_client, named_collection, engine_settings, schema, expected)
+    tables_status = [{"table": table, "loaded": table in loaded, "ch_rows": loaded.get(table),
+                      "pg_rows_estimate": pg_rows.get(table)} for table in expected]
+    snapshot_progress = 1.0
+    if expected:
+        snapshot_progress = round(sum(1 for t in tables_status if t["loaded"]) / len(expected), 4)
+    return {"changed": False, "tables": tables_status, "snapshot_progress": snapshot_progress,
+            "replication_slots": replication_slots(ch_client, named_collection, engine_settings, db_settings)}
+
+
 def drop_db(ch_client, db_name, cluster):
     query = f"DROP DATABASE IF EXISTS {db_name}"
     if cluster:
@@ -147,9 +443,19 @@ def main():
         "state": {"type": "str",  "default": "present", "choices": ["abscent", "present"]},
         "cluster": {"type": "str", "required": False},
         "engine": {"type": "str", "required": False},
-        "engine_settings": {"type": "dict", "required": False}
+        "engine_settings": {"type": "dict", "required": False},
+        "named_collection": {"type": "str", "required": False},
+        "tables": {"type": "list", "required": False},
+        "db_settings": {"type": "dict", "required": False},
+        "zk_path": {"type": "str", "required": False},
+        "shard_name": {"type": "str", "default": "{shard}"},
+        "replica_name": {"type": "str", "default": "{replica}"},
+        "convergence_timeout": {"type": "int", "default": 60},
+        "status": {"type": "bool", "default": False}
     }
 
+    module_args.update(retry_argument_spec())
+
     result = {
         "changed": False
     }
@@ -171,18 +477,33 @@ def main():
     cluster = module.params["cluster"]
     engine = module.params["engine"]
     engine_settings = module.params["engine_settings"]
+    named_collection = module.params["named_collection"]
+    tables = module.params["tables"]
+    db_settings = module.params["db_settings"]
+    zk_path = module.params["zk_path"]
+    shard_name = module.params["shard_name"]
+    replica_name = module.params["replica_name"]
+    convergence_timeout = module.params["convergence_timeout"]
+    status = module.params["status"]
+    retry = retry_params(module.params)
+    conn = {"username": login_user, "password": login_password, "port": port, "retry": retry}
 
     try:
-        ch_client = get_client(username=login_user, password=login_password, port=port, host=host)
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
     except Exception as e:
         return module.fail_json(to_native(e))
 
+    if status:
+        module.exit_json(**materialized_pg_status(ch_client, db_name, named_collection, engine_settings, db_settings, tables))
 
-    if state == 'present':
-        result = create_db(ch_client, db_name, cluster, engine, engine_settings)
+    if state == 'present' and engine == 'Replicated':
+        result = create_replicated_db(ch_client, module, conn, db_name, cluster, host, zk_path, shard_name, replica_name, convergence_timeout)
+    elif state == 'present':
+        result = create_db(ch_client, db_name, cluster, engine, engine_settings, named_collection, tables, db_settings)
     else:
         result = drop_db(ch_client, db_name, cluster)
 
+    result.update(ch_client.ddl_queue_report())
     module.exit_json(**result)
 
 
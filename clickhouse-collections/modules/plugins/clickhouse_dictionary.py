@@ -0,0 +1,410 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_dictionary
+short_description: создание словарей clickhouse из внешних источников и поочерёдная перезагрузка словарей на репликах
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    name:
+        description:
+            имя словаря в виде 'db_name.dictionary_name'
+        required: true
+        aliases: [dictionary]
+        type: str
+    state:
+        description:
+            если состояние установлено 'present'(по умолчанию), то указанный словарь будет создан или пересоздан
+            при изменении описания, если установлено 'abscent', то указанный словарь будет удалён.
+        default: present
+        choices: [abscent, present]
+        type: str
+    cluster:
+        description:
+            название кластера clickhouse, на котором будут выполнены операции. Если не указан,
+            то операции будут выполнены только на целевой ноде, указанной при запуске ansible-playbook.
+        required: false
+        type: str
+    collection:
+        description:
+            имя коллекции кред postgresql, созданной модулем clickhouse_pgcol, из которой загружается словарь.
+            Обязательно должен быть указан либо этот параметр, либо параметр 'source_db'.
+        required: false
+        type: str
+    source_db:
+        description:
+            база данных clickhouse, из таблицы которой загружается словарь, например база данных
+            на движке 'PostgreSQL', созданная модулем clickhouse_db
+        required: false
+        type: str
+    source_table:
+        description:
+            таблица источника, из которой загружается словарь
+        required: false
+        type: str
+    source_user:
+        description:
+            пользователь clickhouse, под которым словарь читает таблицу source_db (USER источника CLICKHOUSE).
+            Если не указан, то используется пользователь default
+        required: false
+        type: str
+    source_password:
+        description:
+            пароль пользователя source_user. В create_table_query сервер скрывает пароль,
+            поэтому его изменение не приводит к пересозданию словаря
+        required: false
+        no_log: true
+        type: str
+    columns:
+        description:
+            столбцы словаря в виде словаря 'имя столбца: тип', включая столбцы первичного ключа
+        required: false
+        type: dict
+    primary_key:
+        description:
+            столбцы первичного ключа. Составной ключ допускается только для layout 'complex_key_hashed'.
+        required: false
+        type: list
+    layout:
+        description:
+            способ размещения словаря в памяти
+        default: hashed
+        choices: [flat, hashed, sparse_hashed, complex_key_hashed, range_hashed, cache]
+        type: str
+    layout_params:
+        description:
+            параметры способа размещения, например 'size_in_cells' для 'cache'
+        required: false
+        type: dict
+    range_min:
+        description:
+            столбец начала диапазона для layout 'range_hashed'
+        required: false
+        type: str
+    range_max:
+        description:
+            столбец конца диапазона для layout 'range_hashed'
+        required: false
+        type: str
+    lifetime_min:
+        description:
+            минимальный интервал обновления словаря в секундах
+        default: 300
+        type: int
+    lifetime_max:
+        description:
+            максимальный интервал обновления словаря в секундах. Сервер выбирает момент обновления
+            случайно в интервале, что распределяет нагрузку на источник между репликами.
+        default: 360
+        type: int
+    reload:
+        description:
+            выполнить SYSTEM RELOAD DICTIONARY на всех репликах кластера по очереди
+        default: false
+        type: bool
+    stagger:
+        description:
+            пауза в секундах между перезагрузками словаря на соседних репликах
+        default: 10
+        type: int
+'''
+
+EXAMPLES = r'''
+- name: создать словарь клиентов из таблицы customers в postgresql
+    clickhouse_dictionary:
+      name: test_db.customers_dict
+      collection: test_collection
+      source_table: customers
+      columns:
+        id: UInt64
+        name: String
+        region: String
+      primary_key:
+        - id
+      layout: hashed
+      lifetime_min: 600
+      lifetime_max: 900
+      cluster: my_cluster
+
+- name: перезагрузить словарь на всех репликах с паузой 30 секунд
+    clickhouse_dictionary:
+      name: test_db.customers_dict
+      cluster: my_cluster
+      reload: true
+      stagger: 30
+
+- name: удалить словарь
+    clickhouse_dictionary:
+      name: test_db.customers_dict
+      cluster: my_cluster
+      state: abscent
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+dictionaries:
+    description:
+        состояние словаря на каждой реплике из system.dictionaries - статус загрузки, тип размещения,
+        количество элементов, занимаемая память в байтах, время последней загрузки в секундах и последняя ошибка
+    returned: state present
+    type: list
+reloads:
+    description:
+        результат перезагрузки словаря на каждой реплике с временем перезагрузки в секундах
+    returned: reload
+    type: list
+'''
+
+import re
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import get_replicas, on_replicas
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import quote
+
+
+def layout_clause(layout, layout_params):
+    params = dict(layout_params or {})
+    if layout == 'cache' and 'size_in_cells' not in params:
+        params['size_in_cells'] = 1000000
+    params_kit = [f"{k.upper()} {v}" for k, v in params.items()]
+    return f"LAYOUT({layout.upper()}({' '.join(params_kit)}))"
+
+
+def dictionary_query(name, cluster, collection, source_db, source_table, source_user, source_password, columns,
+                     primary_key, layout, layout_params, range_min, range_max, lifetime_min, lifetime_max):
+    query_fragments = [f"CREATE OR REPLACE DICTIONARY {name}"]
+    if cluster:
+        query_fragments.append(f"ON CLUSTER {cluster}")
+    query_fragments.append("(" + ", ".join(f"{col} {col_type}" for col, col_type in columns.items()) + ")")
+    query_fragments.append(f"PRIMARY KEY {', '.join(primary_key)}")
+    if collection:
+        query_fragments.append(f"SOURCE(POSTGRESQL(NAME {collection} TABLE '{source_table}'))")
+    else:
+        credentials = ""
+        if source_user:
+            credentials += f" USER {quote(source_user)}"
+        if source_password:
+            credentials += f" PASSWORD {quote(source_password)}"
+        query_fragments.append(f"SOURCE(CLICKHOUSE(DB '{source_db}' TABLE '{source_table}'{credentials}))")
+    query_fragments.append(f"LIFETIME(MIN {lifetime_min} MAX {lifetime_max})")
+    query_fragments.append(layout_clause(layout, layout_params))
+    if layout == 'range_hashed':
+        query_fragments.append(f"RANGE(MIN {range_min} MAX {range_max})")
+    return ' '.join(query_fragments)
+
+
+def normalize_ddl(ch_client, query):
+    # описания сравниваются после форматирования сервером, так как create_table_query хранится
+    # в каноническом виде clickhouse; сравнивается только описание словаря после имени.
+    # Пароль источника в create_table_query скрыт, поэтому он не сравнивается
+    try:
+        query = ch_client.command(f"SELECT formatQuerySingleLine({quote(query)})")
+    except Exception:
+        pass
+    query = query[query.find('('):].replace('`', '').lower()
+    query = re.sub(r"\bpassword\s+'(?:[^'\\]|\\.)*'", "password '[hidden]'", query)
+    query = re.sub(r'\s+', ' ', query)
+    return re.sub(r'\s*([(),=])\s*', r'\1', query).strip()
+
+
+def current_ddl(ch_client, name):
+    database, dictionary = name.split('.', 1)
+    rows = ch_client.query(
+        f"SELECT create_table_query FROM system.tables WHERE database = '{database}' AND name = '{dictionary}'").result_rows
+    return rows[0][0] if rows else None
+
+
+def dictionary_status(ch_client, name):
+    database, dictionary = name.split('.', 1)
+    rows = ch_client.query(
+        "SELECT status, type, element_count, bytes_allocated, loading_duration, last_successful_update_time, last_exception "
+        f"FROM system.dictionaries WHERE database = '{database}' AND name = '{dictionary}'").result_rows
+    if not rows:
+        return {"status": None}
+    row = rows[0]
+    return {"status": row[0], "type": row[1], "element_count": row[2], "bytes_allocated": row[3],
+            "loading_duration": row[4], "last_successful_update_time": str(row[5]), "last_exception": row[6]}
+
+
+def reload_staggered(replicas, conn, name, stagger):
+    def reload(ch_client, replica):
+        started = time.monotonic()
+        ch_client.command(f"SYSTEM RELOAD DICTIONARY {name}")
+        return {"duration": round(time.monotonic() - started, 3)}
+
+    # реплики перезагружаются строго по очереди, чтобы источник не получал запросы от всех реплик сразу
+    reloads = []
+    for n, replica in enumerate(replicas):
+        if n:
+            time.sleep(stagger)
+        reloads += on_replicas([replica], reload, conn)
+    return reloads
+
+
+def drop_dictionary(ch_client, module, name, cluster):
+    query = f"DROP DICTIONARY IF EXISTS {name}"
+    if cluster:
+        query += f" ON CLUSTER {cluster}"
+    try:
+        ch_client.command(query)
+    except Exception as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+    return {"changed": True, "msg": f"Dictionary '{name}' deleted"}
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "name": {"type": "str", "required": True, "aliases": ["dictionary"]},
+        "state": {"type": "str", "default": "present", "choices": ["abscent", "present"]},
+        "cluster": {"type": "str", "required": False},
+        "collection": {"type": "str", "required": False},
+        "source_db": {"type": "str", "required": False},
+        "source_table": {"type": "str", "required": False},
+        "source_user": {"type": "str", "required": False},
+        "source_password": {"type": "str", "required": False, "no_log": True},
+        "columns": {"type": "dict", "required": False},
+        "primary_key": {"type": "list", "required": False},
+        "layout": {"type": "str", "default": "hashed",
+                   "choices": ["flat", "hashed", "sparse_hashed", "complex_key_hashed", "range_hashed", "cache"]},
+        "layout_params": {"type": "dict", "required": False},
+        "range_min": {"type": "str", "required": False},
+        "range_max": {"type": "str", "required": False},
+        "lifetime_min": {"type": "int", "default": 300},
+        "lifetime_max": {"type": "int", "default": 360},
+        "reload": {"type": "bool", "default": False},
+        "stagger": {"type": "int", "default": 10}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        mutually_exclusive=[["collection", "source_db"]],
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    name = module.params["name"]
+    state = module.params["state"]
+    cluster = module.params["cluster"]
+    collection = module.params["collection"]
+    source_db = module.params["source_db"]
+    source_table = module.params["source_table"]
+    source_user = module.params["source_user"]
+    source_password = module.params["source_password"]
+    columns = module.params["columns"]
+    primary_key = module.params["primary_key"]
+    layout = module.params["layout"]
+    layout_params = module.params["layout_params"]
+    range_min = module.params["range_min"]
+    range_max = module.params["range_max"]
+    lifetime_min = module.params["lifetime_min"]
+    lifetime_max = module.params["lifetime_max"]
+    reload = module.params["reload"]
+    stagger = module.params["stagger"]
+    retry = retry_params(module.params)
+    conn = {"username": login_user, "password": login_password, "port": port, "retry": retry}
+
+    if '.' not in name:
+        return module.fail_json(f"Dictionary '{name}' must be set as 'db_name.dictionary_name'")
+
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+        if cluster:
+            replicas = get_replicas(ch_client, cluster)
+        else:
+            replicas = [{"shard_num": None, "replica_num": None, "host": host or "localhost", "is_local": True}]
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    if state == 'abscent':
+        result = drop_dictionary(ch_client, module, name, cluster)
+        result.update(ch_client.ddl_queue_report())
+        module.exit_json(**result)
+
+    result = {"changed": False, "msg": f"Dictionary '{name}' is up to date"}
+    if columns:
+        if not primary_key or not source_table or not (collection or source_db):
+            return module.fail_json("'primary_key', 'source_table' and 'collection' or 'source_db' parameters needs.")
+        if len(primary_key) > 1 and layout != 'complex_key_hashed':
+            return module.fail_json("Composite 'primary_key' needs 'complex_key_hashed' layout.")
+        if layout == 'range_hashed' and not (range_min and range_max):
+            return module.fail_json("'range_min' and 'range_max' parameters needs for 'range_hashed' layout.")
+        query = dictionary_query(name, cluster, collection, source_db, source_table, source_user, source_password, columns,
+                                 primary_key, layout, layout_params, range_min, range_max, lifetime_min, lifetime_max)
+        current = current_ddl(ch_client, name)
+        if current is None or normalize_ddl(ch_client, current) != normalize_ddl(ch_client, query):
+            try:
+                ch_client.command(query)
+            except Exception as e:
+                return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+            result = {"changed": True, "msg": f"Dictionary '{name}' {'created' if current is None else 'changed'}"}
+
+    if reload:
+        result["reloads"] = reload_staggered(replicas, conn, name, stagger)
+        result["changed"] = True
+        failed = [r for r in result["reloads"] if r.get("error")]
+        if failed:
+            return module.fail_json(msg=f"Dictionary '{name}' reload failed on {len(failed)} replicas", **result)
+
+    result["dictionaries"] = on_replicas(replicas, lambda replica_client, replica: dictionary_status(replica_client, name), conn)
+    result.update(ch_client.ddl_queue_report())
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
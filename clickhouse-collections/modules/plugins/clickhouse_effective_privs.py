@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_effective_privs
+short_description: итоговые права пользователей clickhouse с учётом вложенных ролей и иерархии привилегий
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    users:
+        description:
+            пользователи и роли, для которых возвращаются итоговые роли и права. Если не указаны и не задан
+            параметр who_can, то права возвращаются для всех пользователей.
+        required: false
+        type: list
+    who_can:
+        description:
+            вопросы вида "кто может выполнить привилегию на объекте". Каждый вопрос задаётся словарём с ключами
+            privilege, database, table и column (необязательные ключи означают уровень выше).
+        required: false
+        type: list
+    expand:
+        description:
+            раскрыть каждую выданную привилегию во все включаемые ей привилегии (ALL -> SELECT, INSERT, ...)
+        default: false
+        type: bool
+    default_roles_only:
+        description:
+            учитывать только роли, назначенные пользователям по умолчанию (DEFAULT ROLE), без ролей,
+            которые пользователь может включить командой SET ROLE
+        default: false
+        type: bool
+'''
+
+EXAMPLES = r'''
+- name: кто может читать таблицу test_db.events и удалять таблицы в test_db
+    clickhouse_effective_privs:
+      who_can:
+        - privilege: SELECT
+          database: test_db
+          table: events
+        - privilege: DROP TABLE
+          database: test_db
+  register: access
+
+- name: итоговые права пользователей user1 и user2 с раскрытием привилегий
+    clickhouse_effective_privs:
+      users:
+        - user1
+        - user2
+      expand: true
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+effective:
+    description:
+        для каждого пользователя или роли - все действующие роли с учётом вложенности и права, выданные
+        ему самому и его ролям, с указанием роли, через которую получено право (via)
+    returned: success
+    type: dict
+who_can:
+    description:
+        ответы на вопросы who_can - привилегия, объект, пользователи и роли, которые её имеют
+    returned: who_can
+    type: list
+cycles:
+    description:
+        циклы в графе назначения ролей
+    returned: success
+    type: list
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_access import AccessGraph
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+
+
+def effective_privs(graph, name, expand):
+    grants = graph.effective_grants(name)
+    if expand:
+        grants = [dict(grant, access_type=privilege) for grant in grants for privilege in sorted(graph.implied(grant["access_type"]))]
+    return {"roles": sorted(graph.closure(name) - {name}), "grants": grants}
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "users": {"type": "list", "required": False},
+        "who_can": {"type": "list", "required": False},
+        "expand": {"type": "bool", "default": False},
+        "default_roles_only": {"type": "bool", "default": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    users = module.params["users"]
+    who_can = module.params["who_can"]
+    expand = module.params["expand"]
+
+    retry = retry_params(module.params)
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+        graph = AccessGraph(ch_client, module.params["default_roles_only"])
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    if users is None and not who_can:
+        users = graph.users
+    unknown = [name for name in users or [] if name not in graph.edges]
+    if unknown:
+        return module.fail_json(msg=f"Unknown users or roles: {', '.join(unknown)}")
+
+    result = {"changed": False, "cycles": graph.cycles,
+              "effective": {name: effective_privs(graph, name, expand) for name in users or []}}
+    if who_can:
+        result["who_can"] = []
+        for question in who_can:
+            answer = graph.who_can(question["privilege"], question.get("database"), question.get("table"), question.get("column"))
+            result["who_can"].append(dict(question, **answer))
+    result["msg"] = f"{len(result['effective'])} users resolved, {len(who_can or [])} who_can questions answered"
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_explain
+short_description: разбор плана выполнения запроса в clickhouse - использование индексов, проекций и параллелизм конвейера
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    db:
+        description:
+            база данных, в которой выполняется запрос
+        required: false
+        type: str
+    query:
+        description:
+            SELECT запрос, план которого разбирается
+        required: true
+        type: str
+    max_granules_pct:
+        description:
+            максимальная доля гранул в процентах, которую может прочитать запрос из каждой таблицы
+            после применения индексов. При превышении модуль завершается с ошибкой.
+        required: false
+        type: float
+    max_parts_pct:
+        description:
+            максимальная доля кусков в процентах, которую может прочитать запрос из каждой таблицы
+            после применения индексов. При превышении модуль завершается с ошибкой.
+        required: false
+        type: float
+    max_rows:
+        description:
+            максимальное количество строк, которое запрос прочитает по оценке EXPLAIN ESTIMATE
+        required: false
+        type: int
+    require_projection:
+        description:
+            завершить модуль с ошибкой, если запрос не использует ни одной проекции
+        default: false
+        type: bool
+    min_parallelism:
+        description:
+            минимальное количество параллельных потоков конвейера выполнения запроса
+        required: false
+        type: int
+'''
+
+EXAMPLES = r'''
+- name: убедиться, что отчёт по событиям использует первичный ключ и читает не больше 5% гранул
+    clickhouse_explain:
+      db: test_db
+      query: "SELECT count() FROM events WHERE user_id = 42 AND ts >= today() - 7"
+      max_granules_pct: 5
+      min_parallelism: 4
+  register: plan
+
+- name: показать гранулы, выбранные каждым индексом
+    debug:
+      var: plan.reads
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+reads:
+    description:
+        чтения из таблиц семейства MergeTree - таблица, индексы с количеством кусков и гранул до и после
+        их применения, использованные проекции, итоговые доли прочитанных кусков и гранул в процентах
+    returned: success
+    type: list
+pipeline:
+    description:
+        параллелизм конвейера (наибольшее число одинаковых процессоров) и количество процессоров каждого типа
+    returned: success
+    type: dict
+estimate:
+    description:
+        результат EXPLAIN ESTIMATE - база данных, таблица, количество кусков, строк и засечек
+    returned: success
+    type: list
+violations:
+    description:
+        нарушенные пороговые значения
+    returned: success
+    type: list
+'''
+
+import json
+import re
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+
+
+PROCESSOR = re.compile(r'^\s*([A-Za-z]\w*)(?:\s+[×x]\s+(\d+))?')
+
+
+def percent(part, whole):
+    return round(part * 100.0 / whole, 2) if whole else 0.0
+
+
+def read_nodes(plan):
+    # узлы ReadFromMergeTree на любом уровне вложенности плана
+    if plan.get("Node Type") == "ReadFromMergeTree":
+        yield plan
+    for child in plan.get("Plans", []):
+        yield from read_nodes(child)
+
+
+def parse_plan(explain):
+    reads = []
+    for root in explain:
+        for node in read_nodes(root["Plan"]):
+            indexes = [{"type": i.get("Type"), "name": i.get("Name"), "keys": i.get("Keys", []), "condition": i.get("Condition"),
+                        "initial_parts": i.get("Initial Parts", 0), "selected_parts": i.get("Selected Parts", 0),
+                        "initial_granules": i.get("Initial Granules", 0), "selected_granules": i.get("Selected Granules", 0)}
+                       for i in node.get("Indexes", [])]
+            projections = [p.get("Name") for p in node.get("Projections", [])]
+            read = {"table": node.get("Description"), "indexes": indexes, "projections": projections}
+            if indexes:
+                # индексы применяются последовательно: первый видит все куски, последний - итоговую выборку
+                read.update({"initial_parts": indexes[0]["initial_parts"], "selected_parts": indexes[-1]["selected_parts"],
+                             "initial_granules": indexes[0]["initial_granules"], "selected_granules": indexes[-1]["selected_granules"]})
+                read["parts_pct"] = percent(read["selected_parts"], read["initial_parts"])
+                read["granules_pct"] = percent(read["selected_granules"], read["initial_granules"])
+            reads.append(read)
+    return reads
+
+
+def parse_pipeline(lines):
+    processors = {}
+    for line in lines:
+        if line.strip().startswith('('):
+            continue
+        match = PROCESSOR.match(line)
+        if match:
+            processors[match.group(1)] = max(processors.get(match.group(1), 0), int(match.group(2) or 1))
+    return {"parallelism": max(processors.values()) if processors else 0, "processors": processors}
+
+
+def explain(ch_client, query):
+    plan = '\n'.join(r[0] for r in ch_client.query(f"EXPLAIN json = 1, indexes = 1, projections = 1 {query}").result_rows)
+    pipeline = [r[0] for r in ch_client.query(f"EXPLAIN PIPELINE {query}").result_rows]
+    estimate = [{"database": r[0], "table": r[1], "parts": r[2], "rows": r[3], "marks": r[4]}
+                for r in ch_client.query(f"EXPLAIN ESTIMATE {query}").result_rows]
+    return {"reads": parse_plan(json.loads(plan)), "pipeline": parse_pipeline(pipeline), "estimate": estimate}
+
+
+def check_thresholds(result, max_granules_pct, max_parts_pct, max_rows, require_projection, min_parallelism):
+    violations = []
+    for read in result["reads"]:
+        if max_granules_pct is not None and read.get("granules_pct", 0) > max_granules_pct:
+            violations.append(f"{read['table']}: {read['granules_pct']}% granules selected, limit {max_granules_pct}%")
+        if max_parts_pct is not None and read.get("parts_pct", 0) > max_parts_pct:
+            violations.append(f"{read['table']}: {read['parts_pct']}% parts selected, limit {max_parts_pct}%")
+    rows = sum(e["rows"] for e in result["estimate"])
+    if max_rows is not None and rows > max_rows:
+        violations.append(f"{rows} rows estimated, limit {max_rows}")
+    if require_projection and not any(read["projections"] for read in result["reads"]):
+        violations.append("no projection used")
+    if min_parallelism is not None and result["pipeline"]["parallelism"] < min_parallelism:
+        violations.append(f"pipeline parallelism {result['pipeline']['parallelism']}, required {min_parallelism}")
+    return violations
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "db": {"type": "str", "required": False},
+        "query": {"type": "str", "required": True},
+        "max_granules_pct": {"type": "float", "required": False},
+        "max_parts_pct": {"type": "float", "required": False},
+        "max_rows": {"type": "int", "required": False},
+        "require_projection": {"type": "bool", "default": False},
+        "min_parallelism": {"type": "int", "required": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    db = module.params["db"]
+    query = module.params["query"].strip().rstrip(';')
+
+    retry = retry_params(module.params)
+    try:
+        ch_client = get_client(username=login_user, password=login_password, database=db, port=port, host=host, retry=retry)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    try:
+        result.update(explain(ch_client, query))
+    except Exception as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: EXPLAIN {query}"}))
+
+    result["violations"] = check_thresholds(result, module.params["max_granules_pct"], module.params["max_parts_pct"],
+                                            module.params["max_rows"], module.params["require_projection"],
+                                            module.params["min_parallelism"])
+    if result["violations"]:
+        return module.fail_json(msg=f"Query plan violates {len(result['violations'])} thresholds", **result)
+    result["msg"] = f"{len(result['reads'])} table reads, pipeline parallelism {result['pipeline']['parallelism']}"
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_migrate
+short_description: применение версионированных миграций схемы в clickhouse с журналом применённых миграций
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    path:
+        description:
+            каталог с файлами миграций. Имя файла должно начинаться с номера версии, например
+            '0001.sql', '0001_create_events.sql' или 'V0001__create_events.sql', файл .sql с другим именем
+            считается ошибкой. Миграции применяются в порядке
+            возрастания версий, файл может содержать несколько запросов, разделённых ';'.
+            Каталог читается на управляемом хосте, а не на контроллере ansible, поэтому файлы миграций
+            нужно предварительно скопировать на него (например, модулем copy).
+        required: true
+        aliases: [dir]
+        type: path
+    ledger:
+        description:
+            таблица журнала применённых миграций в виде 'db_name.table_name'.
+            Создаётся автоматически, если не существует. Для миграций из нескольких запросов
+            после каждого запроса в журнал записывается прогресс, и после сбоя применение
+            продолжается со следующего невыполненного запроса.
+        default: default.schema_migrations
+        type: str
+    ledger_engine:
+        description:
+            движок таблицы журнала. При работе с кластером имеет смысл указать реплицируемый движок,
+            чтобы журнал был одинаковым на всех репликах.
+        default: MergeTree
+        type: str
+    cluster:
+        description:
+            название кластера clickhouse, на котором будет создана таблица журнала. Запросы самих миграций
+            выполняются как есть, поэтому при необходимости ON CLUSTER указывается в файлах миграций.
+        required: false
+        type: str
+    target_version:
+        description:
+            применить миграции только до указанной версии включительно. Если не задана, применяются все новые миграции.
+        required: false
+        type: int
+    on_changed:
+        description:
+            действие при обнаружении изменённого файла уже применённой миграции (контрольная сумма
+            не совпадает с журналом). 'fail' - завершить модуль с ошибкой до применения новых миграций,
+            'warn' - вывести предупреждение и продолжить.
+        default: fail
+        choices: [fail, warn]
+        type: str
+'''
+
+EXAMPLES = r'''
+- name: скопировать файлы миграций на хост clickhouse
+    copy:
+      src: "{{ playbook_dir }}/migrations/"
+      dest: /opt/clickhouse/migrations/
+
+- name: применить новые миграции из скопированного каталога
+    clickhouse_migrate:
+      path: /opt/clickhouse/migrations
+      ledger: admin.schema_migrations
+
+- name: применить миграции до версии 42, журнал реплицируется на все ноды кластера
+    clickhouse_migrate:
+      path: /opt/clickhouse/migrations
+      ledger: admin.schema_migrations
+      ledger_engine: ReplicatedMergeTree
+      cluster: my_cluster
+      target_version: 42
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+applied:
+    description:
+        применённые за этот запуск миграции - версия, имя файла, количество запросов и время применения в миллисекундах
+    returned: success
+    type: list
+changed_files:
+    description:
+        уже применённые миграции, файлы которых были изменены после применения
+    returned: success
+    type: list
+partial:
+    description:
+        миграция, применение которой прервалось - версия, имя файла, количество выполненных запросов
+        и общее количество запросов
+    returned: failure
+    type: dict
+'''
+
+import hashlib
+import os
+import re
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+
+
+MIGRATION_FILE = re.compile(r'^V?(\d+)(?:[_\-.].*)?\.sql$', re.IGNORECASE)
+
+
+class MigrationError(Exception):
+
+    def __init__(self, error, partial):
+        super(MigrationError, self).__init__(str(error))
+        self.partial = partial
+
+
+def read_migrations(path):
+    migrations = []
+    for file_name in os.listdir(path):
+        if not file_name.lower().endswith('.sql'):
+            continue
+        match = MIGRATION_FILE.match(file_name)
+        if not match:
+            raise Exception(f"Migration file '{file_name}' has no version prefix")
+        with open(os.path.join(path, file_name), 'rb') as f:
+            body = f.read()
+        migrations.append({
+            "version": int(match.group(1)),
+            "name": file_name,
+            "checksum": hashlib.sha256(body).hexdigest(),
+            "sql": body.decode('utf-8'),
+        })
+    migrations.sort(key=lambda m: m["version"])
+    for prev, cur in zip(migrations, migrations[1:]):
+        if prev["version"] == cur["version"]:
+            raise Exception(f"Duplicate migration version {cur['version']}: '{prev['name']}', '{cur['name']}'")
+    return migrations
+
+
+def split_statements(sql):
+    # разбиение файла на запросы по ';' без учёта ';' внутри строк, идентификаторов и комментариев
+    statements = []
+    current = []
+    i = 0
+    quote = None
+    while i < len(sql):
+        ch = sql[i]
+        if quote:
+            current.append(ch)
+            if ch == '\\':
+                current.append(sql[i + 1:i + 2])
+                i += 2
+                continue
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"', '`'):
+            quote = ch
+            current.append(ch)
+        elif sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = len(sql) if end == -1 else end
+            continue
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            i = len(sql) if end == -1 else end + 2
+            continue
+        elif ch == ';':
+            statements.append(''.join(current))
+            current = []
+        else:
+            current.append(ch)
+        i += 1
+    statements.append(''.join(current))
+    return [s.strip() for s in statements if s.strip()]
+
+
+def create_ledger(ch_client, ledger, ledger_engine, cluster):
+    query_fragments = [f"CREATE TABLE IF NOT EXISTS {ledger}"]
+    if cluster:
+        query_fragments.append(f"ON CLUSTER {cluster}")
+    query_fragments.append("(version UInt64, name String, checksum String, "
+                           "applied_at DateTime DEFAULT now(), duration_ms UInt64, "
+                           "statements_applied UInt32 DEFAULT 0, finished UInt8 DEFAULT 1)")
+    query_fragments.append(f"ENGINE = {ledger_engine} ORDER BY version")
+    ch_client.command(' '.join(query_fragments))
+    # журналы, созданные до появления записи прогресса, дополняются столбцами; старые записи считаются завершёнными
+    database, table = ledger.split('.', 1) if '.' in ledger else (None, ledger)
+    database = f"'{database}'" if database else "currentDatabase()"
+    columns = {row[0] for row in ch_client.query(
+        f"SELECT name FROM system.columns WHERE database = {database} AND table = '{table}'").result_rows}
+    if "finished" not in columns:
+        query = f"ALTER TABLE {ledger}"
+        if cluster:
+            query += f" ON CLUSTER {cluster}"
+        ch_client.command(query + " ADD COLUMN IF NOT EXISTS statements_applied UInt32 DEFAULT 0, "
+                                  "ADD COLUMN IF NOT EXISTS finished UInt8 DEFAULT 1")
+
+
+def read_ledger(ch_client, ledger):
+    # завершённые миграции и прогресс прерванных: для каждой версии - наибольшее число выполненных запросов
+    applied = {}
+    progress = {}
+    rows = ch_client.query(
+        f"SELECT version, name, checksum, finished, statements_applied FROM {ledger} ORDER BY version").result_rows
+    for version, name, checksum, finished, statements_applied in rows:
+        if finished:
+            applied[version] = {"name": name, "checksum": checksum}
+        elif statements_applied > progress.get(version, {}).get("statements_applied", 0):
+            progress[version] = {"name": name, "checksum": checksum, "statements_applied": statements_applied}
+    return applied, {v: p for v, p in progress.items() if v not in applied}
+
+
+def record(ch_client, ledger, migration, duration_ms, statements_applied, finished):
+    name = migration["name"].replace("'", "\\'")
+    ch_client.command(f"INSERT INTO {ledger} (version, name, checksum, duration_ms, statements_applied, finished) "
+                      f"VALUES ({migration['version']}, '{name}', '{migration['checksum']}', {duration_ms}, "
+                      f"{statements_applied}, {int(finished)})")
+
+
+def apply_migration(ch_client, ledger, migration, done):
+    # done - число запросов, выполненных при прошлом запуске; после каждого запроса многозапросной
+    # миграции записывается прогресс, чтобы после сбоя не выполнять уже выполненные запросы повторно
+    statements = split_statements(migration["sql"])
+    started = time.monotonic()
+    for n, statement in enumerate(statements[done:], done + 1):
+        try:
+            ch_client.command(statement, idempotent=False)
+        except Exception as e:
+            raise MigrationError(e, {"version": migration["version"], "name": migration["name"],
+                                     "statements_applied": n - 1, "statements": len(statements)})
+        if n < len(statements):
+            record(ch_client, ledger, migration, int((time.monotonic() - started) * 1000), n, False)
+    duration_ms = int((time.monotonic() - started) * 1000)
+    record(ch_client, ledger, migration, duration_ms, len(statements), True)
+    return {"version": migration["version"], "name": migration["name"],
+            "statements": len(statements), "duration_ms": duration_ms}
+
+
+def migrate(ch_client, module, path, ledger, ledger_engine, cluster, target_version, on_changed):
+    try:
+        migrations = read_migrations(path)
+    except Exception as e:
+        return module.fail_json(msg=to_native(e))
+
+    create_ledger(ch_client, ledger, ledger_engine, cluster)
+    applied_versions, progress = read_ledger(ch_client, ledger)
+
+    changed_files = [m["name"] for m in migrations
+                     if m["version"] in applied_versions and applied_versions[m["version"]]["checksum"] != m["checksum"]]
+    if changed_files:
+        if on_changed == 'fail':
+            return module.fail_json(msg=f"Applied migrations were modified: {', '.join(changed_files)}",
+                                    changed=False, changed_files=changed_files)
+        module.warn(f"Applied migrations were modified: {', '.join(changed_files)}")
+
+    pending = [m for m in migrations if m["version"] not in applied_versions
+               and (target_version is None or m["version"] <= target_version)]
+    applied = []
+    for migration in pending:
+        done = progress.get(migration["version"], {}).get("statements_applied", 0)
+        if done and progress[migration["version"]]["checksum"] != migration["checksum"]:
+            # продолжать частично применённую миграцию по изменённому файлу небезопасно
+            return module.fail_json(msg=f"Partially applied migration was modified: {migration['name']}, "
+                                        f"{done} statements already applied",
+                                    changed=bool(applied), applied=applied, changed_files=changed_files)
+        try:
+            applied.append(apply_migration(ch_client, ledger, migration, done))
+        except MigrationError as e:
+            return module.fail_json(msg=f"{to_native(e)}: Error on migration: {migration['name']}",
+                                    changed=bool(applied) or e.partial["statements_applied"] > done,
+                                    applied=applied, changed_files=changed_files, partial=e.partial)
+        except Exception as e:
+            return module.fail_json(msg=f"{to_native(e)}: Error on migration: {migration['name']}",
+                                    changed=True, applied=applied, changed_files=changed_files)
+    if not applied:
+        return {"changed": False, "msg": "No new migrations", "applied": [], "changed_files": changed_files}
+    return {"changed": True, "msg": f"Applied {len(applied)} migrations, current version {applied[-1]['version']}",
+            "applied": applied, "changed_files": changed_files}
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "path": {"type": "path", "required": True, "aliases": ["dir"]},
+        "ledger": {"type": "str", "default": "default.schema_migrations"},
+        "ledger_engine": {"type": "str", "default": "MergeTree"},
+        "cluster": {"type": "str", "required": False},
+        "target_version": {"type": "int", "required": False},
+        "on_changed": {"type": "str", "default": "fail", "choices": ["fail", "warn"]}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    path = module.params["path"]
+    ledger = module.params["ledger"]
+    ledger_engine = module.params["ledger_engine"]
+    cluster = module.params["cluster"]
+    target_version = module.params["target_version"]
+    on_changed = module.params["on_changed"]
+
+    retry = retry_params(module.params)
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    result = migrate(ch_client, module, path, ledger, ledger_engine, cluster, target_version, on_changed)
+    result.update(ch_client.ddl_queue_report())
+
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
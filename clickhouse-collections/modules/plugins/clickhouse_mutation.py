@@ -0,0 +1,338 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_mutation
+short_description: запуск мутаций ALTER TABLE ... UPDATE/DELETE в clickhouse с ограничением числа одновременных мутаций
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    table:
+        description:
+            таблица в виде 'db_name.table_name', для которой выполняются мутации
+        required: true
+        type: str
+    mutations:
+        description:
+            список мутаций без префикса 'ALTER TABLE', например "UPDATE status = 0 WHERE id < 100"
+            или "DELETE WHERE event_date < '2020-01-01'". Мутации запускаются по очереди, каждая
+            следующая - только когда число выполняющихся мутаций опустится ниже заданных ограничений.
+        required: false
+        type: list
+    mutation_ids:
+        description:
+            идентификаторы ранее запущенных мутаций таблицы, завершения которых нужно дождаться.
+            Используется для ожидания мутаций, запущенных с wait = false.
+        required: false
+        type: list
+    cluster:
+        description:
+            название кластера clickhouse, на котором будут выполнены мутации. Если не указан,
+            то мутации будут выполнены только на целевой ноде, указанной при запуске ansible-playbook.
+            Также используется для подсчёта выполняющихся мутаций на всех репликах кластера.
+        required: false
+        type: str
+    max_running_per_table:
+        description:
+            максимальное число одновременно выполняющихся мутаций таблицы
+        default: 1
+        type: int
+    max_running_per_cluster:
+        description:
+            максимальное число одновременно выполняющихся мутаций всех таблиц на всех репликах кластера.
+            Используется только совместно с параметром cluster.
+        required: false
+        type: int
+    wait:
+        description:
+            дождаться завершения запущенных мутаций. Если установлено в false, то модуль завершается
+            сразу после запуска последней мутации и возвращает их идентификаторы.
+        default: true
+        type: bool
+    timeout:
+        description:
+            максимальное время в секундах ожидания свободного места под мутацию и завершения мутаций
+        default: 3600
+        type: int
+    poll_interval:
+        description:
+            начальный интервал опроса system.mutations в секундах. При каждом опросе без изменений
+            интервал увеличивается вдвое, но не больше poll_max_interval.
+        default: 1
+        type: float
+    poll_max_interval:
+        description:
+            максимальный интервал опроса system.mutations в секундах
+        default: 30
+        type: float
+'''
+
+EXAMPLES = r'''
+- name: запустить две мутации, не более одной одновременно на таблицу и трёх на кластер
+    clickhouse_mutation:
+      table: test_db.events
+      mutations:
+        - "UPDATE status = 0 WHERE status IS NULL"
+        - "DELETE WHERE event_date < '2020-01-01'"
+      cluster: my_cluster
+      max_running_per_cluster: 3
+
+- name: запустить мутацию без ожидания завершения
+    clickhouse_mutation:
+      table: test_db.events
+      mutations:
+        - "DELETE WHERE user_id = 42"
+      wait: false
+  register: submitted
+
+- name: дождаться завершения ранее запущенной мутации
+    clickhouse_mutation:
+      table: test_db.events
+      mutation_ids: "{{ submitted.mutations | map(attribute='mutation_id') | list }}"
+      timeout: 7200
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+mutations:
+    description:
+        состояние каждой мутации - mutation_id, command, is_done, parts_to_do, latest_fail_reason
+        и age - возраст мутации в секундах (от create_time до последнего опроса). system.mutations не хранит
+        время завершения, поэтому для мутации, завершившейся во время ожидания, age превышает время её
+        выполнения не больше чем на интервал опроса
+    returned: success
+    type: list
+'''
+
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+
+
+class Backoff:
+    def __init__(self, interval, max_interval, timeout):
+        self.start_interval = interval
+        self.interval = interval
+        self.max_interval = max_interval
+        self.deadline = time.monotonic() + timeout
+
+    def reset(self):
+        self.interval = self.start_interval
+
+    def sleep(self):
+        if time.monotonic() + self.interval > self.deadline:
+            return False
+        time.sleep(self.interval)
+        self.interval = min(self.interval * 2, self.max_interval)
+        return True
+
+
+def split_table(table):
+    if '.' not in table:
+        raise Exception(f"Table '{table}' must be set as 'db_name.table_name'")
+    return table.split('.', 1)
+
+
+def running_mutations(ch_client, database, table, cluster):
+    per_table = ch_client.command(
+        f"SELECT count() FROM system.mutations WHERE database = '{database}' AND table = '{table}' AND NOT is_done")
+    per_cluster = None
+    if cluster:
+        per_cluster = ch_client.command(
+            f"SELECT count() FROM clusterAllReplicas('{cluster}', system.mutations) WHERE NOT is_done")
+    return per_table, per_cluster
+
+
+def wait_for_slot(ch_client, database, table, cluster, max_per_table, max_per_cluster, backoff):
+    backoff.reset()
+    while True:
+        per_table, per_cluster = running_mutations(ch_client, database, table, cluster)
+        if per_table < max_per_table and (per_cluster is None or max_per_cluster is None or per_cluster < max_per_cluster):
+            return
+        if not backoff.sleep():
+            raise Exception(f"Timeout waiting for running mutations to finish: {per_table} on table, {per_cluster} on cluster")
+
+
+def mutation_ids(ch_client, database, table):
+    return {row[0] for row in ch_client.query(
+        f"SELECT mutation_id FROM system.mutations WHERE database = '{database}' AND table = '{table}'").result_rows}
+
+
+def submit_mutation(ch_client, database, table, cluster, command, backoff):
+    known = mutation_ids(ch_client, database, table)
+    query_fragments = [f"ALTER TABLE {database}.{table}"]
+    if cluster:
+        query_fragments.append(f"ON CLUSTER {cluster}")
+    query_fragments.append(command)
+    query = ' '.join(query_fragments)
+    ch_client.command(query, settings={"mutations_sync": 0}, idempotent=False)
+    # при ON CLUSTER мутация появляется в system.mutations после обработки задачи DDL на ноде
+    backoff.reset()
+    while True:
+        new_ids = mutation_ids(ch_client, database, table) - known
+        if new_ids:
+            return sorted(new_ids)
+        if not backoff.sleep():
+            raise Exception(f"Mutation is not found in system.mutations after query: {query}")
+
+
+def mutations_state(ch_client, database, table, ids):
+    id_list = ', '.join(f"'{mutation_id}'" for mutation_id in ids)
+    rows = ch_client.query(
+        "SELECT mutation_id, command, is_done, parts_to_do, latest_fail_reason, dateDiff('second', create_time, now()) "
+        f"FROM system.mutations WHERE database = '{database}' AND table = '{table}' AND mutation_id IN ({id_list})").result_rows
+    return {row[0]: {"mutation_id": row[0], "command": row[1], "is_done": bool(row[2]), "parts_to_do": row[3],
+                     "latest_fail_reason": row[4], "age": row[5]} for row in rows}
+
+
+def wait_mutations(ch_client, database, table, ids, backoff):
+    backoff.reset()
+    finished = {}
+    while True:
+        state = mutations_state(ch_client, database, table, [i for i in ids if i not in finished])
+        progress = False
+        for mutation_id, mutation in state.items():
+            # мутация с ошибкой будет повторяться сервером бесконечно, поэтому ожидание прекращается
+            if mutation["is_done"] or mutation["latest_fail_reason"]:
+                finished[mutation_id] = mutation
+                progress = True
+        for mutation_id in ids:
+            if mutation_id not in finished and mutation_id not in state:
+                raise Exception(f"Mutation '{mutation_id}' is not found in system.mutations")
+        if len(finished) == len(ids):
+            return [finished[i] for i in ids]
+        if progress:
+            backoff.reset()
+        if not backoff.sleep():
+            return [finished.get(i) or state[i] for i in ids]
+
+
+def run_mutations(ch_client, module, table, mutations, ids, cluster, max_per_table, max_per_cluster, wait, backoff):
+    database, table = split_table(table)
+    submitted = list(ids or [])
+    changed = False
+    for command in mutations or []:
+        try:
+            wait_for_slot(ch_client, database, table, cluster, max_per_table, max_per_cluster, backoff)
+            submitted += submit_mutation(ch_client, database, table, cluster, command, backoff)
+            changed = True
+        except Exception as e:
+            return module.fail_json(msg=f"{to_native(e)}: Error on mutation: {command}", changed=changed,
+                                    mutations=list(mutations_state(ch_client, database, table, submitted).values()) if submitted else [])
+    if not submitted:
+        return {"changed": False, "msg": "No mutations to run", "mutations": []}
+    if not wait:
+        state = mutations_state(ch_client, database, table, submitted)
+        return {"changed": changed, "msg": f"Submitted {len(submitted)} mutations", "mutations": [state[i] for i in submitted if i in state]}
+
+    result = wait_mutations(ch_client, database, table, submitted, backoff)
+    failed = [m for m in result if m["latest_fail_reason"]]
+    unfinished = [m for m in result if not m["is_done"] and not m["latest_fail_reason"]]
+    if failed:
+        return module.fail_json(msg=f"Mutations failed: {', '.join(m['mutation_id'] for m in failed)}", changed=changed, mutations=result)
+    if unfinished:
+        return module.fail_json(msg=f"Timeout waiting for mutations: {', '.join(m['mutation_id'] for m in unfinished)}", changed=changed, mutations=result)
+    return {"changed": changed, "msg": f"{len(result)} mutations done", "mutations": result}
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "table": {"type": "str", "required": True},
+        "mutations": {"type": "list", "required": False},
+        "mutation_ids": {"type": "list", "required": False},
+        "cluster": {"type": "str", "required": False},
+        "max_running_per_table": {"type": "int", "default": 1},
+        "max_running_per_cluster": {"type": "int", "required": False},
+        "wait": {"type": "bool", "default": True},
+        "timeout": {"type": "int", "default": 3600},
+        "poll_interval": {"type": "float", "default": 1},
+        "poll_max_interval": {"type": "float", "default": 30}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        required_one_of=[["mutations", "mutation_ids"]],
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    table = module.params["table"]
+    mutations = module.params["mutations"]
+    ids = module.params["mutation_ids"]
+    cluster = module.params["cluster"]
+    max_per_table = module.params["max_running_per_table"]
+    max_per_cluster = module.params["max_running_per_cluster"]
+    wait = module.params["wait"]
+    backoff = Backoff(module.params["poll_interval"], module.params["poll_max_interval"], module.params["timeout"])
+
+    retry = retry_params(module.params)
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    try:
+        result = run_mutations(ch_client, module, table, mutations, ids, cluster, max_per_table, max_per_cluster, wait, backoff)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    result.update(ch_client.ddl_queue_report())
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_parts
+short_description: анализ активных кусков таблиц в clickhouse и запуск OPTIMIZE для партиций с избытком кусков
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    database:
+        description:
+            анализировать только таблицы указанной базы данных
+        required: false
+        aliases: [db]
+        type: str
+    tables:
+        description:
+            анализировать только указанные таблицы
+        required: false
+        type: list
+    cluster:
+        description:
+            название кластера clickhouse, на всех репликах которого будут проанализированы куски.
+            Если не указан, то анализ выполняется только на целевой ноде, указанной при запуске ansible-playbook.
+        required: false
+        type: str
+    threshold:
+        description:
+            количество активных кусков в партиции, начиная с которого партиция считается кандидатом на OPTIMIZE
+        default: 100
+        type: int
+    top:
+        description:
+            количество партиций с наибольшим числом активных кусков, возвращаемых в hot_spots
+        default: 20
+        type: int
+    optimize:
+        description:
+            запустить OPTIMIZE TABLE ... PARTITION ID для партиций, число кусков в которых превышает threshold
+        default: false
+        type: bool
+    final:
+        description:
+            запускать OPTIMIZE с FINAL, объединяя все куски партиции в один
+        default: false
+        type: bool
+    max_optimize:
+        description:
+            максимальное количество партиций, для которых запускается OPTIMIZE за один запуск модуля
+        default: 50
+        type: int
+    max_concurrency:
+        description:
+            максимальное количество одновременно выполняемых OPTIMIZE на всех репликах
+        default: 2
+        type: int
+    max_per_replica:
+        description:
+            максимальное количество одновременно выполняемых OPTIMIZE на одной реплике
+        default: 1
+        type: int
+    busy_windows:
+        description:
+            интервалы времени в формате 'HH:MM-HH:MM' (локальное время хоста, на котором выполняется модуль),
+            в которые OPTIMIZE не запускается. Интервал может переходить через полночь, например '22:00-02:00'.
+        required: false
+        type: list
+'''
+
+EXAMPLES = r'''
+- name: получить 10 партиций с наибольшим числом кусков на всех репликах кластера
+    clickhouse_parts:
+      cluster: my_cluster
+      top: 10
+  register: parts
+
+- name: запустить OPTIMIZE для партиций таблицы events, где более 300 кусков, не в часы пиковой нагрузки
+    clickhouse_parts:
+      database: test_db
+      tables:
+        - events
+      cluster: my_cluster
+      threshold: 300
+      optimize: true
+      max_concurrency: 3
+      busy_windows:
+        - '09:00-13:00'
+        - '18:00-21:00'
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+hot_spots:
+    description:
+        партиции с наибольшим числом активных кусков - хост, база данных, таблица, партиция,
+        количество кусков, размер на диске, количество строк и максимальный уровень слияния
+    returned: success
+    type: list
+optimized:
+    description:
+        партиции, для которых был запущен OPTIMIZE, с временем выполнения в секундах или ошибкой
+    returned: optimize
+    type: list
+'''
+
+import re
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import get_replicas, on_replicas, run_bounded
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+
+
+BUSY_WINDOW = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)-([01]?\d|2[0-3]):([0-5]\d)$")
+
+
+def parse_busy_windows(busy_windows):
+    # интервалы 'HH:MM-HH:MM' в минутах от начала суток, None - если формат неверный
+    parsed = []
+    for window in busy_windows or []:
+        match = BUSY_WINDOW.match(str(window).replace(' ', ''))
+        if not match:
+            return None
+        hours_start, minutes_start, hours_end, minutes_end = [int(g) for g in match.groups()]
+        parsed.append((hours_start * 60 + minutes_start, hours_end * 60 + minutes_end))
+    return parsed
+
+
+def in_busy_window(busy_windows):
+    now = time.localtime()
+    minutes = now.tm_hour * 60 + now.tm_min
+    for start, end in busy_windows or []:
+        if start <= end and start <= minutes < end:
+            return True
+        if start > end and (minutes >= start or minutes < end):
+            return True
+    return False
+
+
+def partitions_query(database, tables, limit):
+    filters = ["p.active"]
+    if database:
+        filters.append(f"p.database = '{database}'")
+    if tables:
+        filters.append("p.table IN (" + ", ".join(f"'{t}'" for t in tables) + ")")
+    return (
+        "SELECT p.database, p.table, p.partition_id, any(p.partition), count() AS parts, "
+        "sum(p.bytes_on_disk), sum(p.rows), max(p.level), any(t.engine) "
+        "FROM system.parts AS p LEFT JOIN system.tables AS t ON p.database = t.database AND p.table = t.name "
+        f"WHERE {' AND '.join(filters)} "
+        f"GROUP BY p.database, p.table, p.partition_id ORDER BY parts DESC LIMIT {limit}")
+
+
+def collect_partitions(replicas, conn, database, tables, limit):
+    query = partitions_query(database, tables, limit)
+
+    def collect(ch_client, replica):
+        rows = ch_client.query(query).result_rows
+        return {"partitions": [{"database": r[0], "table": r[1], "partition_id": r[2], "partition": r[3],
+                                "parts": r[4], "bytes": r[5], "rows": r[6], "max_level": r[7], "engine": r[8]}
+                               for r in rows]}
+
+    collected = on_replicas(replicas, collect, conn)
+    errors = [{"host": r["host"], "error": r["error"]} for r in collected if r.get("error")]
+    partitions = []
+    for replica in collected:
+        for partition in replica.get("partitions", []):
+            partitions.append(dict(partition, host=replica["host"], shard_num=replica["shard_num"]))
+    partitions.sort(key=lambda p: p["parts"], reverse=True)
+    return partitions, errors
+
+
+def optimize_candidates(partitions, threshold, max_optimize):
+    # для реплицируемых таблиц слияние, назначенное на одной реплике, выполняется на всех репликах шарда,
+    # поэтому партиция оптимизируется один раз на шард - на реплике с наибольшим числом кусков
+    candidates = []
+    seen = set()
+    for partition in partitions:
+        if partition["parts"] < threshold:
+            break
+        key = (partition["database"], partition["table"], partition["partition_id"])
+        key += (partition["shard_num"],) if (partition["engine"] or '').startswith('Replicated') else (partition["host"],)
+        if key in seen:
+            continue
+        seen.add(key)
+        candidates.append(partition)
+        if len(candidates) >= max_optimize:
+            break
+    return candidates
+
+
+def optimize_partitions(candidates, conn, final, max_concurrency, max_per_replica, busy_windows):
+    def optimize(ch_client, partition):
+        if in_busy_window(busy_windows):
+            return {"skipped": "busy window"}
+        query = f"OPTIMIZE TABLE {partition['database']}.{partition['table']} PARTITION ID '{partition['partition_id']}'"
+        if final:
+            query += " FINAL"
+        started = time.monotonic()
+        ch_client.command(query)
+        return {"duration": round(time.monotonic() - started, 3)}
+
+    return run_bounded(candidates, optimize, conn, max_concurrency, max_per_replica)
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "database": {"type": "str", "required": False, "aliases": ["db"]},
+        "tables": {"type": "list", "required": False},
+        "cluster": {"type": "str", "required": False},
+        "threshold": {"type": "int", "default": 100},
+        "top": {"type": "int", "default": 20},
+        "optimize": {"type": "bool", "default": False},
+        "final": {"type": "bool", "default": False},
+        "max_optimize": {"type": "int", "default": 50},
+        "max_concurrency": {"type": "int", "default": 2},
+        "max_per_replica": {"type": "int", "default": 1},
+        "busy_windows": {"type": "list", "required": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    database = module.params["database"]
+    tables = module.params["tables"]
+    cluster = module.params["cluster"]
+    threshold = module.params["threshold"]
+    top = module.params["top"]
+    optimize = module.params["optimize"]
+    final = module.params["final"]
+    max_optimize = module.params["max_optimize"]
+    max_concurrency = module.params["max_concurrency"]
+    max_per_replica = module.params["max_per_replica"]
+    busy_windows = parse_busy_windows(module.params["busy_windows"])
+    if busy_windows is None:
+        return module.fail_json(msg=f"busy_windows must be set as 'HH:MM-HH:MM': {module.params['busy_windows']}")
+    retry = retry_params(module.params)
+    conn = {"username": login_user, "password": login_password, "port": port, "retry": retry}
+
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+        if cluster:
+            replicas = get_replicas(ch_client, cluster)
+        else:
+            replicas = [{"shard_num": None, "replica_num": None, "host": host or "localhost", "is_local": True}]
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    partitions, errors = collect_partitions(replicas, conn, database, tables, max(top, max_optimize))
+    if errors:
+        return module.fail_json(msg="Error on collecting system.parts", errors=errors)
+    result = {"changed": False, "hot_spots": partitions[:top]}
+
+    candidates = optimize_candidates(partitions, threshold, max_optimize)
+    if not optimize or not candidates:
+        result["msg"] = f"{len(candidates)} partitions over {threshold} active parts"
+    elif in_busy_window(busy_windows):
+        result["msg"] = f"{len(candidates)} partitions over {threshold} active parts, OPTIMIZE skipped in busy window"
+    else:
+        optimized = optimize_partitions(candidates, conn, final, max_concurrency, max_per_replica, busy_windows)
+        result["optimized"] = optimized
+        result["changed"] = any("duration" in p for p in optimized)
+        failed = [p for p in optimized if p.get("error")]
+        if failed:
+            return module.fail_json(msg=f"OPTIMIZE failed for {len(failed)} partitions", **result)
+        result["msg"] = f"OPTIMIZE run for {sum(1 for p in optimized if 'duration' in p)} partitions"
+
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
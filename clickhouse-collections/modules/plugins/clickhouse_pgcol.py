@@ -7,6 +7,7 @@ DOCUMENTATION = r'''
 ---
 module: clickhouse_pgcol
 short_description: создание коллекций кред named_collections в clickhouse для подключения к внешним базам данных postgresql
+extends_documentation_fragment: ch.modules.clickhouse_retry
 options:
     login_user:
         description:
@@ -121,11 +122,16 @@ msg:
         короткое сообщение, указывающее по произошедшие изменеия
     returned: success
     type: str
+ddl_queue:
+    description:
+        глубина очереди распределённого DDL кластера и суммарное время ожидания её освобождения в секундах
+    returned: ddl_queue_high_water
+    type: dict
 '''
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_native
-from clickhouse_connect import get_client
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
 
 
 def is_collection_exist(ch_client, collection):
@@ -185,6 +191,8 @@ def main():
         "pg_schema": {"type": "str", "required": False}
     }
 
+    module_args.update(retry_argument_spec())
+
     result = {
         "changed": False
     }
@@ -212,8 +220,9 @@ def main():
     pg_db = module.params["pg_db"]
     pg_schema = module.params["pg_schema"]
 
+    retry = retry_params(module.params)
     try:
-        ch_client = get_client(username=login_user, password=login_password, port=port, host=host)
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
     except Exception as e:
         return module.fail_json(to_native(e))
 
@@ -227,6 +236,7 @@ def main():
     else:
         raise Exception(f"Named collection state '{state}' unknown!")
 
+    result.update(ch_client.ddl_queue_report())
     module.exit_json(**result)
 
 
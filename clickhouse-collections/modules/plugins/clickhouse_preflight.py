@@ -0,0 +1,275 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_preflight
+short_description: проверка готовности кластера clickhouse к выполнению DDL - реплики, очередь DDL, keeper, слияния и диски
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    cluster:
+        description:
+            название кластера clickhouse, все реплики которого проверяются параллельно. Если не указан,
+            то проверяется только целевая нода, указанная при запуске ansible-playbook.
+        required: false
+        type: str
+    allow_readonly:
+        description:
+            не считать ошибкой реплицируемые таблицы в режиме только для чтения
+        default: false
+        type: bool
+    max_replica_delay:
+        description:
+            максимальное отставание реплицируемых таблиц (absolute_delay) в секундах
+        default: 300
+        type: int
+    max_replication_queue:
+        description:
+            максимальный размер очереди репликации (queue_size) одной таблицы
+        default: 100
+        type: int
+    max_ddl_queue:
+        description:
+            максимальное количество невыполненных задач в очереди распределённого DDL кластера.
+            Если cluster не указан, то учитываются только задачи, которые должна выполнить целевая нода.
+        default: 20
+        type: int
+    max_merges:
+        description:
+            максимальное количество одновременно выполняющихся слияний на реплике. По умолчанию не проверяется.
+        required: false
+        type: int
+    min_free_disk_pct:
+        description:
+            минимальная доля свободного места в процентах на каждом диске реплики.
+            Диски без известного размера (total_space = 0, например s3) не проверяются.
+        default: 10
+        type: float
+    check_keeper:
+        description:
+            проверять доступность ZooKeeper/Keeper с каждой реплики. На репликах без реплицируемых таблиц
+            или без подключения к keeper (пустая system.zookeeper_connection) проверка пропускается
+            со значением keeper = 'skipped'.
+        default: true
+        type: bool
+    fail:
+        description:
+            завершить модуль с ошибкой, если кластер не прошёл проверку
+        default: true
+        type: bool
+'''
+
+EXAMPLES = r'''
+- name: проверить кластер перед изменением схемы
+    clickhouse_preflight:
+      cluster: my_cluster
+      max_replica_delay: 60
+      max_ddl_queue: 5
+      retry_max_attempts: 1
+
+- name: получить состояние кластера без остановки плейбука
+    clickhouse_preflight:
+      cluster: my_cluster
+      fail: false
+  register: health
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+healthy:
+    description:
+        итог проверки - true, если все реплики прошли все проверки
+    returned: always
+    type: bool
+failures:
+    description:
+        непройденные проверки в виде 'хост: описание'
+    returned: always
+    type: list
+replicas:
+    description:
+        показатели каждой реплики - таблицы только для чтения, отставание, очередь репликации, сессии keeper,
+        слияния и наименьшая доля свободного места на дисках
+    returned: always
+    type: list
+ddl_queue_depth:
+    description:
+        количество невыполненных задач в очереди распределённого DDL кластера или, без cluster, целевой ноды
+    returned: always
+    type: int
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import get_replicas, on_replicas
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+
+
+def replica_health(ch_client, check_keeper):
+    readonly, delay, queue, expired, tables = ch_client.query(
+        "SELECT countIf(is_readonly), max(absolute_delay), max(queue_size), countIf(is_session_expired), count() "
+        "FROM system.replicas").result_rows[0]
+    merges, merge_elapsed = ch_client.query("SELECT count(), max(elapsed) FROM system.merges").result_rows[0]
+    # у дисков без ограничения размера (например, s3) total_space равен 0, они не проверяются
+    disks = ch_client.query(
+        "SELECT name, round(free_space * 100 / total_space, 2) AS pct FROM system.disks "
+        "WHERE total_space > 0 ORDER BY pct LIMIT 1").result_rows
+    disk, free_pct = disks[0] if disks else (None, None)
+    health = {"replicated_tables": tables, "readonly_tables": readonly, "max_delay": delay, "max_queue_size": queue,
+              "expired_sessions": expired, "merges": merges, "max_merge_elapsed": round(merge_elapsed, 3),
+              "worst_disk": disk, "min_free_disk_pct": free_pct}
+    if check_keeper:
+        health["keeper"] = keeper_state(ch_client, tables)
+    return health
+
+
+def keeper_state(ch_client, replicated_tables):
+    # на ноде без реплицируемых таблиц или без подключения к keeper запрос к system.zookeeper завершается ошибкой,
+    # а потерю keeper реплицируемыми таблицами и так показывают readonly_tables и expired_sessions
+    if not replicated_tables:
+        return "skipped"
+    try:
+        if not ch_client.command("SELECT count() FROM system.zookeeper_connection"):
+            return "skipped"
+    except Exception:
+        # system.zookeeper_connection нет в старых версиях
+        pass
+    try:
+        ch_client.command("SELECT count() FROM system.zookeeper WHERE path = '/'")
+        return "ok"
+    except Exception as e:
+        return str(e).splitlines()[0]
+
+
+def replica_failures(replica, params):
+    if replica.get("error"):
+        return [f"unreachable: {replica['error'].splitlines()[0]}"]
+    failures = []
+    if replica["readonly_tables"] and not params["allow_readonly"]:
+        failures.append(f"{replica['readonly_tables']} readonly replicated tables")
+    if replica["expired_sessions"]:
+        failures.append(f"{replica['expired_sessions']} tables with expired keeper session")
+    if replica["max_delay"] > params["max_replica_delay"]:
+        failures.append(f"replica delay {replica['max_delay']}s > {params['max_replica_delay']}s")
+    if replica["max_queue_size"] > params["max_replication_queue"]:
+        failures.append(f"replication queue {replica['max_queue_size']} > {params['max_replication_queue']}")
+    if params["max_merges"] is not None and replica["merges"] > params["max_merges"]:
+        failures.append(f"{replica['merges']} merges > {params['max_merges']}")
+    if replica["min_free_disk_pct"] is not None and replica["min_free_disk_pct"] < params["min_free_disk_pct"]:
+        failures.append(f"disk {replica['worst_disk']} {replica['min_free_disk_pct']}% free < {params['min_free_disk_pct']}%")
+    if params["check_keeper"] and replica["keeper"] not in ("ok", "skipped"):
+        failures.append(f"keeper unavailable: {replica['keeper']}")
+    return failures
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "cluster": {"type": "str", "required": False},
+        "allow_readonly": {"type": "bool", "default": False},
+        "max_replica_delay": {"type": "int", "default": 300},
+        "max_replication_queue": {"type": "int", "default": 100},
+        "max_ddl_queue": {"type": "int", "default": 20},
+        "max_merges": {"type": "int", "required": False},
+        "min_free_disk_pct": {"type": "float", "default": 10},
+        "check_keeper": {"type": "bool", "default": True},
+        "fail": {"type": "bool", "default": True}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    cluster = module.params["cluster"]
+    check_keeper = module.params["check_keeper"]
+    retry = retry_params(module.params)
+    conn = {"username": login_user, "password": login_password, "port": port, "retry": retry}
+
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+        if cluster:
+            replicas = get_replicas(ch_client, cluster)
+            ddl_queue_depth = ch_client.ddl_queue_depth(cluster)
+        else:
+            replicas = [{"shard_num": None, "replica_num": None, "host": host or "localhost", "is_local": True}]
+            # без кластера учитываются только задачи, которые должна выполнить целевая нода
+            ddl_queue_depth = ch_client.command(
+                "SELECT uniqExact(entry) FROM system.distributed_ddl_queue "
+                "WHERE host IN (SELECT host_name FROM system.clusters WHERE is_local) "
+                "AND coalesce(toString(status), 'Inactive') NOT IN ('Finished', 'Removing')")
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    checked = on_replicas(replicas, lambda client, replica: replica_health(client, check_keeper), conn)
+    failures = []
+    if ddl_queue_depth > module.params["max_ddl_queue"]:
+        failures.append(f"{cluster or host or 'localhost'}: distributed DDL queue {ddl_queue_depth} > {module.params['max_ddl_queue']}")
+    for replica in checked:
+        replica["failures"] = replica_failures(replica, module.params)
+        failures += [f"{replica['host']}: {failure}" for failure in replica["failures"]]
+
+    result = {"changed": False, "healthy": not failures, "failures": failures, "replicas": checked, "ddl_queue_depth": ddl_queue_depth}
+    if failures:
+        result["msg"] = f"Preflight failed: {len(failures)} checks on {len({f.split(':')[0] for f in failures})} hosts"
+        if module.params["fail"]:
+            return module.fail_json(**result)
+    else:
+        result["msg"] = f"Preflight passed on {len(checked)} replicas"
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
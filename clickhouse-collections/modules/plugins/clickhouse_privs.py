@@ -7,6 +7,7 @@ DOCUMENTATION = r'''
 ---
 module: clickhouse_privs
 short_description: назначение прав и ролей в clickhouse
+extends_documentation_fragment: ch.modules.clickhouse_retry
 options:
     login_user:
         description:
@@ -129,11 +130,16 @@ msg:
         короткое сообщение, указывающее по произошедшие изменеия
     returned: success
     type: str
+ddl_queue:
+    description:
+        глубина очереди распределённого DDL кластера и суммарное время ожидания её освобождения в секундах
+    returned: ddl_queue_high_water
+    type: dict
 '''
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_native
-from clickhouse_connect import get_client
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
 
 
 def grant_privs(ch_client, module, role, privs, cluster, replace, grant):
@@ -220,6 +226,8 @@ def main():
         "admin": {"type": "bool", "default": False}  # используется при назначении и отборе ролей
     }
 
+    module_args.update(retry_argument_spec())
+
     result = {
         "changed": False
     }
@@ -246,8 +254,9 @@ def main():
     admin = module.params["admin"]
 
 
+    retry = retry_params(module.params)
     try:
-        ch_client = get_client(username=login_user, password=login_password, port=port, host=host)
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
     except Exception as e:
         return module.fail_json(to_native(e))
 
@@ -267,6 +276,7 @@ def main():
         else:
             raise Exception("'privs' or 'grant_to' parameter needs.")
 
+    result.update(ch_client.ddl_queue_report())
     module.exit_json(**result)
 
 
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_processes
+short_description: поиск и остановка долгих и тяжёлых запросов на всех репликах кластера clickhouse
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    cluster:
+        description:
+            название кластера clickhouse, system.processes всех реплик которого просматриваются параллельно.
+            Если не указан, то просматривается только целевая нода, указанная при запуске ansible-playbook.
+        required: false
+        type: str
+    min_elapsed:
+        description:
+            отбирать запросы, выполняющиеся дольше указанного количества секунд
+        required: false
+        type: float
+    min_memory:
+        description:
+            отбирать запросы, использующие больше указанного количества байт памяти
+        required: false
+        type: int
+    min_read_rows:
+        description:
+            отбирать запросы, прочитавшие больше указанного количества строк
+        required: false
+        type: int
+    users:
+        description:
+            отбирать только запросы указанных пользователей
+        required: false
+        type: list
+    query_pattern:
+        description:
+            отбирать только запросы, текст которых соответствует регулярному выражению (синтаксис re2)
+        required: false
+        type: str
+    allow_users:
+        description:
+            пользователи, запросы которых никогда не останавливаются
+        required: false
+        type: list
+    allow_query_ids:
+        description:
+            идентификаторы запросов, которые никогда не останавливаются
+        required: false
+        type: list
+    allow_patterns:
+        description:
+            регулярные выражения (синтаксис re2); запросы, текст которых им соответствует, никогда не останавливаются
+        required: false
+        type: list
+    kill:
+        description:
+            остановить отобранные запросы запросом KILL QUERY ... ASYNC на реплике, где они выполняются.
+            Требует хотя бы одного условия отбора (min_elapsed, min_memory, min_read_rows, users, query_pattern)
+            или kill_all.
+        default: false
+        type: bool
+    kill_all:
+        description:
+            разрешить остановку всех запросов без условий отбора (кроме исключённых параметрами allow_*)
+        default: false
+        type: bool
+    dry_run:
+        description:
+            вернуть запросы, которые были бы остановлены, не останавливая их
+        default: false
+        type: bool
+'''
+
+EXAMPLES = r'''
+- name: остановить запросы дольше 10 минут или использующие больше 20 ГБ памяти, кроме запросов пользователя etl
+    clickhouse_processes:
+      cluster: my_cluster
+      min_elapsed: 600
+      allow_users:
+        - etl
+      kill: true
+
+- name: посмотреть, какие тяжёлые запросы аналитиков были бы остановлены
+    clickhouse_processes:
+      cluster: my_cluster
+      min_memory: 21474836480
+      users:
+        - analyst
+      query_pattern: '(?i)^\s*SELECT'
+      kill: true
+      dry_run: true
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+processes:
+    description:
+        отобранные запросы - хост, query_id, пользователь, время выполнения в секундах, используемая и пиковая
+        память, прочитанные строки и байты, текст запроса и результат остановки (kill_status)
+    returned: success
+    type: list
+resources:
+    description:
+        суммарные память, прочитанные строки и байты остановленных запросов
+    returned: kill
+    type: dict
+errors:
+    description:
+        реплики, с которых не удалось получить список запросов или на которых не удалось остановить запросы
+    returned: success
+    type: list
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import get_replicas, on_replicas
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import quote
+
+
+def processes_query(min_elapsed, min_memory, min_read_rows, users, query_pattern, allow_users, allow_query_ids, allow_patterns):
+    # инициирующие запросы: остановка такого запроса останавливает и его подзапросы на других шардах
+    filters = ["is_initial_query", "query_id != queryID()"]
+    if min_elapsed is not None:
+        filters.append(f"elapsed >= {min_elapsed}")
+    if min_memory is not None:
+        filters.append(f"memory_usage >= {min_memory}")
+    if min_read_rows is not None:
+        filters.append(f"read_rows >= {min_read_rows}")
+    if users:
+        filters.append(f"user IN ({', '.join(quote(u) for u in users)})")
+    if query_pattern:
+        filters.append(f"match(query, {quote(query_pattern)})")
+    if allow_users:
+        filters.append(f"user NOT IN ({', '.join(quote(u) for u in allow_users)})")
+    if allow_query_ids:
+        filters.append(f"query_id NOT IN ({', '.join(quote(q) for q in allow_query_ids)})")
+    for pattern in allow_patterns or []:
+        filters.append(f"NOT match(query, {quote(pattern)})")
+    return ("SELECT query_id, user, elapsed, memory_usage, peak_memory_usage, read_rows, read_bytes, substring(query, 1, 1000) "
+            f"FROM system.processes WHERE {' AND '.join(filters)} ORDER BY elapsed DESC")
+
+
+def snapshot(replicas, conn, query):
+    def collect(ch_client, replica):
+        return {"processes": [{"query_id": r[0], "user": r[1], "elapsed": round(r[2], 3), "memory_usage": r[3],
+                               "peak_memory_usage": r[4], "read_rows": r[5], "read_bytes": r[6], "query": r[7]}
+                              for r in ch_client.query(query).result_rows]}
+    return on_replicas(replicas, collect, conn)
+
+
+def kill_processes(replicas, conn, processes):
+    by_host = {}
+    for process in processes:
+        by_host.setdefault(process["host"], []).append(process["query_id"])
+
+    def kill(ch_client, replica):
+        ids = ', '.join(quote(query_id) for query_id in by_host[replica["host"]])
+        rows = ch_client.query(f"KILL QUERY WHERE query_id IN ({ids}) ASYNC").result_rows
+        # KILL QUERY возвращает строки kill_status, query_id, ...
+        return {"killed": {row[1]: row[0] for row in rows}}
+
+    return on_replicas([r for r in replicas if r["host"] in by_host], kill, conn)
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "cluster": {"type": "str", "required": False},
+        "min_elapsed": {"type": "float", "required": False},
+        "min_memory": {"type": "int", "required": False},
+        "min_read_rows": {"type": "int", "required": False},
+        "users": {"type": "list", "required": False},
+        "query_pattern": {"type": "str", "required": False},
+        "allow_users": {"type": "list", "required": False},
+        "allow_query_ids": {"type": "list", "required": False},
+        "allow_patterns": {"type": "list", "required": False},
+        "kill": {"type": "bool", "default": False},
+        "kill_all": {"type": "bool", "default": False},
+        "dry_run": {"type": "bool", "default": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    cluster = module.params["cluster"]
+    kill = module.params["kill"]
+    dry_run = module.params["dry_run"]
+    selectors = [module.params[name] for name in ("min_elapsed", "min_memory", "min_read_rows", "users", "query_pattern")]
+    if kill and not module.params["kill_all"] and all(value is None or value == [] for value in selectors):
+        # без условий отбора под остановку попали бы все запросы кластера
+        return module.fail_json(msg="kill requires at least one of min_elapsed, min_memory, min_read_rows, users, "
+                                    "query_pattern or an explicit kill_all: true")
+    retry = retry_params(module.params)
+    conn = {"username": login_user, "password": login_password, "port": port, "retry": retry}
+
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+        if cluster:
+            replicas = get_replicas(ch_client, cluster)
+        else:
+            replicas = [{"shard_num": None, "replica_num": None, "host": host or "localhost", "is_local": True}]
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    query = processes_query(module.params["min_elapsed"], module.params["min_memory"], module.params["min_read_rows"],
+                            module.params["users"], module.params["query_pattern"], module.params["allow_users"],
+                            module.params["allow_query_ids"], module.params["allow_patterns"])
+    snapshots = snapshot(replicas, conn, query)
+    errors = [{"host": r["host"], "error": r["error"]} for r in snapshots if r.get("error")]
+    processes = [dict(p, host=r["host"]) for r in snapshots for p in r.get("processes", [])]
+    result = {"changed": False, "processes": processes, "errors": errors}
+
+    if not kill or not processes:
+        result["msg"] = f"{len(processes)} queries matched"
+    elif dry_run:
+        for process in processes:
+            process["kill_status"] = "dry_run"
+        result["msg"] = f"{len(processes)} queries would be killed"
+    else:
+        killed = kill_processes(replicas, conn, processes)
+        statuses = {}
+        for replica in killed:
+            if replica.get("error"):
+                errors.append({"host": replica["host"], "error": replica["error"]})
+            for query_id, status in replica.get("killed", {}).items():
+                statuses[(replica["host"], query_id)] = status
+        for process in processes:
+            process["kill_status"] = statuses.get((process["host"], process["query_id"]), "not_found")
+        killed_processes = [p for p in processes if p["kill_status"] != "not_found"]
+        result["changed"] = bool(killed_processes)
+        result["resources"] = {
+            "memory_usage": sum(p["memory_usage"] for p in killed_processes),
+            "read_rows": sum(p["read_rows"] for p in killed_processes),
+            "read_bytes": sum(p["read_bytes"] for p in killed_processes),
+        }
+        result["msg"] = f"{len(killed_processes)} queries killed"
+
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,532 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_projection
+short_description: управление проекциями и материализованными представлениями в clickhouse
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description: >-
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description: >-
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description: >-
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description: >-
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    mode:
+        description: >-
+            'projection' - управление проекцией таблицы table, 'view' - управление материализованным
+            представлением name, записывающим данные в таблицу to_table.
+        default: projection
+        choices: [projection, view]
+        type: str
+    name:
+        description: >-
+            имя проекции или, для mode = 'view', имя материализованного представления в виде 'db_name.view_name'
+        required: true
+        type: str
+    table:
+        description: >-
+            таблица в виде 'db_name.table_name', для которой создаётся проекция.
+            Для mode = 'view' - исходная таблица, из которой читает запрос представления и по партициям
+            которой выполняется первоначальное заполнение.
+        required: false
+        type: str
+    definition:
+        description: >-
+            запрос проекции, например "SELECT user_id, sum(amount) GROUP BY user_id".
+            Если проекция уже существует с другим запросом, то она будет пересоздана.
+        required: false
+        type: str
+    state:
+        description: >-
+            если состояние установлено 'present'(по умолчанию), то указанная проекция или представление будут созданы,
+            если установлено 'abscent', то будут удалены.
+        default: present
+        choices: [abscent, present]
+        type: str
+    cluster:
+        description: >-
+            название кластера clickhouse, на котором будут выполнены операции. Если не указан,
+            то операции будут выполнены только на целевой ноде, указанной при запуске ansible-playbook.
+        required: false
+        type: str
+    materialize:
+        description: >-
+            построить проекцию для существующих данных запросом MATERIALIZE PROJECTION по каждой партиции,
+            в которой есть куски без проекции
+        default: false
+        type: bool
+    partitions:
+        description: >-
+            идентификаторы партиций (partition_id), которыми ограничивается построение проекции
+            или первоначальное заполнение представления. По умолчанию обрабатываются все партиции.
+        required: false
+        type: list
+    max_concurrency:
+        description: >-
+            максимальное количество одновременно выполняемых мутаций MATERIALIZE PROJECTION или
+            вставок первоначального заполнения представления
+        default: 2
+        type: int
+    timeout:
+        description: >-
+            максимальное время в секундах ожидания построения проекции
+        default: 3600
+        type: int
+    poll_interval:
+        description: >-
+            интервал опроса system.mutations в секундах
+        default: 5
+        type: int
+    to_table:
+        description: >-
+            таблица в виде 'db_name.table_name', в которую записывает данные материализованное представление
+        required: false
+        type: str
+    select:
+        description: >-
+            запрос материализованного представления, читающий из таблицы table. Для backfill таблица
+            должна быть указана в FROM в том же виде 'db_name.table_name', что и в параметре table.
+        required: false
+        type: str
+    backfill:
+        description: >-
+            заполнить to_table данными, уже находящимися в table, без использования POPULATE - отдельной вставкой
+            на каждую партицию table. При cluster заполнение выполняется на одной реплике каждого шарда.
+            При создании представления запоминается номер последнего блока вставки каждой партиции, и читаются
+            только куски с номерами блоков не больше него: более новые строки уже записаны представлением.
+            Партиция, в которой после создания представления слились куски до и после отсечки, возвращается
+            со статусом skipped. Если представление уже существует, то заполнение выполняется только для явно
+            перечисленных partitions, и они заполняются целиком при каждом запуске - так заполняются пропущенные
+            партиции после удаления их из to_table (ALTER TABLE ... DROP PARTITION).
+        default: false
+        type: bool
+'''
+
+EXAMPLES = r'''
+- name: добавить проекцию и построить её для всех партиций, не более трёх мутаций одновременно
+    clickhouse_projection:
+      table: test_db.events
+      name: by_user
+      definition: "SELECT user_id, count(), sum(amount) GROUP BY user_id"
+      materialize: true
+      max_concurrency: 3
+
+- name: создать материализованное представление и заполнить его по партициям исходной таблицы
+    clickhouse_projection:
+      mode: view
+      name: test_db.events_daily_mv
+      table: test_db.events
+      to_table: test_db.events_daily
+      select: "SELECT event_date, user_id, count() AS cnt FROM test_db.events GROUP BY event_date, user_id"
+      backfill: true
+      partitions: "{{ closed_partitions }}"
+
+- name: удалить проекцию
+    clickhouse_projection:
+      table: test_db.events
+      name: by_user
+      state: abscent
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+materialized:
+    description:
+        построение проекции по партициям - partition_id, mutation_id, is_done, parts_to_do,
+        latest_fail_reason и время построения в секундах
+    returned: materialize
+    type: list
+backfilled:
+    description:
+        первоначальное заполнение представления по партициям - host, partition_id, cutoff (номер последнего
+        заполняемого блока, null при заполнении партиции целиком), количество вставленных строк, время вставки
+        в секундах, ошибка или skipped, если в партиции слиты куски до и после отсечки
+    returned: backfill
+    type: list
+'''
+
+import re
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import get_replicas, on_replicas, run_bounded
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+
+
+def normalize_sql(query):
+    query = re.sub(r'\s+', ' ', query.replace('`', '').lower())
+    return re.sub(r'\s*([(),=])\s*', r'\1', query).strip()
+
+
+def create_table_query(ch_client, table):
+    database, name = table.split('.', 1)
+    rows = ch_client.query(
+        f"SELECT create_table_query FROM system.tables WHERE database = '{database}' AND name = '{name}'").result_rows
+    if not rows:
+        raise Exception(f"Table '{table}' does not exist")
+    return rows[0][0]
+
+
+def find_projection(create_query, name):
+    # запрос проекции из описания таблицы, с учётом вложенных скобок
+    match = re.search(rf"PROJECTION\s+`?{re.escape(name)}`?\s*\(", create_query)
+    if not match:
+        return None
+    depth = 0
+    for i in range(match.end() - 1, len(create_query)):
+        if create_query[i] == '(':
+            depth += 1
+        elif create_query[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return create_query[match.end():i]
+    return None
+
+
+def alter_table(ch_client, table, cluster, command, settings=None):
+    query_fragments = [f"ALTER TABLE {table}"]
+    if cluster:
+        query_fragments.append(f"ON CLUSTER {cluster}")
+    query_fragments.append(command)
+    query = ' '.join(query_fragments)
+    try:
+        ch_client.command(query, settings=settings or {})
+    except Exception as e:
+        raise Exception(f"{e}: Error on query: {query}")
+
+
+def ensure_projection(ch_client, table, name, definition, cluster):
+    current = find_projection(create_table_query(ch_client, table), name)
+    if current is not None and normalize_sql(current) == normalize_sql(definition):
+        return False
+    if current is not None:
+        alter_table(ch_client, table, cluster, f"DROP PROJECTION IF EXISTS {name}")
+    alter_table(ch_client, table, cluster, f"ADD PROJECTION {name} ({definition})")
+    return True
+
+
+def partitions_without_projection(ch_client, table, name, partitions):
+    database, table_name = table.split('.', 1)
+    filters = f"database = '{database}' AND table = '{table_name}' AND active"
+    if partitions:
+        filters += " AND partition_id IN (" + ", ".join(f"'{p}'" for p in partitions) + ")"
+    rows = ch_client.query(
+        f"SELECT partition_id, count() AS parts FROM system.parts WHERE {filters} GROUP BY partition_id ORDER BY partition_id").result_rows
+    projected = dict(ch_client.query(
+        f"SELECT partition_id, count() FROM system.projection_parts WHERE {filters} AND name = '{name}' "
+        "GROUP BY partition_id").result_rows)
+    return [row[0] for row in rows if projected.get(row[0], 0) < row[1]]
+
+
+def mutation_ids(ch_client, table):
+    database, table_name = table.split('.', 1)
+    return {row[0] for row in ch_client.query(
+        f"SELECT mutation_id FROM system.mutations WHERE database = '{database}' AND table = '{table_name}'").result_rows}
+
+
+def mutations_state(ch_client, table, ids):
+    database, table_name = table.split('.', 1)
+    id_list = ', '.join(f"'{mutation_id}'" for mutation_id in ids)
+    rows = ch_client.query(
+        "SELECT mutation_id, is_done, parts_to_do, latest_fail_reason, dateDiff('second', create_time, now()) "
+        f"FROM system.mutations WHERE database = '{database}' AND table = '{table_name}' AND mutation_id IN ({id_list})").result_rows
+    return {row[0]: {"is_done": bool(row[1]), "parts_to_do": row[2], "latest_fail_reason": row[3], "duration": row[4]}
+            for row in rows}
+
+
+def materialize_projection(ch_client, module, table, name, cluster, partitions, max_concurrency, timeout, poll_interval):
+    # мутации запускаются по одной на партицию, одновременно выполняется не больше max_concurrency
+    pending = partitions_without_projection(ch_client, table, name, partitions)
+    progress = []
+    running = {}
+    deadline = time.monotonic() + timeout
+    while pending or running:
+        if running:
+            state = mutations_state(ch_client, table, list(running))
+            for mutation_id, mutation in state.items():
+                running[mutation_id].update(mutation)
+                if mutation["is_done"] or mutation["latest_fail_reason"]:
+                    running.pop(mutation_id)
+        if any(p.get("latest_fail_reason") for p in progress):
+            return module.fail_json(msg=f"MATERIALIZE PROJECTION {name} failed", changed=True, materialized=progress)
+        while pending and len(running) < max_concurrency:
+            partition_id = pending.pop(0)
+            known = mutation_ids(ch_client, table)
+            alter_table(ch_client, table, cluster, f"MATERIALIZE PROJECTION {name} IN PARTITION ID '{partition_id}'",
+                        {"mutations_sync": 0})
+            # при ON CLUSTER мутация появляется в system.mutations с задержкой, следующая запускается
+            # только после того, как эта учтена в running, иначе ограничение max_concurrency не соблюдается
+            new_ids = mutation_ids(ch_client, table) - known
+            while not new_ids:
+                if time.monotonic() + poll_interval > deadline:
+                    return module.fail_json(msg=f"Mutation for partition '{partition_id}' is not found in system.mutations",
+                                            changed=True, materialized=progress)
+                time.sleep(poll_interval)
+                new_ids = mutation_ids(ch_client, table) - known
+            for mutation_id in new_ids:
+                running[mutation_id] = {"partition_id": partition_id, "mutation_id": mutation_id, "is_done": False}
+                progress.append(running[mutation_id])
+        if not running:
+            continue
+        if time.monotonic() + poll_interval > deadline:
+            return module.fail_json(msg=f"Timeout waiting for MATERIALIZE PROJECTION {name}", changed=True, materialized=progress)
+        time.sleep(poll_interval)
+    return progress
+
+
+def source_partitions(ch_client, table, partitions):
+    # номер последнего блока вставки каждой партиции: слияния и мутации его не увеличивают,
+    # поэтому рост номера означает новую вставку в партицию
+    database, table_name = table.split('.', 1)
+    rows = ch_client.query(
+        "SELECT partition_id, max(max_block_number) FROM system.parts "
+        f"WHERE database = '{database}' AND table = '{table_name}' AND active GROUP BY partition_id ORDER BY partition_id").result_rows
+    return {row[0]: row[1] for row in rows if not partitions or row[0] in partitions}
+
+
+def reads_from(select, table):
+    database, table_name = table.split('.', 1)
+    return re.search(rf"\bFROM\s+`?{re.escape(database)}`?\.`?{re.escape(table_name)}`?(?![\w`.])", select, re.IGNORECASE) is not None
+
+
+def straddling_parts(ch_client, table, partition_id, cutoff, before=None):
+    # куски, слитые из вставок до и после создания представления: строки до отсечки из них не выделить
+    database, table_name = table.split('.', 1)
+    query = ("SELECT count() FROM system.parts "
+             f"WHERE database = '{database}' AND table = '{table_name}' AND active AND partition_id = '{partition_id}' "
+             f"AND min_block_number <= {cutoff} AND max_block_number > {cutoff}")
+    if before is not None:
+        query += f" AND modification_time <= toDateTime('{before}')"
+    return ch_client.command(query)
+
+
+def shard_hosts(ch_client, host, cluster):
+    # представление создаётся на всех нодах кластера и читает локальную таблицу, поэтому заполнение выполняется
+    # на одной реплике каждого шарда: вставка в реплицируемую to_table дойдёт до остальных реплик шарда
+    if not cluster:
+        return [host]
+    shards = {}
+    for replica in get_replicas(ch_client, cluster):
+        shards.setdefault(replica["shard_num"], replica["host"])
+    return list(shards.values())
+
+
+def backfill_view(conn, table, to_table, select, snapshots, max_concurrency):
+    # вместо POPULATE запрос представления выполняется отдельно для каждой партиции исходной таблицы на каждом шарде,
+    # ограничение на партицию накладывается настройкой additional_table_filters.
+    # snapshots - {хост: {partition_id: номер последнего блока вставки сразу после создания представления}}:
+    # читаются только куски с номерами блоков не больше этой отсечки, более новые строки уже записало представление.
+    # Отсечка None - партиция заполняется целиком
+    def insert(partition_client, task):
+        cutoff = task["cutoff"]
+        partition_filter = f"_partition_id = '{task['partition_id']}'"
+        if cutoff is not None:
+            if straddling_parts(partition_client, table, task["partition_id"], cutoff):
+                return {"skipped": "parts inserted before and after the view was created are merged together"}
+            # в имени куска partition_min_max_level номер последнего блока - третий элемент
+            partition_filter += f" AND toUInt64(splitByChar('_', _part)[3]) <= {cutoff}"
+        filters = "{'%s': '%s'}" % (table, partition_filter.replace("'", "\\'"))
+        server_started = partition_client.command("SELECT now()")
+        started = time.monotonic()
+        summary = partition_client.command(f"INSERT INTO {to_table} {select}", settings={"additional_table_filters": filters},
+                                           idempotent=False)
+        result = {"rows": getattr(summary, "written_rows", None), "duration": round(time.monotonic() - started, 3)}
+        if cutoff is not None and straddling_parts(partition_client, table, task["partition_id"], cutoff, server_started):
+            # слияние через отсечку успело завершиться до начала вставки - часть старых строк не прочитана
+            result["error"] = "parts were merged across the cutoff before the backfill, rows may be missing"
+        return result
+
+    tasks = [{"host": host, "partition_id": p, "cutoff": cutoff}
+             for host, snapshot in snapshots.items() for p, cutoff in snapshot.items()]
+    return run_bounded(tasks, insert, conn, max_concurrency, max_concurrency)
+
+
+def is_view_exists(ch_client, name):
+    database, view = name.split('.', 1)
+    return ch_client.command(f"SELECT count() FROM system.tables WHERE database = '{database}' AND name = '{view}'") > 0
+
+
+def create_view(ch_client, module, host, conn, name, table, to_table, select, cluster, backfill, partitions, max_concurrency):
+    exists = is_view_exists(ch_client, name)
+    if exists and not (backfill and partitions):
+        return {"changed": False, "msg": f"Materialized view '{name}' alredy exists"}
+    if backfill and not reads_from(select, table):
+        # ограничение по партиции задаётся для таблицы table, при другом FROM оно не применится
+        return module.fail_json(msg=f"'select' must read FROM '{table}' to backfill by its partitions")
+    if exists:
+        # представление уже пишет новые строки, перечисленные партиции заполняются целиком
+        result = {"changed": True, "msg": f"Materialized view '{name}' alredy exists, partitions backfilled"}
+        snapshots = {h: {p: None for p in partitions} for h in shard_hosts(ch_client, host, cluster)}
+    else:
+        query_fragments = [f"CREATE MATERIALIZED VIEW IF NOT EXISTS {name}"]
+        if cluster:
+            query_fragments.append(f"ON CLUSTER {cluster}")
+        query_fragments.append(f"TO {to_table} AS {select}")
+        query = ' '.join(query_fragments)
+        try:
+            ch_client.command(query)
+        except Exception as e:
+            return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+        result = {"changed": True, "msg": f"Materialized view '{name}' created"}
+        if not backfill:
+            return result
+        taken = on_replicas([{"host": h} for h in shard_hosts(ch_client, host, cluster)],
+                            lambda replica_client, replica: {"snapshot": source_partitions(replica_client, table, partitions)}, conn)
+        failed = [s for s in taken if s.get("error")]
+        if failed:
+            return module.fail_json(msg=f"Cannot read partitions of '{table}' on {failed[0]['host']}: {failed[0]['error']}", **result)
+        snapshots = {s["host"]: s["snapshot"] for s in taken}
+    result["backfilled"] = backfill_view(conn, table, to_table, select, snapshots, max_concurrency)
+    failed = [b for b in result["backfilled"] if b.get("error")]
+    if failed:
+        return module.fail_json(msg=f"Backfill of '{to_table}' failed for {len(failed)} partitions", **result)
+    return result
+
+
+def drop_view(ch_client, module, name, cluster):
+    if not is_view_exists(ch_client, name):
+        return {"changed": False, "msg": f"Materialized view '{name}' does not exist"}
+    query = f"DROP VIEW IF EXISTS {name}"
+    if cluster:
+        query += f" ON CLUSTER {cluster}"
+    try:
+        ch_client.command(query)
+    except Exception as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+    return {"changed": True, "msg": f"Materialized view '{name}' deleted"}
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "mode": {"type": "str", "default": "projection", "choices": ["projection", "view"]},
+        "name": {"type": "str", "required": True},
+        "table": {"type": "str", "required": False},
+        "definition": {"type": "str", "required": False},
+        "state": {"type": "str", "default": "present", "choices": ["abscent", "present"]},
+        "cluster": {"type": "str", "required": False},
+        "materialize": {"type": "bool", "default": False},
+        "partitions": {"type": "list", "required": False},
+        "max_concurrency": {"type": "int", "default": 2},
+        "timeout": {"type": "int", "default": 3600},
+        "poll_interval": {"type": "int", "default": 5},
+        "to_table": {"type": "str", "required": False},
+        "select": {"type": "str", "required": False},
+        "backfill": {"type": "bool", "default": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    mode = module.params["mode"]
+    name = module.params["name"]
+    table = module.params["table"]
+    definition = module.params["definition"]
+    state = module.params["state"]
+    cluster = module.params["cluster"]
+    materialize = module.params["materialize"]
+    partitions = module.params["partitions"]
+    max_concurrency = module.params["max_concurrency"]
+    timeout = module.params["timeout"]
+    poll_interval = module.params["poll_interval"]
+    to_table = module.params["to_table"]
+    select = module.params["select"]
+    backfill = module.params["backfill"]
+    retry = retry_params(module.params)
+    conn = {"username": login_user, "password": login_password, "port": port, "retry": retry}
+
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    if mode == 'view':
+        if state != 'abscent' and (not (to_table and select) or (backfill and not table)):
+            return module.fail_json("'to_table' and 'select' parameters needs, 'table' is needed for backfill.")
+        try:
+            if state == 'abscent':
+                result = drop_view(ch_client, module, name, cluster)
+            else:
+                result = create_view(ch_client, module, host or "localhost", conn, name, table, to_table, select,
+                                     cluster, backfill, partitions, max_concurrency)
+        except Exception as e:
+            return module.fail_json(to_native(e))
+        result.update(ch_client.ddl_queue_report())
+        module.exit_json(**result)
+
+    if not table:
+        return module.fail_json("'table' parameter needs.")
+    try:
+        if state == 'abscent':
+            if find_projection(create_table_query(ch_client, table), name) is None:
+                module.exit_json(changed=False, msg=f"Projection '{name}' does not exist", **ch_client.ddl_queue_report())
+            alter_table(ch_client, table, cluster, f"DROP PROJECTION IF EXISTS {name}")
+            module.exit_json(changed=True, msg=f"Projection '{name}' deleted", **ch_client.ddl_queue_report())
+        changed = False
+        if definition:
+            changed = ensure_projection(ch_client, table, name, definition, cluster)
+        result = {"changed": changed, "msg": f"Projection '{name}' {'created or changed' if changed else 'is up to date'}"}
+        if materialize:
+            result["materialized"] = materialize_projection(ch_client, module, table, name, cluster, partitions,
+                                                            max_concurrency, timeout, poll_interval)
+            result["changed"] = result["changed"] or bool(result["materialized"])
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    result.update(ch_client.ddl_queue_report())
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ DOCUMENTATION = r'''
 ---
 module: clickhouse_query
 short_description: Run CLickhouse queries
+extends_documentation_fragment: ch.modules.clickhouse_retry
 options:
     login_user:
         description: login name for clickhouse session on a remote host. If not set, the 'default' user will be used.
@@ -28,14 +29,102 @@ options:
         description: database name where queries should be executed. If not set, 'default' will be used.
         required: false
         type: str
-    query: query or list of queries.
-        description:
-        required: true
+    query:
+        description: query or list of queries.
+        required: false
         type: str
-    parameters: list of positional arguments for queries.
+    parameters:
+        description: list of positional arguments for queries.
+        required: false
+        type: list
+    benchmark:
+        description:
+            run the query (or benchmark_queries) benchmark_iterations times at benchmark_concurrency and return
+            client-side latency percentiles, QPS and server-side stats from system.query_log instead of the result.
+            The query cache is disabled for benchmark runs. Benchmark queries are sent without retries and circuit breaker,
+            so latencies contain no backoff pauses and every failed attempt (including TOO_MANY_SIMULTANEOUS_QUERIES)
+            is counted in errors. Without benchmark the query option is required.
+            Mutually exclusive with fanout_targets and fanout_where.
+        required: false
+        default: false
+        type: bool
+    benchmark_queries:
+        description:
+            weighted set of queries for benchmark mode, each a dict with query, optional name and weight (default 1).
+            Names must not contain ':' as they are part of the query_id used to group system.query_log stats.
+            Every iteration picks one query at random according to the weights.
+        required: false
+        type: list
+        elements: dict
+        suboptions:
+            query:
+                description: query text.
+                required: true
+                type: str
+            name:
+                description: name of the query in the report, query_N by default.
+                required: false
+                type: str
+            weight:
+                description: relative frequency of the query.
+                required: false
+                default: 1
+                type: int
+    benchmark_iterations:
+        description: total number of queries executed in benchmark mode.
+        required: false
+        default: 100
+        type: int
+    benchmark_concurrency:
+        description: number of queries executed in parallel in benchmark mode, each worker uses its own connection.
+        required: false
+        default: 4
+        type: int
+    benchmark_warmup:
+        description: number of queries executed before measurements start, not included in the results.
+        required: false
+        default: 0
+        type: int
+    baseline_file:
+        description:
+            JSON file on the target host with a previous benchmark result. If it exists, the current result is
+            compared against it and regressions are returned. With update_baseline the current result is written to it.
+        required: false
+        type: path
+    update_baseline:
+        description: write the current benchmark result to baseline_file.
+        required: false
+        default: false
+        type: bool
+    regression_threshold:
+        description: percent by which latency may grow or QPS may drop against the baseline before it counts as a regression.
+        required: false
+        default: 10
+        type: float
+    fail_on_regression:
+        description: fail the task if any regression against the baseline is found.
+        required: false
+        default: false
+        type: bool
+    fanout_targets:
         description:
+            run query as a template once per target. A target is 'db' or 'db.table', available in the template
+            as {database}, {table} and {target} substituted as backquoted identifiers. Other braces in the template
+            are kept as is, parameters are applied to the template before substitution. Using {table} with a
+            database-only target fails the task. Mutually exclusive with fanout_where.
         required: false
         type: list
+    fanout_where:
+        description:
+            run query as a template once per system.tables row matching this condition,
+            e.g. "database = 'test_db' AND engine LIKE 'Replicated%'".
+        required: false
+        type: str
+    fanout_concurrency:
+        description: number of fan-out statements executed in parallel, each worker reuses its own connection.
+        required: false
+        default: 4
+        type: int
 
 '''
 
@@ -64,6 +153,37 @@ EXAMPLES = r'''
 - name: show var select query results
   debug:
     var: res_query.query_result
+
+- name: sync every replicated table of test_db with one task
+  clickhouse_query:
+    query: "SYSTEM SYNC REPLICA {target}"
+    fanout_where: "database = 'test_db' AND engine LIKE 'Replicated%'"
+    fanout_concurrency: 8
+
+- name: change a setting on a list of tables
+  clickhouse_query:
+    query: "ALTER TABLE {target} MODIFY SETTING max_parts_in_total = 200000"
+    fanout_targets:
+      - test_db.events
+      - test_db.clicks
+
+- name: benchmark a weighted query mix and compare it with the stored baseline
+  clickhouse_query:
+    db: test_db
+    benchmark: true
+    benchmark_queries:
+      - name: point_lookup
+        query: "SELECT * FROM events WHERE user_id = 42"
+        weight: 8
+      - name: daily_report
+        query: "SELECT toDate(ts), count() FROM events GROUP BY 1"
+        weight: 2
+    benchmark_iterations: 500
+    benchmark_concurrency: 8
+    baseline_file: /var/tmp/events_benchmark.json
+    fail_on_regression: true
+  register:
+    res_benchmark
 '''
 
 RETURN = r'''
@@ -75,27 +195,231 @@ executed_queries:
     description: list of queries were executed.
     type: list
     returned: always
+error_code:
+    description: ClickHouse server error code of the failed query, if the server returned one.
+    type: int
+    returned: failure
+benchmark:
+    description:
+        benchmark result - iterations, concurrency, duration, qps, errors (failed attempts), client-side latency (p50, p90, p99,
+        max, mean in milliseconds) and per-query latency and errors with server-side read_rows, read_bytes, memory_usage from system.query_log.
+    type: dict
+    returned: benchmark
+regressions:
+    description: metrics that got worse than the baseline by more than regression_threshold percent.
+    type: list
+    returned: benchmark with an existing baseline_file
+fanout:
+    description: per-target statement, status (ok or error), duration in seconds, error and query_result for SELECT templates.
+    type: list
+    returned: fanout_targets or fanout_where
 '''
 
+import json
+import os
+import random
+import re
+import time
+import uuid
+
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_native
-from clickhouse_connect import get_client
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import run_bounded
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import QueryError, error_code, get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import quote_identifier
 
+LATENCY_METRICS = ["p50", "p90", "p99", "max"]
+FANOUT_PLACEHOLDER = re.compile(r"\{(database|table|target)\}")
 
-def exec_query(ch_client, query, query_params):
+
+def exec_query(ch_client, module, query, query_params):
     try:
         if query_params is not None:
             query = query % tuple(query_params)
-        if query.split(' ')[0].upper() in ["SELECT","SHOW]":
+        if query.split(' ')[0].upper() in ["SELECT", "SHOW"]:
             result = ch_client.query(query)
             #raise Exception(result)
             return {"changed": False, "query_result": result.result_rows}
         ch_client.command(query)
-    except:
-        raise Exception(f'QueryError - {query}')
+    except QueryError as e:
+        return module.fail_json(msg=f"QueryError - {to_native(e)}: Error on query: {query}", error_code=e.code)
+    except Exception as e:
+        return module.fail_json(msg=f"{type(e).__name__} - {to_native(e)}: Error on query: {query}", error_code=None)
     return {"changed": True, "executed_query": query}
 
 
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))]
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return {}
+    summary = {f"p{pct}": round(percentile(latencies, pct), 3) for pct in (50, 90, 99)}
+    summary.update({"max": round(max(latencies), 3), "mean": round(sum(latencies) / len(latencies), 3)})
+    return summary
+
+
+def server_stats(ch_client, run_id):
+    # query_log пишется с задержкой, поэтому перед чтением сбрасываем буферы логов
+    ch_client.command("SYSTEM FLUSH LOGS")
+    rows = ch_client.query(
+        "SELECT splitByChar(':', query_id)[2] AS name, count(), sum(read_rows), sum(read_bytes), "
+        "avg(memory_usage), max(memory_usage), avg(query_duration_ms) FROM system.query_log "
+        f"WHERE event_date >= yesterday() AND type = 'QueryFinish' AND startsWith(query_id, '{run_id}:') "
+        "GROUP BY name").result_rows
+    return {r[0]: {"logged": r[1], "read_rows": r[2], "read_bytes": r[3], "avg_memory_usage": int(r[4]),
+                   "max_memory_usage": r[5], "avg_server_duration_ms": round(r[6], 3)} for r in rows}
+
+
+def run_benchmark(ch_client, conn, host, queries, iterations, concurrency, warmup):
+    run_id = uuid.uuid4().hex
+    names = [q["name"] for q in queries]
+    weights = [q["weight"] for q in queries]
+    by_name = {q["name"]: q["query"] for q in queries}
+
+    def execute(client, task):
+        settings = {"use_query_cache": 0}
+        if not task["warmup"]:
+            settings["query_id"] = f"{run_id}:{task['name']}:{task['n']}"
+        # замеряется сам запрос: без повторов и пауз между ними, каждая неудачная попытка считается ошибкой
+        started = time.monotonic()
+        try:
+            client.raw().query(by_name[task["name"]], settings=settings)
+        except Exception as e:
+            return {"error": str(e), "error_code": error_code(e)}
+        return {"latency": (time.monotonic() - started) * 1000}
+
+    def tasks(count, is_warmup):
+        return [{"host": host, "n": n, "name": name, "warmup": is_warmup}
+                for n, name in enumerate(random.choices(names, weights=weights, k=count))]
+
+    if warmup:
+        run_bounded(tasks(warmup, True), execute, conn, concurrency, concurrency)
+    started = time.monotonic()
+    results = run_bounded(tasks(iterations, False), execute, conn, concurrency, concurrency)
+    duration = time.monotonic() - started
+
+    done = [r for r in results if "latency" in r]
+    errors = [{"name": r["name"], "error": r["error"], "error_code": r.get("error_code")} for r in results if r.get("error")]
+    stats = server_stats(ch_client, run_id)
+    per_query = {}
+    for name in names:
+        latencies = [r["latency"] for r in done if r["name"] == name]
+        per_query[name] = dict(latency_summary(latencies), count=len(latencies),
+                               errors=len([e for e in errors if e["name"] == name]), **stats.get(name, {}))
+    return {
+        "iterations": iterations, "concurrency": concurrency, "duration": round(duration, 3),
+        "qps": round(len(done) / duration, 3) if duration else None,
+        "errors": len(errors), "error_samples": errors[:10],
+        "latency": latency_summary([r["latency"] for r in done]), "queries": per_query,
+    }
+
+
+def compare_baseline(current, baseline, threshold):
+    # рост задержек или падение QPS больше чем на threshold процентов считается регрессией
+    regressions = []
+
+    def check(scope, metric, was, now, higher_is_worse=True):
+        if not was or now is None:
+            return
+        change = (now - was) / was * 100 if higher_is_worse else (was - now) / was * 100
+        if change > threshold:
+            regressions.append({"scope": scope, "metric": metric, "baseline": was, "current": now, "change_pct": round(change, 2)})
+
+    check("total", "qps", baseline.get("qps"), current.get("qps"), higher_is_worse=False)
+    for metric in LATENCY_METRICS:
+        check("total", metric, baseline.get("latency", {}).get(metric), current["latency"].get(metric))
+    for name, stats in current["queries"].items():
+        was = baseline.get("queries", {}).get(name, {})
+        for metric in LATENCY_METRICS + ["read_bytes", "max_memory_usage"]:
+            check(name, metric, was.get(metric), stats.get(metric))
+    return regressions
+
+
+def benchmark(ch_client, module, conn, host, queries, params):
+    try:
+        report = run_benchmark(ch_client, conn, host, queries, params["benchmark_iterations"],
+                               params["benchmark_concurrency"], params["benchmark_warmup"])
+    except QueryError as e:
+        return module.fail_json(msg=f"QueryError - {to_native(e)}: Error on benchmark", error_code=e.code)
+    result = {"changed": False, "benchmark": report}
+    baseline_file = params["baseline_file"]
+    if baseline_file and os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            result["regressions"] = compare_baseline(report, json.load(f), params["regression_threshold"])
+    if baseline_file and params["update_baseline"]:
+        with open(baseline_file, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        result["changed"] = True
+    if params["fail_on_regression"] and result.get("regressions"):
+        return module.fail_json(msg=f"{len(result['regressions'])} regressions against baseline {baseline_file}", **result)
+    return result
+
+
+def fanout_targets(ch_client, module, targets, where):
+    if targets is not None:
+        expanded = []
+        for target in targets:
+            database, _, table = str(target).partition('.')
+            expanded.append({"database": database, "table": table or None, "target": target})
+        return expanded
+    query = f"SELECT database, name FROM system.tables WHERE {where} ORDER BY database, name"
+    try:
+        rows = ch_client.query(query).result_rows
+    except QueryError as e:
+        return module.fail_json(msg=f"QueryError - {to_native(e)}: Error on query: {query}", error_code=e.code)
+    return [{"database": r[0], "table": r[1], "target": f"{r[0]}.{r[1]}"} for r in rows]
+
+
+def render_fanout(template, target):
+    # подставляются только {database}, {table} и {target}, остальные фигурные скобки шаблона не трогаем
+    def substitute(match):
+        if match.group(1) == "target":
+            return '.'.join(quote_identifier(part) for part in (target["database"], target["table"]) if part is not None)
+        if target[match.group(1)] is None:
+            raise KeyError(match.group(1))
+        return quote_identifier(target[match.group(1)])
+    return FANOUT_PLACEHOLDER.sub(substitute, template)
+
+
+def fanout(ch_client, module, conn, host, template, targets, concurrency, query_params):
+    if query_params is not None:
+        template = template % tuple(query_params)
+    tasks = []
+    for target in targets:
+        try:
+            tasks.append(dict(target, host=host, statement=render_fanout(template, target)))
+        except KeyError as e:
+            return module.fail_json(msg=f"Template placeholder {{{e.args[0]}}} is not available for target {target['target']}")
+
+    def execute(client, task):
+        started = time.monotonic()
+        if task["statement"].split(' ')[0].upper() in ["SELECT", "SHOW"]:
+            rows = client.query(task["statement"]).result_rows
+            return {"status": "ok", "duration": round(time.monotonic() - started, 3), "query_result": rows}
+        client.command(task["statement"])
+        return {"status": "ok", "duration": round(time.monotonic() - started, 3)}
+
+    # одна задача модуля вместо loop: подключения переиспользуются потоками пула
+    results = run_bounded(tasks, execute, conn, concurrency, concurrency)
+    for item in results:
+        item.pop("host")
+        if item.get("error"):
+            item["status"] = "error"
+    failed = [r for r in results if r["status"] == "error"]
+    changed = any(r["status"] == "ok" and "query_result" not in r for r in results)
+    result = {"changed": changed, "fanout": results,
+              "executed_queries": [r["statement"] for r in results if r["status"] == "ok"]}
+    if failed:
+        return module.fail_json(msg=f"{len(failed)} of {len(results)} fan-out statements failed", **result)
+    result["msg"] = f"{len(results)} fan-out statements executed"
+    return result
+
+
 def main():
 
     module_args = {
@@ -104,10 +428,27 @@ def main():
         "port": {"type": "int", "required": False},
         "host": {"type": "str", "required": False},
         "db": {"type": "str", "required": False},
-        "query": {"type": "str", "required": True},
-        "parameters": {"type": "list", "required": False}
+        "query": {"type": "str", "required": False},
+        "parameters": {"type": "list", "required": False},
+        "benchmark": {"type": "bool", "default": False},
+        "benchmark_queries": {"type": "list", "required": False, "elements": "dict",
+                              "options": {"query": {"type": "str", "required": True},
+                                          "name": {"type": "str", "required": False},
+                                          "weight": {"type": "int", "default": 1}}},
+        "benchmark_iterations": {"type": "int", "default": 100},
+        "benchmark_concurrency": {"type": "int", "default": 4},
+        "benchmark_warmup": {"type": "int", "default": 0},
+        "baseline_file": {"type": "path", "required": False},
+        "update_baseline": {"type": "bool", "default": False},
+        "regression_threshold": {"type": "float", "default": 10},
+        "fail_on_regression": {"type": "bool", "default": False},
+        "fanout_targets": {"type": "list", "required": False},
+        "fanout_where": {"type": "str", "required": False},
+        "fanout_concurrency": {"type": "int", "default": 4}
     }
 
+    module_args.update(retry_argument_spec())
+
     result = {
         "changed": False,
         "executed_queries": {"type": "list"}
@@ -115,6 +456,10 @@ def main():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[["query", "benchmark_queries"]],
+        required_if=[["benchmark", False, ["query"]]],
+        required_by={"fanout_targets": "query", "fanout_where": "query"},
+        mutually_exclusive=[["fanout_targets", "fanout_where"], ["benchmark", "fanout_targets"], ["benchmark", "fanout_where"]],
         supports_check_mode=True
     )
 
@@ -129,12 +474,33 @@ def main():
     query = module.params["query"]
     parameters = module.params["parameters"]
 
+    retry = retry_params(module.params)
     try:
-        ch_client = get_client(username=login_user, password=login_password, database=db, port=port, host=host)
+        ch_client = get_client(username=login_user, password=login_password, database=db, port=port, host=host, retry=retry)
     except Exception as e:
         return module.fail_json(to_native(e))
 
-    result = exec_query(ch_client, query, parameters)
+    if module.params["benchmark"]:
+        if module.params["benchmark_queries"]:
+            queries = [{"name": q["name"] or f"query_{n}", "query": q["query"], "weight": q["weight"]}
+                       for n, q in enumerate(module.params["benchmark_queries"], 1)]
+            # имя запроса входит в query_id вида run_id:name:n, по которому группируется system.query_log
+            invalid = [q["name"] for q in queries if ':' in q["name"]]
+            if invalid:
+                module.fail_json(msg=f"Benchmark query names must not contain ':': {', '.join(invalid)}")
+        else:
+            queries = [{"name": "query", "query": query % tuple(parameters) if parameters is not None else query, "weight": 1}]
+        conn = {"username": login_user, "password": login_password, "database": db, "port": port, "retry": retry}
+        result = benchmark(ch_client, module, conn, host or "localhost", queries, module.params)
+        module.exit_json(**result)
+
+    if module.params["fanout_targets"] is not None or module.params["fanout_where"]:
+        targets = fanout_targets(ch_client, module, module.params["fanout_targets"], module.params["fanout_where"])
+        conn = {"username": login_user, "password": login_password, "database": db, "port": port, "retry": retry}
+        result = fanout(ch_client, module, conn, host or "localhost", query, targets, module.params["fanout_concurrency"], parameters)
+        module.exit_json(**result)
+
+    result = exec_query(ch_client, module, query, parameters)
     #raise Exception(result)
     module.exit_json(**result)
 
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_query_log
+short_description: самые тяжёлые запросы по system.query_log всех реплик кластера clickhouse
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    cluster:
+        description:
+            название кластера clickhouse, system.query_log всех реплик которого читается через clusterAllReplicas.
+            Если не указан, то читается только журнал целевой ноды, указанной при запуске ansible-playbook.
+        required: false
+        type: str
+    window:
+        description:
+            окно анализа в минутах, отсчитываемое от текущего времени. Не используется, если задан since.
+        default: 60
+        type: int
+    since:
+        description:
+            начало окна анализа в формате 'YYYY-MM-DD hh:mm:ss'
+        required: false
+        type: str
+    until:
+        description:
+            конец окна анализа в формате 'YYYY-MM-DD hh:mm:ss', по умолчанию текущее время
+        required: false
+        type: str
+    top:
+        description:
+            количество групп запросов, возвращаемых по каждой метрике
+        default: 10
+        type: int
+    metrics:
+        description:
+            метрики, по которым отбираются самые тяжёлые группы запросов
+        default: [duration, memory, read_bytes, error_rate]
+        choices: [duration, memory, read_bytes, error_rate]
+        type: list
+    log_comment:
+        description:
+            учитывать только запросы с log_comment, соответствующим шаблону LIKE. Модули коллекции помечают
+            свои запросы как 'ch.modules.<имя модуля>', например 'ch.modules.%'.
+        required: false
+        type: str
+    users:
+        description:
+            учитывать только запросы указанных пользователей
+        required: false
+        type: list
+    initial_only:
+        description:
+            учитывать только инициирующие запросы, без подзапросов распределённых таблиц на других шардах
+        default: true
+        type: bool
+'''
+
+EXAMPLES = r'''
+- name: 10 самых тяжёлых групп запросов кластера за последние 3 часа
+    clickhouse_query_log:
+      cluster: my_cluster
+      window: 180
+  register: heavy
+
+- name: запросы модулей коллекции за время выката
+    clickhouse_query_log:
+      cluster: my_cluster
+      since: '2024-05-01 10:00:00'
+      until: '2024-05-01 11:00:00'
+      log_comment: 'ch.modules.%'
+      metrics:
+        - duration
+        - error_rate
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+top:
+    description:
+        для каждой метрики - группы запросов по normalized_query_hash с примером запроса, количеством
+        запросов и ошибок, долей ошибок, суммарной и p90 длительностью, пиковой памятью, прочитанными
+        байтами и строками, количеством хостов и пользователями
+    returned: success
+    type: dict
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import quote
+
+
+# ключ сортировки групп для каждой метрики, g - кортеж столбцов COLUMNS
+ORDER = {
+    "duration": "g -> g.6",
+    "memory": "g -> g.8",
+    "read_bytes": "g -> g.9",
+    "error_rate": "g -> (g.5, g.4)",
+}
+
+COLUMNS = ["normalized_query_hash", "query", "queries", "errors", "error_rate", "total_duration_ms", "p90_duration_ms",
+           "max_memory_usage", "read_bytes", "read_rows", "hosts", "users"]
+
+
+def window_filter(window, since, until):
+    start = f"toDateTime({quote(since)})" if since else f"now() - INTERVAL {window} MINUTE"
+    end = f"toDateTime({quote(until)})" if until else "now()"
+    return [f"event_date >= toDate({start})", f"event_time >= {start}", f"event_time <= {end}"]
+
+
+def top_query(source, filters, metrics, top):
+    # query_log читается один раз: все метрики групп считаются одной агрегацией (ошибки - countIf),
+    # а первые top групп по каждой метрике выбираются сортировкой массива групп
+    groups = (
+        "SELECT toString(normalized_query_hash) AS hash, substring(any(query), 1, 1000) AS sample, count() AS queries, "
+        "countIf(type != 'QueryFinish') AS errors, round(errors / queries, 4) AS error_rate, "
+        "sum(query_duration_ms) AS total_duration_ms, quantile(0.9)(query_duration_ms) AS p90, "
+        "max(memory_usage) AS max_memory_usage, sum(read_bytes) AS total_read_bytes, "
+        "sum(read_rows) AS total_read_rows, uniqExact(hostName()) AS hosts, groupUniqArray(10)(user) AS users "
+        f"FROM {source} WHERE {' AND '.join(filters)} GROUP BY normalized_query_hash")
+    ranked = []
+    for metric in metrics:
+        candidates = "arrayFilter(g -> g.4 > 0, groups)" if metric == "error_rate" else "groups"
+        ranked.append(f"arraySlice(arrayReverseSort({ORDER[metric]}, {candidates}), 1, {top})")
+    return (f"SELECT {', '.join(ranked)} FROM (SELECT groupArray((hash, sample, queries, errors, error_rate, total_duration_ms, "
+            f"p90, max_memory_usage, total_read_bytes, total_read_rows, hosts, users)) AS groups FROM ({groups}))")
+
+
+def collect_top(ch_client, module, cluster, filters, metrics, top):
+    if not metrics:
+        return {}
+    source = f"clusterAllReplicas('{cluster}', system.query_log)" if cluster else "system.query_log"
+    query = top_query(source, filters, metrics, top)
+    try:
+        rows = ch_client.query(query).result_rows
+    except Exception as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+    return {metric: [dict(zip(COLUMNS, group)) for group in groups] for metric, groups in zip(metrics, rows[0])}
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "cluster": {"type": "str", "required": False},
+        "window": {"type": "int", "default": 60},
+        "since": {"type": "str", "required": False},
+        "until": {"type": "str", "required": False},
+        "top": {"type": "int", "default": 10},
+        "metrics": {"type": "list", "default": list(ORDER), "choices": list(ORDER)},
+        "log_comment": {"type": "str", "required": False},
+        "users": {"type": "list", "required": False},
+        "initial_only": {"type": "bool", "default": True}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    cluster = module.params["cluster"]
+    log_comment = module.params["log_comment"]
+    users = module.params["users"]
+
+    retry = retry_params(module.params)
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    filters = window_filter(module.params["window"], module.params["since"], module.params["until"])
+    filters.append("type IN ('QueryFinish', 'ExceptionBeforeStart', 'ExceptionWhileProcessing')")
+    if module.params["initial_only"]:
+        filters.append("is_initial_query")
+    if log_comment:
+        filters.append(f"log_comment LIKE {quote(log_comment)}")
+    if users:
+        filters.append(f"user IN ({', '.join(quote(u) for u in users)})")
+
+    top = collect_top(ch_client, module, cluster, filters, module.params["metrics"], module.params["top"])
+    result = {"changed": False, "top": top,
+              "msg": f"{max([len(groups) for groups in top.values()] or [0])} query groups per metric"}
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
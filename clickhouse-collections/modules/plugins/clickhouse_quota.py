@@ -0,0 +1,308 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_quota
+short_description: создание и изменение квот в clickhouse с ограничениями по интервалам
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    name:
+        description:
+            имя квоты
+        required: true
+        aliases: [quota]
+        type: str
+    check:
+        description:
+            прверить, существует ли указанная квота на сервере clickhouse.
+            Возвращает результат в __имя_переменной__.exists в виде булевого значения.
+        default: false
+        type: bool
+    state:
+        description:
+            если состояние установлено 'present'(по умолчанию), то указанная квота будет создана или изменена,
+            если установлено 'abscent', то указанная квота будет удалена.
+        default: present
+        choices: [abscent, present]
+        type: str
+    cluster:
+        description:
+            название кластера clickhouse, на котором будут выполнены операции. Если не указан,
+            то операции будут выполнены только на целевой ноде, указанной при запуске ansible-playbook.
+        required: false
+        type: str
+    keyed_by:
+        description:
+            ключ, по которому ведётся учёт потребления квоты. Если не указан, то квота общая для всех,
+            кому она назначена.
+        required: false
+        choices: [user_name, ip_address, client_key, client_key_or_user_name, client_key_or_ip_address]
+        type: str
+    intervals:
+        description:
+            интервалы квоты. Каждый интервал задаётся словарём с ключом duration (например '1 hour' или
+            количество секунд), признаком randomized и ограничениями queries, query_selects, query_inserts,
+            errors, result_rows, result_bytes, read_rows, read_bytes, execution_time, written_bytes,
+            failed_sequential_authentications. Интервалы существующей квоты, не указанные в списке, удаляются.
+        required: false
+        type: list
+    assign_to:
+        description:
+            пользователи и роли, которым назначается квота. Значение 'NONE' снимает квоту со всех,
+            'ALL' назначает всем. Если параметр не задан, то назначения существующей квоты не изменяются.
+        required: false
+        type: list
+'''
+
+EXAMPLES = r'''
+- name: квота для аналитиков - не более 1000 запросов и 1 ТБ прочитанных данных в час на пользователя
+    clickhouse_quota:
+      name: analysts
+      keyed_by: user_name
+      intervals:
+        - duration: 1 hour
+          queries: 1000
+          read_bytes: 1000000000000
+        - duration: 1 day
+          execution_time: 36000
+          errors: 500
+      assign_to:
+        - analysts
+        - bi
+      cluster: my_cluster
+
+- name: удалить квоту
+    clickhouse_quota:
+      name: analysts
+      cluster: my_cluster
+      state: abscent
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+'''
+
+import re
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+
+
+LIMITS = ["queries", "query_selects", "query_inserts", "errors", "result_rows", "result_bytes",
+          "read_rows", "read_bytes", "execution_time", "written_bytes", "failed_sequential_authentications"]
+
+# длительность интервалов в секундах в том виде, в котором её считает clickhouse
+UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 604800,
+         "month": 2629746, "quarter": 7889238, "year": 31556952}
+
+KEYS = {"user_name": ["user_name"], "ip_address": ["ip_address"], "client_key": ["client_key"],
+        "client_key_or_user_name": ["client_key", "user_name"], "client_key_or_ip_address": ["client_key", "ip_address"]}
+
+
+def duration_seconds(duration):
+    if isinstance(duration, int) or str(duration).isdigit():
+        return int(duration)
+    match = re.match(r'^\s*(\d+)\s+([a-z]+?)s?\s*$', str(duration).lower())
+    if not match or match.group(2) not in UNITS:
+        raise ValueError(f"Invalid quota interval duration: {duration}")
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+def desired_intervals(intervals):
+    desired = {}
+    for interval in intervals or []:
+        limits = {limit: float(interval[limit]) for limit in LIMITS if interval.get(limit)}
+        desired[duration_seconds(interval["duration"])] = {"randomized": bool(interval.get("randomized")), "limits": limits}
+    return desired
+
+
+def current_quota(ch_client, name):
+    rows = ch_client.query(f"SELECT keys, apply_to_all, apply_to_list FROM system.quotas WHERE name = '{name}'").result_rows
+    if not rows:
+        return None
+    assigned = ["ALL"] if rows[0][1] else sorted(rows[0][2]) or ["NONE"]
+    limits_result = ch_client.query(f"SELECT * FROM system.quota_limits WHERE quota_name = '{name}'")
+    # набор ограничений зависит от версии clickhouse, поэтому колонки берутся из ответа
+    columns = list(limits_result.column_names)
+    intervals = {}
+    for row in limits_result.result_rows:
+        row = dict(zip(columns, row))
+        limits = {limit: float(row[f"max_{limit}"]) for limit in LIMITS if row.get(f"max_{limit}")}
+        intervals[int(row["duration"])] = {"randomized": bool(row["is_randomized_interval"]), "limits": limits}
+    supported = [limit for limit in LIMITS if f"max_{limit}" in columns]
+    return {"keys": sorted(str(k) for k in rows[0][0]), "assigned": assigned, "intervals": intervals, "supported": supported}
+
+
+def format_limit(value):
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+def interval_clause(duration, interval, limits):
+    clause = f"FOR {'RANDOMIZED ' if interval['randomized'] else ''}INTERVAL {duration} second"
+    limits = [f"{limit} = {format_limit(interval['limits'].get(limit, 0))}" for limit in limits]
+    if not limits:
+        return f"{clause} TRACKING ONLY"
+    return f"{clause} MAX {', '.join(limits)}"
+
+
+def is_quota_exists(ch_client, name):
+    return {"exists": ch_client.command(f"SELECT count(*) FROM system.quotas WHERE name = '{name}'") > 0}
+
+
+def create_quota(ch_client, module, name, cluster, keyed_by, intervals, assign_to):
+    try:
+        desired = desired_intervals(intervals)
+    except (KeyError, ValueError) as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"Invalid intervals: {e}"}))
+    current = current_quota(ch_client, name)
+    query_fragments = [f"{'ALTER' if current else 'CREATE'} QUOTA {name}"]
+    if cluster:
+        query_fragments.append(f"ON CLUSTER {cluster}")
+    if current is None:
+        if keyed_by:
+            query_fragments.append(f"KEYED BY {keyed_by}")
+        interval_kit = [interval_clause(d, i, list(i["limits"])) for d, i in sorted(desired.items())]
+    else:
+        changes = []
+        if sorted(KEYS.get(keyed_by, [])) != current["keys"]:
+            query_fragments.append(f"KEYED BY {keyed_by}" if keyed_by else "NOT KEYED")
+            changes.append("keys")
+        interval_kit = []
+        if intervals is not None:
+            for duration, interval in sorted(desired.items()):
+                if current["intervals"].get(duration) != interval:
+                    # неуказанные ограничения изменяемого интервала сбрасываются в 0 (без ограничения)
+                    limits = current["supported"] + [limit for limit in interval["limits"] if limit not in current["supported"]]
+                    interval_kit.append(interval_clause(duration, interval, limits))
+            for duration in sorted(set(current["intervals"]) - set(desired)):
+                interval_kit.append(f"FOR INTERVAL {duration} second NO LIMITS")
+        if interval_kit:
+            changes.append("intervals")
+        if assign_to is not None and current["assigned"] != sorted(assign_to):
+            changes.append("assign")
+        if not changes:
+            return {"changed": False, "msg": f"Quota '{name}' is up to date"}
+    if interval_kit:
+        query_fragments.append(', '.join(interval_kit))
+    if assign_to is not None:
+        query_fragments.append(f"TO {', '.join(assign_to)}")
+    query = ' '.join(query_fragments)
+    try:
+        ch_client.command(query)
+    except Exception as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+    return {"changed": True, "msg": f"Quota '{name}' {'changed' if current else 'created'}"}
+
+
+def drop_quota(ch_client, module, name, cluster):
+    if not is_quota_exists(ch_client, name)["exists"]:
+        return {"changed": False, "msg": f"Quota '{name}' does not exist"}
+    query = f"DROP QUOTA IF EXISTS {name}"
+    if cluster:
+        query += f" ON CLUSTER {cluster}"
+    try:
+        ch_client.command(query)
+    except Exception as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+    return {"changed": True, "msg": f"Quota '{name}' deleted"}
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "name": {"type": "str", "required": True, "aliases": ["quota"]},
+        "check": {"type": "bool", "default": False},
+        "state": {"type": "str", "default": "present", "choices": ["abscent", "present"]},
+        "cluster": {"type": "str", "required": False},
+        "keyed_by": {"type": "str", "required": False, "choices": list(KEYS)},
+        "intervals": {"type": "list", "required": False},
+        "assign_to": {"type": "list", "required": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    name = module.params["name"]
+    check = module.params["check"]
+    state = module.params["state"]
+    cluster = module.params["cluster"]
+    keyed_by = module.params["keyed_by"]
+    intervals = module.params["intervals"]
+    assign_to = module.params["assign_to"]
+
+    retry = retry_params(module.params)
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    if check:
+        module.exit_json(**is_quota_exists(ch_client, name))
+
+    if state == 'present':
+        result = create_quota(ch_client, module, name, cluster, keyed_by, intervals, assign_to)
+    else:
+        result = drop_quota(ch_client, module, name, cluster)
+
+    result.update(ch_client.ddl_queue_report())
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ DOCUMENTATION = r'''
 ---
 module: clickhouse_role
 short_description: создание ролей в clickhouse
+extends_documentation_fragment: ch.modules.clickhouse_retry
 options:
     login_user:
         description:
@@ -101,11 +102,17 @@ msg:
         короткое сообщение, указывающее по произошедшие изменеия
     returned: success
     type: str
+ddl_queue:
+    description:
+        глубина очереди распределённого DDL кластера и суммарное время ожидания её освобождения в секундах
+    returned: ddl_queue_high_water
+    type: dict
 '''
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_native
-from clickhouse_connect import get_client
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import format_setting
 
 def is_role_exists(ch_client, name):
     return {"exists": ch_client.command(f"SELECT count(*) FROM system.roles WHERE name = '{name}'") > 0}
@@ -115,7 +122,7 @@ def create_role(ch_client, module, name, cluster, settings):
     if cluster:
         query_fragments.append(f"ON CLUSTER {cluster}")
     if settings:
-        settings_kit = [f'{k}={v} READONLY' for k,v in settings.items()]
+        settings_kit = [f'{k}={format_setting(v)} READONLY' for k,v in settings.items()]
         query_fragments.append("SETTINGS " + ", ".join(settings_kit))
     query = ' '.join(query_fragments)
     try:
@@ -150,6 +157,8 @@ def main():
         "settings": {"type": "dict", "required": False}
     }
 
+    module_args.update(retry_argument_spec())
+
     result = {
         "changed": False
     }
@@ -172,8 +181,9 @@ def main():
     cluster = module.params["cluster"]
     settings = module.params["settings"]
 
+    retry = retry_params(module.params)
     try:
-        ch_client = get_client(username=login_user, password=login_password, port=port, host=host)
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
     except Exception as e:
         return module.fail_json(to_native(e))
 
@@ -185,6 +195,7 @@ def main():
     else:
         result = drop_role(ch_client, module, name, cluster)
 
+    result.update(ch_client.ddl_queue_report())
     module.exit_json(**result)
 
 
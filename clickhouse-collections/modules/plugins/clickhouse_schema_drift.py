@@ -0,0 +1,334 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_schema_drift
+short_description: поиск расхождений схемы баз данных и таблиц между репликами кластера clickhouse
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    cluster:
+        description:
+            название кластера clickhouse, схемы всех реплик которого сравниваются
+        required: true
+        type: str
+    databases:
+        description:
+            сравнивать только указанные базы данных. По умолчанию сравниваются все базы, кроме системных.
+        required: false
+        type: list
+    ignore_patterns:
+        description:
+            дополнительные регулярные выражения (синтаксис re2), фрагменты определений, совпадающие с которыми,
+            не учитываются при сравнении. UUID и аргументы путей реплицируемых движков не учитываются всегда.
+        required: false
+        type: list
+    reference_host:
+        description:
+            реплика, схема которой считается эталонной. По умолчанию эталоном для каждого объекта
+            считается определение, которое встречается на большинстве реплик.
+        required: false
+        type: str
+    ddl:
+        description:
+            сформировать запросы, приводящие расходящиеся реплики к эталону. Запросы только возвращаются
+            и не выполняются.
+        default: false
+        type: bool
+'''
+
+EXAMPLES = r'''
+- name: найти расхождения схемы между репликами кластера
+    clickhouse_schema_drift:
+      cluster: my_cluster
+  register: drift
+
+- name: сформировать запросы для исправления расхождений в базе test_db относительно реплики ch-1
+    clickhouse_schema_drift:
+      cluster: my_cluster
+      databases:
+        - test_db
+      reference_host: ch-1
+      ddl: true
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+objects:
+    description:
+        количество сравненных баз данных и таблиц
+    returned: success
+    type: int
+divergent:
+    description:
+        расходящиеся объекты - база данных, таблица, вид расхождения (missing, definition, columns),
+        эталонная реплика и реплики, определение объекта на которых отличается от эталона или отсутствует
+    returned: success
+    type: list
+ddl:
+    description:
+        запросы для приведения реплик к эталону - хост, запрос и комментарий
+    returned: ddl
+    type: list
+errors:
+    description:
+        реплики, с которых не удалось получить схему
+    returned: success
+    type: list
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import get_replicas, on_replicas
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import quote
+
+
+SYSTEM_DATABASES = ["system", "INFORMATION_SCHEMA", "information_schema"]
+
+# фрагменты, которые законно различаются между репликами: UUID объектов и пути/имена реплик в движках
+IGNORE_PATTERNS = [
+    r" UUID '[0-9a-f-]+'",
+    r"Replicated\w*MergeTree\('[^']*', '[^']*'",
+    r"Replicated\('[^']*', '[^']*', '[^']*'\)",
+]
+
+
+def normalized(column, patterns):
+    for pattern in patterns:
+        column = f"replaceRegexpAll({column}, {quote(pattern)}, '')"
+    return f"toString(cityHash64({column}))"
+
+
+def schema_queries(databases, patterns):
+    if databases:
+        db_filter = f"IN ({', '.join(quote(d) for d in databases)})"
+    else:
+        db_filter = f"NOT IN ({', '.join(quote(d) for d in SYSTEM_DATABASES)})"
+    return {
+        "databases": f"SELECT name, engine, {normalized('engine_full', patterns)} FROM system.databases WHERE name {db_filter}",
+        # внутренние таблицы материализованных представлений называются по UUID и сравниваются через сами представления
+        "tables": (f"SELECT database, name, engine, {normalized('create_table_query', patterns)} FROM system.tables "
+                   f"WHERE database {db_filter} AND NOT is_temporary AND NOT startsWith(name, '.inner')"),
+        "columns": ("SELECT database, table, toString(cityHash64(arraySort(groupArray("
+                    "(position, name, type, default_kind, default_expression, compression_codec))))) "
+                    f"FROM system.columns WHERE database {db_filter} AND NOT startsWith(table, '.inner') GROUP BY database, table"),
+    }
+
+
+def collect_schemas(replicas, conn, databases, patterns):
+    queries = schema_queries(databases, patterns)
+
+    def collect(ch_client, replica):
+        objects = {}
+        for name, engine, digest in ch_client.query(queries["databases"]).result_rows:
+            objects[(name, None)] = (engine, digest, None)
+        columns = {(r[0], r[1]): r[2] for r in ch_client.query(queries["columns"]).result_rows}
+        for database, name, engine, digest in ch_client.query(queries["tables"]).result_rows:
+            objects[(database, name)] = (engine, digest, columns.get((database, name)))
+        return {"objects": objects}
+
+    return on_replicas(replicas, collect, conn)
+
+
+def find_drift(schemas, reference_host):
+    hosts = [s["host"] for s in schemas if "objects" in s]
+    by_host = {s["host"]: s["objects"] for s in schemas if "objects" in s}
+    keys = set()
+    for objects in by_host.values():
+        keys.update(objects)
+    divergent = []
+    for key in sorted(keys, key=lambda k: (k[0], k[1] or '')):
+        signatures = {host: by_host[host].get(key) for host in hosts}
+        if len(set(signatures.values())) == 1:
+            continue
+        if reference_host in signatures and signatures[reference_host] is not None:
+            reference = reference_host
+        else:
+            # эталон - определение, которое встречается на большинстве реплик
+            present = [s for s in signatures.values() if s is not None]
+            common = max(present, key=present.count)
+            reference = next(host for host in hosts if signatures[host] == common)
+        expected = signatures[reference]
+        differing = {}
+        for host, signature in signatures.items():
+            if signature == expected:
+                continue
+            if signature is None:
+                differing[host] = "missing"
+            elif signature[0] == expected[0] and signature[2] != expected[2]:
+                # определение таблицы включает колонки, поэтому расхождение колонок исправляется через ALTER
+                differing[host] = "columns"
+            else:
+                differing[host] = "definition"
+        kinds = set(differing.values())
+        divergent.append({"database": key[0], "table": key[1], "reference_host": reference,
+                          "kind": "missing" if "missing" in kinds else "definition" if "definition" in kinds else "columns",
+                          "hosts": differing})
+    return divergent, len(keys)
+
+
+def object_filter(objects, column="name"):
+    return " OR ".join(f"(database = {quote(o['database'])} AND {column} = {quote(o['table'])})" for o in objects)
+
+
+def corrective_ddl(replicas, conn, divergent):
+    # определения объектов эталонных реплик и колонки таблиц, различающихся только колонками
+    wanted = {}
+    for obj in divergent:
+        hosts = [obj["reference_host"]] + [h for h, kind in obj["hosts"].items() if kind == "columns"]
+        for host in hosts:
+            wanted.setdefault(host, []).append(obj)
+
+    def fetch(ch_client, replica):
+        objects = wanted[replica["host"]]
+        tables = [o for o in objects if o["table"]]
+        dbs = [o["database"] for o in objects if not o["table"]]
+        create = {}
+        if tables:
+            for database, name, query in ch_client.query(
+                    f"SELECT database, name, create_table_query FROM system.tables WHERE {object_filter(tables)}").result_rows:
+                create[(database, name)] = query
+        for database in dbs:
+            create[(database, None)] = ch_client.command(f"SHOW CREATE DATABASE {database}")
+        columns = {}
+        if tables:
+            for database, table, name, type_, kind, expression in ch_client.query(
+                    "SELECT database, table, name, type, default_kind, default_expression FROM system.columns "
+                    f"WHERE {object_filter(tables, 'table')} ORDER BY position").result_rows:
+                columns.setdefault((database, table), []).append((name, type_, kind, expression))
+        return {"create": create, "columns": columns}
+
+    fetched = {r["host"]: r for r in on_replicas([r for r in replicas if r["host"] in wanted], fetch, conn)}
+    ddl = []
+    for obj in divergent:
+        key = (obj["database"], obj["table"])
+        reference = fetched[obj["reference_host"]]
+        if reference.get("error"):
+            continue
+        full_name = f"{obj['database']}.{obj['table']}" if obj["table"] else obj["database"]
+        for host, kind in obj["hosts"].items():
+            if kind == "missing":
+                statement = reference["create"].get(key, "")
+                statement = statement.replace("CREATE TABLE ", "CREATE TABLE IF NOT EXISTS ", 1).replace(
+                    "CREATE DATABASE ", "CREATE DATABASE IF NOT EXISTS ", 1)
+                ddl.append({"host": host, "statement": statement, "comment": f"{full_name} is missing"})
+            elif kind == "columns" and not fetched[host].get("error"):
+                for statement in column_ddl(full_name, reference["columns"].get(key, []), fetched[host]["columns"].get(key, [])):
+                    ddl.append({"host": host, "statement": statement, "comment": f"{full_name} columns differ"})
+            else:
+                ddl.append({"host": host, "statement": reference["create"].get(key, ""),
+                            "comment": f"{full_name} definition differs, recreate from reference {obj['reference_host']}"})
+    return ddl
+
+
+def column_ddl(full_name, expected, actual):
+    statements = []
+    current = {c[0]: c for c in actual}
+    previous = None
+    for column in expected:
+        default = f" {column[2]} {column[3]}" if column[2] else ""
+        if column[0] not in current:
+            after = f" AFTER {previous}" if previous else " FIRST"
+            statements.append(f"ALTER TABLE {full_name} ADD COLUMN {column[0]} {column[1]}{default}{after}")
+        elif current[column[0]] != column:
+            statements.append(f"ALTER TABLE {full_name} MODIFY COLUMN {column[0]} {column[1]}{default}")
+        previous = column[0]
+    expected_names = {c[0] for c in expected}
+    for column in actual:
+        if column[0] not in expected_names:
+            statements.append(f"ALTER TABLE {full_name} DROP COLUMN {column[0]}")
+    return statements
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "cluster": {"type": "str", "required": True},
+        "databases": {"type": "list", "required": False},
+        "ignore_patterns": {"type": "list", "required": False},
+        "reference_host": {"type": "str", "required": False},
+        "ddl": {"type": "bool", "default": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    cluster = module.params["cluster"]
+    databases = module.params["databases"]
+    patterns = IGNORE_PATTERNS + (module.params["ignore_patterns"] or [])
+    retry = retry_params(module.params)
+    conn = {"username": login_user, "password": login_password, "port": port, "retry": retry}
+
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+        replicas = get_replicas(ch_client, cluster)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    schemas = collect_schemas(replicas, conn, databases, patterns)
+    errors = [{"host": s["host"], "error": s["error"]} for s in schemas if s.get("error")]
+    divergent, objects = find_drift(schemas, module.params["reference_host"])
+    result = {"changed": False, "objects": objects, "divergent": divergent, "errors": errors}
+    if module.params["ddl"] and divergent:
+        result["ddl"] = corrective_ddl(replicas, conn, divergent)
+    result["msg"] = f"{len(divergent)} of {objects} objects diverge across {len(schemas) - len(errors)} replicas"
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
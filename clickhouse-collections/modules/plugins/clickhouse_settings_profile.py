@@ -0,0 +1,307 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_settings_profile
+short_description: создание и изменение профилей настроек в clickhouse с ограничениями MIN/MAX
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    name:
+        description:
+            имя профиля настроек
+        required: true
+        aliases: [profile]
+        type: str
+    check:
+        description:
+            прверить, существует ли указанный профиль на сервере clickhouse.
+            Возвращает результат в __имя_переменной__.exists в виде булевого значения.
+        default: false
+        type: bool
+    state:
+        description:
+            если состояние установлено 'present'(по умолчанию), то указанный профиль будет создан или изменён,
+            если установлено 'abscent', то указанный профиль будет удалён.
+        default: present
+        choices: [abscent, present]
+        type: str
+    cluster:
+        description:
+            название кластера clickhouse, на котором будут выполнены операции. Если не указан,
+            то операции будут выполнены только на целевой ноде, указанной при запуске ansible-playbook.
+        required: false
+        type: str
+    settings:
+        description:
+            настройки профиля. Значение задаётся числом или строкой, либо словарём с ключами value, min, max
+            и writability (readonly, const, writable, changeable_in_readonly).
+            Если параметр не задан, то настройки существующего профиля не изменяются, пустой словарь
+            без inherit удаляет все настройки профиля. Значения сравниваются с текущими после приведения
+            сервером (например 10G и 10000000000 считаются одинаковыми).
+        required: false
+        type: dict
+    inherit:
+        description:
+            профили, от которых наследуются настройки
+        required: false
+        type: list
+    assign_to:
+        description:
+            пользователи и роли, которым назначается профиль. Значение 'NONE' снимает профиль со всех,
+            'ALL' назначает всем. Если параметр не задан, то назначения существующего профиля не изменяются.
+        required: false
+        type: list
+'''
+
+EXAMPLES = r'''
+- name: профиль аналитиков с ограничениями памяти и потоков, назначенный ролям analysts и bi
+    clickhouse_settings_profile:
+      name: analysts
+      settings:
+        max_memory_usage:
+          value: 10000000000
+          min: 1000000000
+          max: 20000000000
+        max_threads:
+          value: 8
+          max: 16
+        max_execution_time: 600
+        readonly:
+          value: 1
+          writability: const
+      assign_to:
+        - analysts
+        - bi
+      cluster: my_cluster
+
+- name: удалить профиль
+    clickhouse_settings_profile:
+      name: analysts
+      cluster: my_cluster
+      state: abscent
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import format_setting, quote
+
+
+WRITABILITY = {"readonly": "CONST", "const": "CONST", "writable": "WRITABLE", "changeable_in_readonly": "CHANGEABLE_IN_READONLY"}
+
+
+def plain_value(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return str(int(value))
+    return str(value)
+
+
+def server_values(ch_client, values):
+    # значения в том виде, в котором их хранит сервер (10G -> 10000000000, True -> 1 или true):
+    # значения применяются как настройки запроса и читаются обратно из system.settings.
+    # Если сервер не принял настройки (например, из-за ограничений пользователя), сравниваются значения как есть
+    if not values:
+        return {}
+    query = ("SELECT name, value FROM system.settings WHERE name IN (" + ", ".join(quote(name) for name in values) + ") "
+             "SETTINGS " + ", ".join(f"{name} = {format_setting(value)}" for name, value in values.items()))
+    try:
+        normalized = dict(ch_client.query(query).result_rows)
+    except Exception:
+        normalized = {}
+    return {name: normalized.get(name, plain_value(value)) for name, value in values.items()}
+
+
+def desired_elements(ch_client, settings, inherit):
+    elements = set()
+    for profile in inherit or []:
+        elements.add(("PROFILE", profile, None, None, None))
+    specs = {name: spec if isinstance(spec, dict) else {"value": spec} for name, spec in (settings or {}).items()}
+    normalized = {key: server_values(ch_client, {name: spec[key] for name, spec in specs.items() if spec.get(key) is not None})
+                  for key in ("value", "min", "max")}
+    for name, spec in specs.items():
+        writability = WRITABILITY[spec["writability"].lower()] if spec.get("writability") else None
+        elements.add((name, normalized["value"].get(name), normalized["min"].get(name), normalized["max"].get(name), writability))
+    return elements
+
+
+def current_profile(ch_client, name):
+    rows = ch_client.query(f"SELECT apply_to_all, apply_to_list FROM system.settings_profiles WHERE name = '{name}'").result_rows
+    if not rows:
+        return None
+    assigned = ["ALL"] if rows[0][0] else sorted(rows[0][1]) or ["NONE"]
+    elements = set()
+    for row in ch_client.query(
+            "SELECT setting_name, value, min, max, writability, inherit_profile "
+            f"FROM system.settings_profile_elements WHERE profile_name = '{name}'").result_rows:
+        if row[5]:
+            elements.add(("PROFILE", row[5], None, None, None))
+        else:
+            elements.add((row[0], row[1], row[2], row[3], row[4]))
+    return {"elements": elements, "assigned": assigned}
+
+
+def settings_clause(settings, inherit):
+    settings_kit = [f"PROFILE '{profile}'" for profile in inherit or []]
+    for name, spec in (settings or {}).items():
+        if not isinstance(spec, dict):
+            spec = {"value": spec}
+        fragment = [name]
+        if spec.get("value") is not None:
+            fragment.append(f"= {format_setting(spec['value'])}")
+        if spec.get("min") is not None:
+            fragment.append(f"MIN {format_setting(spec['min'])}")
+        if spec.get("max") is not None:
+            fragment.append(f"MAX {format_setting(spec['max'])}")
+        if spec.get("writability"):
+            fragment.append(WRITABILITY[spec["writability"].lower()])
+        settings_kit.append(' '.join(fragment))
+    return "SETTINGS " + ", ".join(settings_kit)
+
+
+def is_profile_exists(ch_client, name):
+    return {"exists": ch_client.command(f"SELECT count(*) FROM system.settings_profiles WHERE name = '{name}'") > 0}
+
+
+def create_profile(ch_client, module, name, cluster, settings, inherit, assign_to):
+    current = current_profile(ch_client, name)
+    manage_settings = settings is not None or inherit is not None
+    if current is not None:
+        same_settings = not manage_settings or current["elements"] == desired_elements(ch_client, settings, inherit)
+        same_assign = assign_to is None or current["assigned"] == sorted(assign_to)
+        if same_settings and same_assign:
+            return {"changed": False, "msg": f"Settings profile '{name}' is up to date"}
+    query_fragments = [f"{'ALTER' if current else 'CREATE'} SETTINGS PROFILE {name}"]
+    if cluster:
+        query_fragments.append(f"ON CLUSTER {cluster}")
+    if manage_settings and (settings or inherit):
+        query_fragments.append(settings_clause(settings, inherit))
+    elif manage_settings and current:
+        # settings: {} без inherit - убрать все настройки существующего профиля
+        query_fragments.append("SETTINGS NONE")
+    if assign_to is not None:
+        query_fragments.append(f"TO {', '.join(assign_to)}")
+    query = ' '.join(query_fragments)
+    try:
+        ch_client.command(query)
+    except Exception as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+    return {"changed": True, "msg": f"Settings profile '{name}' {'changed' if current else 'created'}"}
+
+
+def drop_profile(ch_client, module, name, cluster):
+    if not is_profile_exists(ch_client, name)["exists"]:
+        return {"changed": False, "msg": f"Settings profile '{name}' does not exist"}
+    query = f"DROP SETTINGS PROFILE IF EXISTS {name}"
+    if cluster:
+        query += f" ON CLUSTER {cluster}"
+    try:
+        ch_client.command(query)
+    except Exception as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+    return {"changed": True, "msg": f"Settings profile '{name}' deleted"}
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "name": {"type": "str", "required": True, "aliases": ["profile"]},
+        "check": {"type": "bool", "default": False},
+        "state": {"type": "str", "default": "present", "choices": ["abscent", "present"]},
+        "cluster": {"type": "str", "required": False},
+        "settings": {"type": "dict", "required": False},
+        "inherit": {"type": "list", "required": False},
+        "assign_to": {"type": "list", "required": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    name = module.params["name"]
+    check = module.params["check"]
+    state = module.params["state"]
+    cluster = module.params["cluster"]
+    settings = module.params["settings"]
+    inherit = module.params["inherit"]
+    assign_to = module.params["assign_to"]
+
+    retry = retry_params(module.params)
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    if check:
+        module.exit_json(**is_profile_exists(ch_client, name))
+
+    if state == 'present':
+        result = create_profile(ch_client, module, name, cluster, settings, inherit, assign_to)
+    else:
+        result = drop_profile(ch_client, module, name, cluster)
+
+    result.update(ch_client.ddl_queue_report())
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_storage
+short_description: политики хранения clickhouse - правила TTL TO VOLUME и перенос старых партиций между томами
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description: >-
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description: >-
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description: >-
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description: >-
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    database:
+        description: >-
+            база данных таблицы
+        required: false
+        aliases: [db]
+        type: str
+    table:
+        description: >-
+            таблица, для которой задаются правила TTL или переносятся партиции. Если не указана, то модуль
+            только возвращает политики хранения и диски.
+        required: false
+        type: str
+    cluster:
+        description: >-
+            название кластера clickhouse. Правила TTL изменяются запросом ON CLUSTER, партиции переносятся
+            на каждой реплике кластера. Если не указан, то операции выполняются только на целевой ноде.
+        required: false
+        type: str
+    ttl_moves:
+        description: >-
+            правила переноса данных таблицы, каждое задаётся словарём с ключами expression и volume или disk,
+            например {expression: 'ts + INTERVAL 30 DAY', volume: cold}. Правила TTL таблицы заменяются целиком,
+            только если отличаются от текущих.
+        required: false
+        type: list
+        elements: dict
+        suboptions:
+            expression:
+                description: выражение TTL, например 'ts + INTERVAL 30 DAY'
+                required: true
+                type: str
+            volume:
+                description: том политики хранения, на который переносятся данные. Задаётся volume или disk.
+                required: false
+                type: str
+            disk:
+                description: диск политики хранения, на который переносятся данные. Задаётся volume или disk.
+                required: false
+                type: str
+    ttl_delete:
+        description: >-
+            выражение TTL удаления данных таблицы, добавляемое после правил переноса
+        required: false
+        type: str
+    materialize_ttl:
+        description: >-
+            применить изменённые правила TTL к уже существующим кускам. По умолчанию новые правила действуют
+            только для новых кусков и слияний, чтобы изменение TTL не запускало тяжёлую мутацию.
+        default: false
+        type: bool
+    move_to_volume:
+        description: >-
+            том политики хранения таблицы, на который переносятся старые партиции
+        required: false
+        type: str
+    move_older_than:
+        description: >-
+            переносить партиции, самые свежие данные которых старше указанного количества дней
+            (по столбцу даты/времени ключа партиционирования)
+        required: false
+        type: int
+    max_moves:
+        description: >-
+            максимальное количество партиций, переносимых на одной реплике за один запуск модуля
+        default: 20
+        type: int
+    max_concurrency:
+        description: >-
+            максимальное количество одновременно выполняемых переносов на всех репликах
+        default: 2
+        type: int
+    max_per_replica:
+        description: >-
+            максимальное количество одновременно выполняемых переносов на одной реплике
+        default: 1
+        type: int
+    max_bytes_per_sec:
+        description: >-
+            средняя скорость переноса в байтах в секунду на все реплики. Очередной перенос начинается не раньше,
+            чем объём уже начатых переносов укладывается в этот бюджет.
+        required: false
+        type: int
+'''
+
+EXAMPLES = r'''
+- name: политики хранения и заполненность дисков
+    clickhouse_storage:
+  register: storage
+
+- name: переносить данные events старше 30 дней на том cold, удалять старше года
+    clickhouse_storage:
+      database: test_db
+      table: events
+      cluster: my_cluster
+      ttl_moves:
+        - expression: ts + INTERVAL 30 DAY
+          volume: cold
+      ttl_delete: ts + INTERVAL 365 DAY
+
+- name: перенести уже накопленные партиции старше 30 дней, не больше 100 МБ/с
+    clickhouse_storage:
+      database: test_db
+      table: events
+      cluster: my_cluster
+      move_to_volume: cold
+      move_older_than: 30
+      max_bytes_per_sec: 104857600
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+policies:
+    description:
+        политики хранения - имя политики, тома в порядке приоритета с дисками, типом, max_data_part_size и move_factor
+    returned: success
+    type: dict
+disks:
+    description:
+        диски целевой ноды - путь, тип, свободное и общее место в байтах
+    returned: success
+    type: list
+ttl:
+    description:
+        текущее и требуемое правило TTL таблицы
+    returned: ttl_moves or ttl_delete
+    type: dict
+moved:
+    description:
+        перенесённые партиции - хост, партиция, размер в байтах, время переноса в секундах или ошибка
+    returned: move_to_volume
+    type: list
+in_progress:
+    description:
+        выполняющиеся переносы кусков таблицы из system.moves - хост, кусок, целевой диск, размер, время выполнения
+    returned: table
+    type: list
+'''
+
+import re
+import threading
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_cluster import get_replicas, on_replicas, run_bounded
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import quote
+
+
+TABLE_TTL = re.compile(r"\sTTL\s(.+?)(?:\sSETTINGS\s.*)?$", re.DOTALL)
+
+
+class Budget:
+    # ограничение средней скорости переноса: каждый перенос занимает окно bytes / rate секунд,
+    # следующий начинается не раньше, чем закончится окно предыдущего
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            start = max(time.monotonic(), self.next_slot)
+            self.next_slot = start + size / float(self.rate)
+        time.sleep(max(0, start - time.monotonic()))
+
+
+def storage_policies(ch_client):
+    policies = {}
+    for policy, volume, priority, disks, volume_type, max_part, move_factor in ch_client.query(
+            "SELECT policy_name, volume_name, volume_priority, disks, volume_type, max_data_part_size, move_factor "
+            "FROM system.storage_policies ORDER BY policy_name, volume_priority").result_rows:
+        policies.setdefault(policy, []).append({"volume": volume, "priority": priority, "disks": list(disks),
+                                                "type": str(volume_type), "max_data_part_size": max_part, "move_factor": move_factor})
+    return policies
+
+
+def disks(ch_client):
+    return [{"name": r[0], "path": r[1], "type": r[2], "free_space": r[3], "total_space": r[4]}
+            for r in ch_client.query("SELECT name, path, type, free_space, total_space FROM system.disks ORDER BY name").result_rows]
+
+
+def desired_ttl(ttl_moves, ttl_delete):
+    rules = []
+    for rule in ttl_moves or []:
+        if rule.get("volume"):
+            rules.append(f"{rule['expression']} TO VOLUME {quote(rule['volume'])}")
+        else:
+            rules.append(f"{rule['expression']} TO DISK {quote(rule['disk'])}")
+    if ttl_delete:
+        rules.append(f"{ttl_delete} DELETE")
+    return ', '.join(rules)
+
+
+def formatted_ttl(ch_client, full_name, ttl):
+    # clickhouse хранит TTL в собственном форматировании (INTERVAL 30 DAY -> toIntervalDay(30)),
+    # поэтому обе стороны сравниваются после форматирования сервером
+    if not ttl:
+        return ""
+    try:
+        return ch_client.command(f"SELECT formatQuerySingleLine({quote(f'ALTER TABLE {full_name} MODIFY TTL {ttl}')})")
+    except Exception:
+        return ' '.join(ttl.split())
+
+
+def set_ttl(ch_client, module, full_name, policy, policies, cluster, ttl_moves, ttl_delete, materialize_ttl):
+    volumes = {v["volume"] for v in policies.get(policy, [])}
+    disk_names = {d for v in policies.get(policy, []) for d in v["disks"]}
+    for rule in ttl_moves or []:
+        if (rule.get("volume") and rule["volume"] not in volumes) or (not rule.get("volume") and rule.get("disk") not in disk_names):
+            return module.fail_json(msg=f"Rule {rule} does not match storage policy '{policy}' of table {full_name}")
+    create_query = ch_client.command(f"SELECT create_table_query FROM system.tables WHERE database || '.' || name = {quote(full_name)}")
+    match = TABLE_TTL.search(create_query.split(" ENGINE = ", 1)[-1])
+    current = match.group(1) if match else ""
+    desired = desired_ttl(ttl_moves, ttl_delete)
+    ttl = {"current": current, "desired": desired}
+    if formatted_ttl(ch_client, full_name, current) == formatted_ttl(ch_client, full_name, desired):
+        return False, ttl
+    query_fragments = [f"ALTER TABLE {full_name}"]
+    if cluster:
+        query_fragments.append(f"ON CLUSTER {cluster}")
+    query_fragments.append(f"MODIFY TTL {desired}")
+    query = ' '.join(query_fragments)
+    try:
+        ch_client.command(query, settings={"materialize_ttl_after_modify": int(materialize_ttl)})
+    except Exception as e:
+        return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+    return True, ttl
+
+
+def move_candidates(replicas, conn, database, table, target_disks, older_than, max_moves):
+    query = (
+        "SELECT partition_id, any(partition), sum(bytes_on_disk), "
+        "greatest(toDateTime(max(max_date)), max(max_time)) AS newest, groupUniqArray(disk_name) AS disks "
+        f"FROM system.parts WHERE active AND database = {quote(database)} AND table = {quote(table)} "
+        f"GROUP BY partition_id HAVING newest > toDateTime(0) AND newest < now() - INTERVAL {older_than} DAY "
+        f"AND arrayExists(d -> NOT has([{', '.join(quote(d) for d in target_disks)}], d), disks) "
+        "ORDER BY newest")
+    free_query = f"SELECT sum(free_space) FROM system.disks WHERE name IN ({', '.join(quote(d) for d in target_disks)})"
+
+    def collect(ch_client, replica):
+        free = ch_client.command(free_query)
+        partitions = []
+        for partition_id, partition, size, newest, _ in ch_client.query(query).result_rows:
+            # партиции, для которых не хватает места на целевом томе, остаются на месте
+            if size > free or len(partitions) >= max_moves:
+                continue
+            free -= size
+            partitions.append({"partition_id": partition_id, "partition": partition, "bytes": size, "newest": str(newest)})
+        return {"partitions": partitions}
+
+    collected = on_replicas(replicas, collect, conn)
+    errors = [{"host": r["host"], "error": r["error"]} for r in collected if r.get("error")]
+    tasks = [dict(p, host=r["host"]) for r in collected for p in r.get("partitions", [])]
+    return tasks, errors
+
+
+def move_partitions(tasks, conn, full_name, volume, max_concurrency, max_per_replica, max_bytes_per_sec):
+    budget = Budget(max_bytes_per_sec)
+
+    def move(ch_client, task):
+        budget.acquire(task["bytes"])
+        started = time.monotonic()
+        ch_client.command(f"ALTER TABLE {full_name} MOVE PARTITION ID {quote(task['partition_id'])} TO VOLUME {quote(volume)}")
+        return {"duration": round(time.monotonic() - started, 3)}
+
+    return run_bounded(tasks, move, conn, max_concurrency, max_per_replica)
+
+
+def moves_in_progress(replicas, conn, database, table):
+    def collect(ch_client, replica):
+        return {"moves": [{"part_name": r[0], "target_disk": r[1], "part_size": r[2], "elapsed": round(r[3], 3)}
+                          for r in ch_client.query(
+                              "SELECT part_name, target_disk_name, part_size, elapsed FROM system.moves "
+                              f"WHERE database = {quote(database)} AND table = {quote(table)}").result_rows]}
+    return [dict(m, host=r["host"]) for r in on_replicas(replicas, collect, conn) for m in r.get("moves", [])]
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "database": {"type": "str", "required": False, "aliases": ["db"]},
+        "table": {"type": "str", "required": False},
+        "cluster": {"type": "str", "required": False},
+        "ttl_moves": {"type": "list", "required": False, "elements": "dict",
+                      "options": {"expression": {"type": "str", "required": True},
+                                  "volume": {"type": "str", "required": False},
+                                  "disk": {"type": "str", "required": False}},
+                      "mutually_exclusive": [["volume", "disk"]],
+                      "required_one_of": [["volume", "disk"]]},
+        "ttl_delete": {"type": "str", "required": False},
+        "materialize_ttl": {"type": "bool", "default": False},
+        "move_to_volume": {"type": "str", "required": False},
+        "move_older_than": {"type": "int", "required": False},
+        "max_moves": {"type": "int", "default": 20},
+        "max_concurrency": {"type": "int", "default": 2},
+        "max_per_replica": {"type": "int", "default": 1},
+        "max_bytes_per_sec": {"type": "int", "required": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        required_by={"table": "database"},
+        required_together=[["move_to_volume", "move_older_than"]],
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    database = module.params["database"]
+    table = module.params["table"]
+    cluster = module.params["cluster"]
+    ttl_moves = module.params["ttl_moves"]
+    ttl_delete = module.params["ttl_delete"]
+    move_to_volume = module.params["move_to_volume"]
+    retry = retry_params(module.params)
+    conn = {"username": login_user, "password": login_password, "port": port, "retry": retry}
+
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+        if cluster:
+            replicas = get_replicas(ch_client, cluster)
+        else:
+            replicas = [{"shard_num": None, "replica_num": None, "host": host or "localhost", "is_local": True}]
+        policies = storage_policies(ch_client)
+        result = {"changed": False, "policies": policies, "disks": disks(ch_client)}
+        policy = ch_client.command(
+            f"SELECT storage_policy FROM system.tables WHERE database = {quote(database)} AND name = {quote(table)}") if table else None
+    except Exception as e:
+        return module.fail_json(to_native(e))
+    if not table:
+        result["msg"] = f"{len(policies)} storage policies, {len(result['disks'])} disks"
+        module.exit_json(**result)
+    if not policy:
+        return module.fail_json(msg=f"Table {database}.{table} does not exist or has no storage policy")
+    full_name = f"{database}.{table}"
+    messages = []
+
+    if ttl_moves or ttl_delete:
+        changed, result["ttl"] = set_ttl(ch_client, module, full_name, policy, policies, cluster, ttl_moves, ttl_delete,
+                                         module.params["materialize_ttl"])
+        result["changed"] = changed
+        messages.append(f"TTL {'changed' if changed else 'is up to date'}")
+
+    if move_to_volume:
+        volume = next((v for v in policies[policy] if v["volume"] == move_to_volume), None)
+        if volume is None:
+            return module.fail_json(msg=f"Volume '{move_to_volume}' is not in storage policy '{policy}' of table {full_name}", **result)
+        tasks, errors = move_candidates(replicas, conn, database, table, volume["disks"], module.params["move_older_than"],
+                                        module.params["max_moves"])
+        if errors:
+            return module.fail_json(msg="Error on collecting system.parts", errors=errors, **result)
+        moved = move_partitions(tasks, conn, full_name, move_to_volume, module.params["max_concurrency"],
+                                module.params["max_per_replica"], module.params["max_bytes_per_sec"])
+        result["moved"] = moved
+        result["changed"] = result["changed"] or any("duration" in m for m in moved)
+        failed = [m for m in moved if m.get("error")]
+        if failed:
+            return module.fail_json(msg=f"MOVE PARTITION failed for {len(failed)} partitions", **result)
+        messages.append(f"{len(moved)} partitions moved to volume '{move_to_volume}'")
+
+    result["in_progress"] = moves_in_progress(replicas, conn, database, table)
+    result["msg"] = ', '.join(messages) or f"Table {full_name} uses storage policy '{policy}'"
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ DOCUMENTATION = r'''
 ---
 module:
 short_description:
+extends_documentation_fragment: ch.modules.clickhouse_retry
 options:
     login_user:
         description:
@@ -145,11 +146,17 @@ msg:
         короткое сообщение, указывающее по произошедшие изменеия
     returned: success
     type: str
+ddl_queue:
+    description:
+        глубина очереди распределённого DDL кластера и суммарное время ожидания её освобождения в секундах
+    returned: ddl_queue_high_water
+    type: dict
 '''
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_native
-from clickhouse_connect import get_client
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import format_setting
 
 def is_user_exists(ch_client, name):
     return {"exists": ch_client.command(f"SELECT count(*) FROM system.users WHERE name = '{name}'") > 0}
@@ -173,7 +180,7 @@ def create_user(ch_client, module, name, cluster, auth_type, auth, roles, databa
     if grantees:
         query_fragments.append(f"GRANTEES {','.join(grantees)}")
     if settings:
-        settings_kit = [f'{k}={v} READONLY' for k,v in settings.items()]
+        settings_kit = [f'{k}={format_setting(v)} READONLY' for k,v in settings.items()]
         query_fragments.append("SETTINGS " + ", ".join(settings_kit))
     query = ' '.join(query_fragments)
     #raise Exception(query)
@@ -214,6 +221,8 @@ def main():
         "settings": {"type": "dict", "required": False}
     }
 
+    module_args.update(retry_argument_spec())
+
     result = {
         "changed": False
     }
@@ -241,8 +250,9 @@ def main():
     grantees = module.params["grantees"]
     settings = module.params["settings"]
 
+    retry = retry_params(module.params)
     try:
-        ch_client = get_client(username=login_user, password=login_password, port=port, host=host)
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
     except Exception as e:
         return module.fail_json(to_native(e))
 
@@ -254,6 +264,7 @@ def main():
     else:
         result = drop_user(ch_client, module, name, cluster)
 
+    result.update(ch_client.ddl_queue_report())
     module.exit_json(**result)
 
 
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: clickhouse_workload
+short_description: управление ресурсами и иерархией нагрузок (workload) планировщика clickhouse
+extends_documentation_fragment: ch.modules.clickhouse_retry
+options:
+    login_user:
+        description:
+            имя пользователя к сессии на сервере clickhouse,
+            по умолчанию подключение пользователем default
+        required: false
+        type: str
+    login_password:
+        description:
+            пароль пользователя для подключения к сессии на сервере clickhouse,
+            по умолчанию не задан
+        required: false
+        type: str
+    port:
+        description:
+            порт для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 8123
+        required: false
+        type: int
+    host:
+        description:
+            хост для подключения к сессии на сервере clickhouse,
+            по умолчанию используется 'localhost'
+        required: false
+        type: str
+    cluster:
+        description:
+            название кластера clickhouse, на котором будут выполнены операции. Если не указан,
+            то операции будут выполнены только на целевой ноде, указанной при запуске ansible-playbook.
+        required: false
+        type: str
+    state:
+        description:
+            если состояние установлено 'present'(по умолчанию), то указанные ресурсы и нагрузки будут созданы или изменены,
+            если установлено 'abscent', то указанные нагрузки и ресурсы будут удалены.
+        default: present
+        choices: [abscent, present]
+        type: str
+    resources:
+        description:
+            ресурсы планировщика, каждый задаётся словарём с ключами name и access - списком видов доступа,
+            например ['WRITE DISK s3', 'READ DISK s3'] или ['MASTER THREAD', 'WORKER THREAD']
+        required: false
+        type: list
+    workloads:
+        description:
+            нагрузки, каждая задаётся словарём с ключами name, parent (родительская нагрузка), settings
+            (weight, priority, max_requests, max_cost, max_speed, max_burst и т.д.) и resource_settings -
+            словарём настроек, действующих только для указанного ресурса (FOR resource).
+            Родительские нагрузки создаются раньше дочерних независимо от порядка в списке.
+        required: false
+        type: list
+    attach:
+        description:
+            назначение нагрузки пользователям и ролям через настройку workload (READONLY), каждое задаётся
+            словарём с ключами workload, users и roles. Те же назначения можно сделать параметром settings
+            модулей clickhouse_user и clickhouse_role.
+        required: false
+        type: list
+'''
+
+EXAMPLES = r'''
+- name: разделить дисковый ввод-вывод между дашбордами и ETL
+    clickhouse_workload:
+      cluster: my_cluster
+      resources:
+        - name: s3_write
+          access:
+            - WRITE DISK s3
+        - name: s3_read
+          access:
+            - READ DISK s3
+      workloads:
+        - name: all
+        - name: dashboards
+          parent: all
+          settings:
+            priority: 0
+            weight: 3
+        - name: etl
+          parent: all
+          settings:
+            priority: 1
+            max_requests: 10
+          resource_settings:
+            s3_write:
+              max_speed: 104857600
+      attach:
+        - workload: etl
+          users:
+            - etl_loader
+        - workload: dashboards
+          roles:
+            - bi
+
+- name: удалить нагрузки и ресурсы
+    clickhouse_workload:
+      cluster: my_cluster
+      workloads:
+        - name: etl
+        - name: dashboards
+        - name: all
+      resources:
+        - name: s3_write
+        - name: s3_read
+      state: abscent
+'''
+
+RETURN = r'''
+changed:
+    description:
+        статус, указывающий произошли ли изменения в результате выполнения операции
+    returned: success
+    type: bool
+msg:
+    description:
+        короткое сообщение, указывающее по произошедшие изменеия
+    returned: success
+    type: str
+executed_queries:
+    description:
+        выполненные запросы
+    returned: success
+    type: list
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_native
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client, retry_argument_spec, retry_params
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_sql import format_setting, quote
+
+
+def resource_query(resource):
+    return f"CREATE RESOURCE {resource['name']} ({', '.join(resource['access'])})"
+
+
+def workload_query(workload):
+    query = f"CREATE WORKLOAD {workload['name']}"
+    if workload.get("parent"):
+        query += f" IN {workload['parent']}"
+    settings_kit = [f"{k} = {format_setting(v)}" for k, v in (workload.get("settings") or {}).items()]
+    for resource, settings in (workload.get("resource_settings") or {}).items():
+        settings_kit += [f"{k} = {format_setting(v)} FOR {resource}" for k, v in settings.items()]
+    if settings_kit:
+        query += " SETTINGS " + ", ".join(settings_kit)
+    return query
+
+
+def parents_first(workloads):
+    # дочерняя нагрузка может быть создана только после родительской
+    names = {w["name"] for w in workloads}
+    ordered, done = [], set()
+    while len(ordered) < len(workloads):
+        ready = [w for w in workloads if w["name"] not in done and (not w.get("parent") or w["parent"] not in names or w["parent"] in done)]
+        if not ready:
+            raise ValueError(f"Workload hierarchy has a cycle: {sorted(names - done)}")
+        ordered += ready
+        done.update(w["name"] for w in ready)
+    return ordered
+
+
+def formatted(ch_client, query):
+    # определения сравниваются после форматирования сервером, так как create_query хранится
+    # в каноническом виде clickhouse
+    return ch_client.command(f"SELECT formatQuerySingleLine({quote(query)})")
+
+
+def on_cluster(query, kind, name, cluster):
+    # CREATE WORKLOAD name -> CREATE OR REPLACE WORKLOAD name ON CLUSTER cluster
+    query = query.replace(f"CREATE {kind} {name}", f"CREATE OR REPLACE {kind} {name}", 1)
+    if cluster:
+        query = query.replace(f"{kind} {name}", f"{kind} {name} ON CLUSTER {cluster}", 1)
+    return query
+
+
+def create_entities(ch_client, module, table, kind, entities, make_query, cluster):
+    current = {r[0]: r[1] for r in ch_client.query(f"SELECT name, create_query FROM {table}").result_rows}
+    executed = []
+    for entity in entities:
+        query = make_query(entity)
+        if entity["name"] in current and formatted(ch_client, query) == formatted(ch_client, current[entity["name"]]):
+            continue
+        query = on_cluster(query, kind, entity["name"], cluster)
+        try:
+            ch_client.command(query)
+        except Exception as e:
+            return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+        executed.append(query)
+    return executed
+
+
+def drop_entities(ch_client, module, table, kind, names, cluster):
+    current = {r[0] for r in ch_client.query(f"SELECT name FROM {table}").result_rows}
+    executed = []
+    for name in names:
+        if name not in current:
+            continue
+        query = f"DROP {kind} IF EXISTS {name}"
+        if cluster:
+            query += f" ON CLUSTER {cluster}"
+        try:
+            ch_client.command(query)
+        except Exception as e:
+            return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+        executed.append(query)
+    return executed
+
+
+def attach_workloads(ch_client, module, attach, cluster):
+    current = {}
+    for user_name, role_name, value in ch_client.query(
+            "SELECT user_name, role_name, value FROM system.settings_profile_elements "
+            "WHERE setting_name = 'workload' AND (user_name IS NOT NULL OR role_name IS NOT NULL)").result_rows:
+        current[("USER", user_name) if user_name else ("ROLE", role_name)] = value
+    executed = []
+    for item in attach or []:
+        grantees = [("USER", u) for u in item.get("users") or []] + [("ROLE", r) for r in item.get("roles") or []]
+        for kind, name in grantees:
+            if current.get((kind, name)) == item["workload"]:
+                continue
+            # MODIFY SETTINGS меняет только настройку workload, не затрагивая остальные настройки пользователя или роли
+            query = f"ALTER {kind} {name}"
+            if cluster:
+                query += f" ON CLUSTER {cluster}"
+            query += f" MODIFY SETTINGS workload = {quote(item['workload'])} READONLY"
+            try:
+                ch_client.command(query)
+            except Exception as e:
+                return module.fail_json(to_native({"changed": False, "msg": f"{e}: Error on query: {query}"}))
+            executed.append(query)
+    return executed
+
+
+def main():
+
+    module_args = {
+        "login_user": {"type": "str", "required": False},
+        "login_password": {"type": "str", "required": False},
+        "port": {"type": "int", "required": False},
+        "host": {"type": "str", "required": False},
+        "cluster": {"type": "str", "required": False},
+        "state": {"type": "str", "default": "present", "choices": ["abscent", "present"]},
+        "resources": {"type": "list", "required": False},
+        "workloads": {"type": "list", "required": False},
+        "attach": {"type": "list", "required": False}
+    }
+
+    module_args.update(retry_argument_spec())
+
+    result = {
+        "changed": False
+    }
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        required_one_of=[["resources", "workloads", "attach"]],
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    login_user = module.params["login_user"]
+    login_password = module.params["login_password"]
+    port = module.params["port"]
+    host = module.params["host"]
+    cluster = module.params["cluster"]
+    state = module.params["state"]
+    resources = module.params["resources"] or []
+    workloads = module.params["workloads"] or []
+
+    retry = retry_params(module.params)
+    try:
+        ch_client = get_client(username=login_user, password=login_password, port=port, host=host, retry=retry)
+        workloads = parents_first(workloads)
+    except Exception as e:
+        return module.fail_json(to_native(e))
+
+    if state == 'present':
+        executed = create_entities(ch_client, module, "system.resources", "RESOURCE", resources, resource_query, cluster)
+        executed += create_entities(ch_client, module, "system.workloads", "WORKLOAD", workloads, workload_query, cluster)
+        executed += attach_workloads(ch_client, module, module.params["attach"], cluster)
+    else:
+        # нагрузки удаляются от дочерних к родительским, ресурсы - после всех нагрузок
+        executed = drop_entities(ch_client, module, "system.workloads", "WORKLOAD", [w["name"] for w in reversed(workloads)], cluster)
+        executed += drop_entities(ch_client, module, "system.resources", "RESOURCE", [r["name"] for r in resources], cluster)
+
+    result = {"changed": bool(executed), "executed_queries": executed,
+              "msg": f"{len(executed)} scheduler changes applied" if executed else "Workloads are up to date"}
+    result.update(ch_client.ddl_queue_report())
+    module.exit_json(**result)
+
+
+if __name__ == '__main__':
+    main()
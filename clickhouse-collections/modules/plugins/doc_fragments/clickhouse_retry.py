@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+
+class ModuleDocFragment(object):
+
+    DOCUMENTATION = r'''
+options:
+    retry_budget:
+        description:
+            общее время в секундах, в течение которого модуль повторяет запросы после временных ошибок
+            сервера (TOO_MANY_SIMULTANEOUS_QUERIES, потеря сессии keeper, сетевые ошибки и т.п.).
+            Ошибки запроса, которые не исправятся повтором, возвращаются сразу, с кодом ошибки сервера.
+            Запросы, которые нельзя выполнять дважды (INSERT, мутации, BACKUP, миграции), повторяются только
+            если сервер их точно не принял - соединение не было установлено или TOO_MANY_SIMULTANEOUS_QUERIES.
+        default: 120
+        type: int
+    retry_max_attempts:
+        description:
+            максимальное количество попыток выполнения одного запроса
+        default: 5
+        type: int
+    retry_base_delay:
+        description:
+            базовая задержка перед повтором в секундах. Задержка растёт экспоненциально с каждой попыткой,
+            фактическое значение выбирается случайно от 0 до текущего предела.
+        default: 0.5
+        type: float
+    retry_max_delay:
+        description:
+            максимальная задержка перед повтором в секундах
+        default: 30
+        type: float
+    breaker_threshold:
+        description:
+            количество временных ошибок подряд на одном сервере, после которого все задачи на этой машине
+            прекращают отправлять запросы на сервер на время breaker_cooldown
+        default: 5
+        type: int
+    breaker_cooldown:
+        description:
+            время в секундах, на которое прекращается отправка запросов на сервер после breaker_threshold ошибок
+        default: 30
+        type: int
+    ddl_queue_high_water:
+        description:
+            включить ожидание очереди распределённого DDL. Перед каждым запросом ON CLUSTER модуль проверяет
+            количество незавершённых задач кластера в system.distributed_ddl_queue и, если оно не меньше
+            заданного значения, ждёт с нарастающей задержкой. Макросы в имени кластера (ON CLUSTER '{cluster}')
+            раскрываются через getMacro. Если модуль отправил хотя бы один запрос ON CLUSTER, глубина очереди
+            и время ожидания возвращаются в __имя_переменной__.ddl_queue. По умолчанию очередь не проверяется.
+        required: false
+        type: int
+    ddl_queue_max_wait:
+        description:
+            максимальное время в секундах ожидания освобождения очереди распределённого DDL перед одним запросом
+        default: 600
+        type: int
+'''
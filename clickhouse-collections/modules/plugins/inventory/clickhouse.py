@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+name: clickhouse
+plugin_type: inventory
+short_description: инвентарь хостов и групп по топологии кластеров из system.clusters
+description:
+    - Получает шарды и реплики кластеров clickhouse из system.clusters и создаёт группы по кластеру,
+      шарду и номеру реплики.
+    - Для каждого хоста задаются переменные shard_num, replica_num, is_local и clickhouse_cluster,
+      которые можно передавать в параметр cluster модулей коллекции.
+    - Конфигурационный файл должен называться clickhouse.yml или clickhouse.yaml.
+extends_documentation_fragment:
+    - constructed
+    - inventory_cache
+options:
+    plugin:
+        description: имя плагина
+        required: true
+        choices: ['ch.modules.clickhouse']
+    host:
+        description: хост clickhouse, из system.clusters которого читается топология
+        default: localhost
+        type: str
+    port:
+        description: порт для подключения к сессии на сервере clickhouse
+        default: 8123
+        type: int
+    login_user:
+        description: имя пользователя к сессии на сервере clickhouse
+        default: default
+        type: str
+    login_password:
+        description: пароль пользователя для подключения к сессии на сервере clickhouse
+        default: ''
+        type: str
+    clusters:
+        description: кластеры, которые попадают в инвентарь. По умолчанию используются все кластеры.
+        default: []
+        type: list
+        elements: str
+'''
+
+EXAMPLES = r'''
+# clickhouse.yml
+plugin: ch.modules.clickhouse
+host: ch-1.example.com
+login_user: admin
+login_password: qwerty
+clusters:
+  - my_cluster
+cache: true
+cache_plugin: ansible.builtin.jsonfile
+cache_connection: /tmp/clickhouse_inventory
+cache_timeout: 600
+
+# изменения по одной реплике каждого шарда за раз:
+# - hosts: my_cluster_replica_1
+#   serial: 1
+'''
+
+from ansible.errors import AnsibleError
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable, Constructable
+
+try:
+    from clickhouse_connect import get_client
+    HAS_CLICKHOUSE_CONNECT = True
+except ImportError:
+    HAS_CLICKHOUSE_CONNECT = False
+
+
+class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
+
+    NAME = 'ch.modules.clickhouse'
+
+    def verify_file(self, path):
+        return super(InventoryModule, self).verify_file(path) and path.endswith(('clickhouse.yml', 'clickhouse.yaml'))
+
+    def _fetch_topology(self):
+        if not HAS_CLICKHOUSE_CONNECT:
+            raise AnsibleError("clickhouse_connect is required for the ch.modules.clickhouse inventory plugin")
+        ch_client = get_client(host=self.get_option('host'), port=self.get_option('port'),
+                               username=self.get_option('login_user'), password=self.get_option('login_password'))
+        query = "SELECT cluster, shard_num, replica_num, host_name, host_address, port, is_local FROM system.clusters"
+        clusters = self.get_option('clusters')
+        if clusters:
+            query += " WHERE cluster IN (" + ", ".join(f"'{c}'" for c in clusters) + ")"
+        query += " ORDER BY cluster, shard_num, replica_num"
+        rows = ch_client.query(query).result_rows
+        return [{"cluster": r[0], "shard_num": r[1], "replica_num": r[2], "host": r[3], "host_address": r[4],
+                 "port": r[5], "is_local": bool(r[6])} for r in rows]
+
+    def _populate(self, topology):
+        strict = self.get_option('strict')
+        for replica in topology:
+            cluster_group = self.inventory.add_group(self._sanitize_group_name(replica["cluster"]))
+            shard_group = self.inventory.add_group(
+                self._sanitize_group_name(f"{replica['cluster']}_shard_{replica['shard_num']}"))
+            replica_group = self.inventory.add_group(
+                self._sanitize_group_name(f"{replica['cluster']}_replica_{replica['replica_num']}"))
+            self.inventory.add_child(cluster_group, shard_group)
+            host = self.inventory.add_host(replica["host"], group=shard_group)
+            self.inventory.add_host(host, group=replica_group)
+
+            host_vars = self.inventory.get_host(host).vars
+            clusters = dict(host_vars.get("clickhouse_clusters", {}))
+            clusters[replica["cluster"]] = {"shard_num": replica["shard_num"], "replica_num": replica["replica_num"]}
+            self.inventory.set_variable(host, "clickhouse_clusters", clusters)
+            # переменные первого кластера хоста, для остальных кластеров значения берутся из clickhouse_clusters
+            if "clickhouse_cluster" not in host_vars:
+                self.inventory.set_variable(host, "clickhouse_cluster", replica["cluster"])
+                self.inventory.set_variable(host, "shard_num", replica["shard_num"])
+                self.inventory.set_variable(host, "replica_num", replica["replica_num"])
+                self.inventory.set_variable(host, "is_local", replica["is_local"])
+                self.inventory.set_variable(host, "clickhouse_host_address", replica["host_address"])
+                self.inventory.set_variable(host, "clickhouse_tcp_port", replica["port"])
+
+            host_vars = self.inventory.get_host(host).get_vars()
+            self._set_composite_vars(self.get_option('compose'), host_vars, host, strict=strict)
+            self._add_host_to_composed_groups(self.get_option('groups'), host_vars, host, strict=strict)
+            self._add_host_to_keyed_groups(self.get_option('keyed_groups'), host_vars, host, strict=strict)
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        self._read_config_data(path)
+
+        cache_key = self.get_cache_key(path)
+        user_cache_setting = self.get_option('cache')
+        topology = None
+        if user_cache_setting and cache:
+            try:
+                topology = self._cache[cache_key]
+            except KeyError:
+                topology = None
+        if topology is None:
+            try:
+                topology = self._fetch_topology()
+            except AnsibleError:
+                raise
+            except Exception as e:
+                raise AnsibleError(f"Error reading system.clusters: {e}")
+            if user_cache_setting:
+                self._cache[cache_key] = topology
+
+        self._populate(topology)
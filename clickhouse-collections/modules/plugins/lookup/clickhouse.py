@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+name: clickhouse
+short_description: чтение данных из clickhouse в шаблонах на управляющей машине
+description:
+    - Выполняет запросы на управляющей машине, без запуска модуля на целевом хосте.
+    - Подключения к серверам и результаты запросов (по запросу, параметрам и серверу) запоминаются в рамках
+      одной задачи - процесса ansible, выполняющего её, поэтому повторные обращения в цикле loop этой задачи
+      не выполняют запрос заново. Между задачами запомненные результаты не сохраняются.
+options:
+    _terms:
+        description: один или несколько запросов
+        required: true
+    host:
+        description: хост для подключения к сессии на сервере clickhouse
+        default: localhost
+        type: str
+    port:
+        description: порт для подключения к сессии на сервере clickhouse
+        default: 8123
+        type: int
+    login_user:
+        description: имя пользователя к сессии на сервере clickhouse
+        default: default
+        type: str
+    login_password:
+        description: пароль пользователя для подключения к сессии на сервере clickhouse
+        default: ''
+        type: str
+        no_log: true
+    db:
+        description: база данных, в которой выполняются запросы
+        default: default
+        type: str
+    parameters:
+        description: >-
+            параметры запроса, подставляемые на сервере, например {'id': 42} для запроса
+            "SELECT name FROM t WHERE id = {id:UInt64}"
+        type: dict
+    output:
+        description: >-
+            'scalar' - первое значение первой строки, 'rows' - список строк в виде словарей,
+            'columns' - словарь со списками значений каждого столбца
+        default: scalar
+        choices: [scalar, rows, columns]
+        type: str
+    cache:
+        description: запоминать результаты запросов в рамках задачи
+        default: true
+        type: bool
+'''
+
+EXAMPLES = r'''
+- name: количество пользователей
+  debug:
+    msg: "{{ lookup('ch.modules.clickhouse', 'SELECT count() FROM system.users', host='ch-1') }}"
+
+- name: создать роли для каждой базы данных
+  ch.modules.clickhouse_role:
+    name: "{{ item }}_reader"
+  loop: "{{ lookup('ch.modules.clickhouse', query, output='columns', host='ch-1')['name'] }}"
+  vars:
+    query: "SELECT name FROM system.databases WHERE name NOT IN ('system', 'INFORMATION_SCHEMA', 'information_schema')"
+
+- name: значение с параметром запроса
+  set_fact:
+    region: "{{ lookup('ch.modules.clickhouse', 'SELECT region FROM test_db.customers WHERE id = {id:UInt64}', parameters={'id': customer_id}) }}"
+'''
+
+RETURN = r'''
+_raw:
+    description: результат каждого запроса в виде, заданном параметром output
+    type: list
+'''
+
+import json
+import threading
+
+from ansible.errors import AnsibleError
+from ansible.plugins.lookup import LookupBase
+
+try:
+    from clickhouse_connect import get_client
+    HAS_CLICKHOUSE_CONNECT = True
+except ImportError:
+    HAS_CLICKHOUSE_CONNECT = False
+
+
+# подключения и результаты запросов процесса, выполняющего задачу: живут до конца задачи (всех итераций loop)
+_CLIENTS = {}
+_RESULTS = {}
+_LOCK = threading.Lock()
+
+
+def _client(host, port, login_user, login_password, db):
+    key = (host, port, login_user, login_password, db)
+    with _LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = get_client(host=host, port=port, username=login_user, password=login_password, database=db)
+        return key, _CLIENTS[key]
+
+
+def _format(result, output):
+    if output == 'scalar':
+        return result.result_rows[0][0] if result.result_rows else None
+    if output == 'columns':
+        return {name: list(values) for name, values in zip(result.column_names, result.result_columns)}
+    return [dict(zip(result.column_names, row)) for row in result.result_rows]
+
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables=None, **kwargs):
+        if not HAS_CLICKHOUSE_CONNECT:
+            raise AnsibleError("clickhouse_connect is required for the ch.modules.clickhouse lookup plugin")
+        self.set_options(var_options=variables, direct=kwargs)
+        output = self.get_option('output')
+        parameters = self.get_option('parameters') or {}
+        use_cache = self.get_option('cache')
+
+        try:
+            key, ch_client = _client(self.get_option('host'), self.get_option('port'), self.get_option('login_user'),
+                                     self.get_option('login_password'), self.get_option('db'))
+        except Exception as e:
+            raise AnsibleError(f"Error connecting to clickhouse: {e}")
+
+        ret = []
+        for query in terms:
+            cache_key = (key, query, json.dumps(parameters, sort_keys=True, default=str), output)
+            if use_cache and cache_key in _RESULTS:
+                ret.append(_RESULTS[cache_key])
+                continue
+            try:
+                with _LOCK:
+                    value = _format(ch_client.query(query, parameters=parameters or None), output)
+            except Exception as e:
+                raise AnsibleError(f"{e}: Error on query: {query}")
+            if use_cache:
+                _RESULTS[cache_key] = value
+            ret.append(value)
+        return ret
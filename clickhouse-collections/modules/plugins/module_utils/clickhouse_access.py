@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+
+class AccessGraph:
+    # снимок системы прав clickhouse: граф назначений ролей, выданные привилегии и иерархия привилегий.
+    # Все системные таблицы читаются один раз, дальнейшие вопросы решаются в памяти с мемоизацией
+
+    def __init__(self, ch_client, default_roles_only=False):
+        self.users = [r[0] for r in ch_client.query("SELECT name FROM system.users ORDER BY name").result_rows]
+        self.roles = [r[0] for r in ch_client.query("SELECT name FROM system.roles ORDER BY name").result_rows]
+        self.edges = {name: set() for name in self.users + self.roles}
+        for user_name, role_name, granted, is_default in ch_client.query(
+                "SELECT user_name, role_name, granted_role_name, granted_role_is_default FROM system.role_grants").result_rows:
+            if default_roles_only and user_name and not is_default:
+                continue
+            self.edges.setdefault(user_name or role_name, set()).add(granted)
+            self.edges.setdefault(granted, set())
+        self.grants = {}
+        for row in ch_client.query(
+                "SELECT coalesce(user_name, role_name), access_type, database, table, column, is_partial_revoke, grant_option "
+                "FROM system.grants").result_rows:
+            self.grants.setdefault(row[0], []).append({"access_type": row[1], "database": row[2], "table": row[3], "column": row[4],
+                                                       "is_partial_revoke": bool(row[5]), "grant_option": bool(row[6])})
+        self.children = {}
+        self.aliases = {}
+        for privilege, aliases, parent in ch_client.query(
+                "SELECT privilege, aliases, parent_group FROM system.privileges").result_rows:
+            self.children.setdefault(parent, []).append(privilege)
+            self.aliases[privilege.upper()] = privilege
+            for alias in aliases:
+                self.aliases[alias.upper()] = privilege
+        self._implied = {}
+        self._closure = {}
+        self.cycles = self._find_cycles()
+
+    def _find_cycles(self):
+        # компоненты сильной связности (алгоритм Тарьяна): роли внутри одной компоненты
+        # получают права друг друга, поэтому замыкание считается для компоненты целиком
+        index, low, stack, on_stack, self.component = {}, {}, [], set(), {}
+        cycles = []
+
+        def visit(node):
+            index[node] = low[node] = len(index)
+            stack.append(node)
+            on_stack.add(node)
+            for target in self.edges.get(node, ()):
+                if target not in index:
+                    visit(target)
+                    low[node] = min(low[node], low[target])
+                elif target in on_stack:
+                    low[node] = min(low[node], index[target])
+            if low[node] == index[node]:
+                members = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    members.append(member)
+                    if member == node:
+                        break
+                for member in members:
+                    self.component[member] = node
+                if len(members) > 1 or node in self.edges.get(node, ()):
+                    cycles.append(sorted(members))
+
+        for node in sorted(self.edges):
+            if node not in index:
+                visit(node)
+        self.members = {}
+        for member, root in self.component.items():
+            self.members.setdefault(root, set()).add(member)
+        return cycles
+
+    def closure(self, name):
+        # все роли, права которых действуют для пользователя или роли name, включая её саму
+        root = self.component.get(name, name)
+        if root not in self._closure:
+            members = self.members.get(root, {name})
+            result = set(members)
+            for member in members:
+                for target in self.edges.get(member, ()):
+                    if self.component.get(target, target) != root:
+                        result |= self.closure(target)
+            self._closure[root] = frozenset(result)
+        return self._closure[root]
+
+    def implied(self, privilege):
+        # привилегия и все привилегии, которые она включает (ALL -> SELECT, ALTER -> ALTER UPDATE и т.д.)
+        if privilege not in self._implied:
+            result = {privilege}
+            for child in self.children.get(privilege, []):
+                result |= self.implied(child)
+            self._implied[privilege] = frozenset(result)
+        return self._implied[privilege]
+
+    def canonical(self, privilege):
+        return self.aliases.get(privilege.strip().upper(), privilege.strip().upper())
+
+    def effective_grants(self, name):
+        grants = []
+        for grantee in sorted(self.closure(name)):
+            for grant in self.grants.get(grantee, []):
+                grants.append(dict(grant, via=grantee))
+        return grants
+
+    def can(self, name, privilege, database=None, table=None, column=None):
+        # частичный отзыв действует только на права той роли, у которой он сделан,
+        # итоговые права - объединение прав всех ролей замыкания
+        privilege = self.canonical(privilege)
+        for grantee in self.closure(name):
+            matched = [g for g in self.grants.get(grantee, [])
+                       if privilege in self.implied(g["access_type"]) and covers(g, database, table, column)]
+            if matched and not any(g["is_partial_revoke"] for g in matched):
+                return True
+        return False
+
+    def who_can(self, privilege, database=None, table=None, column=None):
+        return {"users": [u for u in self.users if self.can(u, privilege, database, table, column)],
+                "roles": [r for r in self.roles if self.can(r, privilege, database, table, column)]}
+
+
+def covers(grant, database, table, column):
+    # пустые database/table/column в system.grants означают привилегию на все объекты уровня
+    for scope, target in ((grant["database"], database), (grant["table"], table), (grant["column"], column)):
+        if scope is not None and scope != target:
+            return False
+    return True
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, zip_longest
+
+from ansible_collections.ch.modules.plugins.module_utils.clickhouse_exec import get_client
+
+
+def get_replicas(ch_client, cluster):
+    # все реплики всех шардов кластера в порядке shard_num, replica_num
+    rows = ch_client.query(
+        "SELECT shard_num, replica_num, host_name, is_local FROM system.clusters "
+        f"WHERE cluster = '{cluster}' ORDER BY shard_num, replica_num").result_rows
+    return [{"shard_num": r[0], "replica_num": r[1], "host": r[2], "is_local": bool(r[3])} for r in rows]
+
+
+def on_replicas(replicas, func, conn, max_workers=None):
+    # func(ch_client, replica) выполняется параллельно, на каждую реплику открывается своё подключение,
+    # так как сессия clickhouse_connect не допускает конкурентных запросов.
+    # conn - параметры подключения get_client (username, password, port), хост берётся из реплики
+    def run(replica):
+        try:
+            ch_client = get_client(host=replica["host"], **conn)
+            return dict(replica, **func(ch_client, replica))
+        except Exception as e:
+            return dict(replica, error=str(e))
+
+    if not replicas:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers or len(replicas)) as pool:
+        return list(pool.map(run, replicas))
+
+
+def run_bounded(tasks, func, conn, max_workers, max_per_host=1):
+    # func(ch_client, task) выполняется пулом из max_workers потоков, но не более max_per_host задач
+    # одновременно на одном хосте (task["host"]). Подключение к хосту переиспользуется внутри потока.
+    # Результаты возвращаются в исходном порядке задач.
+    if not tasks:
+        return []
+    host_slots = {task["host"]: threading.BoundedSemaphore(max_per_host) for task in tasks}
+    local = threading.local()
+
+    def run(task):
+        with host_slots[task["host"]]:
+            try:
+                clients = local.__dict__.setdefault("clients", {})
+                if task["host"] not in clients:
+                    clients[task["host"]] = get_client(host=task["host"], **conn)
+                return dict(task, **func(clients[task["host"]], task))
+            except Exception as e:
+                return dict(task, error=str(e))
+
+    # задачи чередуются по хостам, чтобы потоки пула не простаивали в ожидании одного хоста
+    by_host = {}
+    for n, task in enumerate(tasks):
+        by_host.setdefault(task["host"], []).append((n, task))
+    order = [item for item in chain.from_iterable(zip_longest(*by_host.values())) if item]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(run, [task for _, task in order]))
+    ordered = [None] * len(tasks)
+    for (n, _), res in zip(order, results):
+        ordered[n] = res
+    return ordered
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import fcntl
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+import clickhouse_connect
+from clickhouse_connect.driver.exceptions import OperationalError
+
+
+# коды ошибок сервера, после которых запрос имеет смысл повторить: перегрузка сервера,
+# сетевые сбои, потеря сессии zookeeper/keeper и временные состояния реплик
+RETRYABLE_CODES = {
+    32: "ATTEMPT_TO_READ_AFTER_EOF",
+    202: "TOO_MANY_SIMULTANEOUS_QUERIES",
+    203: "NO_FREE_CONNECTION",
+    209: "SOCKET_TIMEOUT",
+    210: "NETWORK_ERROR",
+    225: "NO_ZOOKEEPER",
+    242: "TABLE_IS_READ_ONLY",
+    279: "ALL_CONNECTION_TRIES_FAILED",
+    285: "TOO_FEW_LIVE_REPLICAS",
+    425: "SYSTEM_ERROR",
+    439: "CANNOT_SCHEDULE_TASK",
+    473: "DEADLOCK_AVOIDED",
+    517: "CANNOT_ASSIGN_ALTER",
+    999: "KEEPER_EXCEPTION",
+}
+
+# ошибки, после которых сервер гарантированно не начинал выполнять запрос: только их можно
+# повторять для неидемпотентных запросов (INSERT ... SELECT, мутации, BACKUP, миграции)
+NOT_EXECUTED_CODES = {202: "TOO_MANY_SIMULTANEOUS_QUERIES"}
+NOT_SENT = re.compile(r"Connection refused|NewConnectionError|Failed to establish a new connection|"
+                      r"Name or service not known|Temporary failure in name resolution", re.IGNORECASE)
+
+TIMEOUT_EXCEEDED = 159
+DDL_TASK_TIMEOUT = re.compile(r"Watching task (\S*/(query-\d+)) is executing longer than distributed_ddl_task_timeout")
+ERROR_CODE = re.compile(r"Code: (\d+)")
+ON_CLUSTER = re.compile(r"\bON\s+CLUSTER\s+(?:'([^']+)'|\"([^\"]+)\"|`([^`]+)`|([\w.-]+))", re.IGNORECASE)
+MACRO = re.compile(r"\{(\w+)\}")
+BREAKER_DIR = os.path.join(tempfile.gettempdir(), "ansible-clickhouse-breaker")
+# запросы модулей коллекции помечаются в system.query_log как ch.modules.<имя модуля>
+LOG_COMMENT = "ch.modules." + re.sub(r"^AnsiballZ_|\.py$", "", os.path.basename(sys.argv[0] or "ansible"))
+
+
+class QueryError(Exception):
+
+    def __init__(self, message, code=None, query=None):
+        super(QueryError, self).__init__(message)
+        self.code = code
+        self.query = query
+
+
+class CircuitOpenError(QueryError):
+    pass
+
+
+def retry_argument_spec():
+    return {
+        "retry_budget": {"type": "int", "default": 120},
+        "retry_max_attempts": {"type": "int", "default": 5},
+        "retry_base_delay": {"type": "float", "default": 0.5},
+        "retry_max_delay": {"type": "float", "default": 30},
+        "breaker_threshold": {"type": "int", "default": 5},
+        "breaker_cooldown": {"type": "int", "default": 30},
+        "ddl_queue_high_water": {"type": "int", "required": False},
+        "ddl_queue_max_wait": {"type": "int", "default": 600},
+    }
+
+
+def retry_params(params):
+    # бюджет времени отсчитывается от начала задачи и общий для всех подключений модуля
+    retry = {name: params.get(name, spec.get("default")) for name, spec in retry_argument_spec().items()}
+    retry["deadline"] = time.monotonic() + retry["retry_budget"]
+    return retry
+
+
+def error_code(exc):
+    match = ERROR_CODE.search(str(exc))
+    return int(match.group(1)) if match else None
+
+
+def is_retryable(exc, idempotent=True):
+    code = error_code(exc)
+    if not idempotent:
+        # разрыв соединения после отправки не говорит, выполнил ли сервер запрос, поэтому
+        # неидемпотентный запрос повторяется, только если он точно не был принят
+        if code is None:
+            return isinstance(exc, OperationalError) and bool(NOT_SENT.search(str(exc)))
+        return code in NOT_EXECUTED_CODES
+    if code is None:
+        return isinstance(exc, OperationalError)
+    return code in RETRYABLE_CODES
+
+
+def is_idempotent(query, idempotent):
+    if idempotent is not None:
+        return idempotent
+    return not query.lstrip().upper().startswith("INSERT")
+
+
+class CircuitBreaker:
+    # состояние хранится в файле на хост, чтобы его разделяли все процессы модулей,
+    # одновременно работающие с одним сервером на этой машине
+
+    def __init__(self, host, port, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.path = os.path.join(BREAKER_DIR, re.sub(r"[^\w.-]", "_", f"{host}_{port}") + ".json")
+
+    def _is_clean(self):
+        # быстрая проверка без блокировки: у здорового хоста файла состояния нет или он пуст,
+        # и успешные запросы не должны сериализоваться на блокировке файла
+        try:
+            with open(self.path) as f:
+                return f.read() in ("", "{}")
+        except (IOError, OSError):
+            return True
+
+    def _update(self, func):
+        os.makedirs(BREAKER_DIR, exist_ok=True)
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            content = f.read()
+            try:
+                state = json.loads(content or "{}")
+            except ValueError:
+                state = {}
+            result = func(state)
+            if json.dumps(state) != (content or "{}"):
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+            return result
+
+    def wait_time(self):
+        # 0 - запрос можно выполнять; после окончания паузы один процесс получает право на пробный запрос,
+        # остальные ждут его результата ещё одну паузу
+        if self._is_clean():
+            return 0
+
+        def check(state):
+            now = time.time()
+            if state.get("opened_until", 0) > now:
+                return state["opened_until"] - now
+            if state.get("failures", 0) >= self.threshold:
+                state["opened_until"] = now + self.cooldown
+            return 0
+        return self._update(check)
+
+    def record_success(self):
+        if self._is_clean():
+            return
+
+        def reset(state):
+            state.clear()
+        self._update(reset)
+
+    def record_failure(self):
+        def fail(state):
+            state["failures"] = state.get("failures", 0) + 1
+            if state["failures"] >= self.threshold:
+                state["opened_until"] = time.time() + self.cooldown
+        self._update(fail)
+
+
+class Client:
+    # обёртка над клиентом clickhouse_connect: повторяет запросы после временных ошибок
+    # с экспоненциальной задержкой со случайным разбросом в пределах бюджета времени задачи
+
+    def __init__(self, host, port, retry, connect):
+        self.host = host
+        self.retry = retry
+        self.breaker = CircuitBreaker(host, port, retry["breaker_threshold"], retry["breaker_cooldown"])
+        self.deadline = retry["deadline"]
+        self.retries = 0
+        self.ddl_queue = None
+        self._client = self.execute(connect, None)
+
+    def __getattr__(self, name):
+        if name == "_client":
+            raise AttributeError(name)
+        return getattr(self._client, name)
+
+    # idempotent=False - запрос нельзя выполнять дважды (INSERT ... SELECT, мутации, BACKUP, миграции):
+    # он повторяется только после ошибок, при которых сервер его точно не выполнял.
+    # По умолчанию неидемпотентными считаются запросы INSERT
+    def command(self, query, *args, idempotent=None, **kwargs):
+        self.ddl_backpressure(query)
+        return self.execute(lambda: self._client.command(query, *args, **kwargs), query, is_idempotent(query, idempotent))
+
+    def query(self, query, *args, idempotent=None, **kwargs):
+        self.ddl_backpressure(query)
+        return self.execute(lambda: self._client.query(query, *args, **kwargs), query, is_idempotent(query, idempotent))
+
+    def insert(self, *args, idempotent=False, **kwargs):
+        return self.execute(lambda: self._client.insert(*args, **kwargs), "INSERT", idempotent)
+
+    def raw(self):
+        # клиент clickhouse_connect без повторов, circuit breaker и ожидания очереди DDL,
+        # например для замеров задержек, в которые не должны попадать паузы между попытками
+        return self._client
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(self.retry["retry_max_delay"], self.retry["retry_base_delay"] * 2 ** attempt))
+
+    def _remaining(self):
+        return self.deadline - time.monotonic()
+
+    def execute(self, func, query, idempotent=True):
+        attempt = 0
+        while True:
+            wait = self.breaker.wait_time()
+            if wait:
+                if wait > self._remaining():
+                    raise CircuitOpenError(f"Circuit breaker is open for host {self.host}, retry in {int(wait)}s", query=query)
+                time.sleep(wait + random.uniform(0, 1))
+                continue
+            try:
+                result = func()
+            except Exception as e:
+                code = error_code(e)
+                ddl_task = DDL_TASK_TIMEOUT.search(str(e)) if code == TIMEOUT_EXCEEDED else None
+                if ddl_task:
+                    # задача распределённого DDL продолжает выполняться в фоне, повторная отправка
+                    # привела бы к ошибкам на уже выполнивших её репликах, поэтому дожидаемся её завершения
+                    self.breaker.record_success()
+                    return self.wait_ddl_task(ddl_task.group(2), query, e)
+                if not is_retryable(e):
+                    self.breaker.record_success()
+                    raise QueryError(f"{e}", code=code, query=query)
+                if not is_retryable(e, idempotent):
+                    # сбой хоста, но запрос мог быть выполнен - не повторяем его
+                    self.breaker.record_failure()
+                    raise QueryError(f"{e} (not retried: the statement may have been executed)", code=code, query=query)
+                self.breaker.record_failure()
+                attempt += 1
+                delay = self._delay(attempt)
+                if attempt >= self.retry["retry_max_attempts"] or delay > self._remaining():
+                    raise QueryError(f"{e} (gave up after {attempt} attempts)", code=code, query=query)
+                self.retries += 1
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    def ddl_queue_depth(self, cluster):
+        return self.execute(lambda: self._client.command(
+            "SELECT uniqExact(entry) FROM system.distributed_ddl_queue "
+            f"WHERE cluster = '{cluster}' AND coalesce(toString(status), 'Inactive') NOT IN ('Finished', 'Removing')"), None)
+
+    def expand_macros(self, name):
+        # ON CLUSTER '{cluster}': в system.distributed_ddl_queue записано имя кластера после подстановки макросов
+        for macro in set(MACRO.findall(name)):
+            value = self.execute(lambda: self._client.command(f"SELECT getMacro('{macro}')"), None)
+            name = name.replace("{" + macro + "}", str(value))
+        return name
+
+    def ddl_backpressure(self, query):
+        # перед отправкой запроса ON CLUSTER ждём, пока очередь распределённого DDL кластера
+        # не опустится ниже ddl_queue_high_water, чтобы не наращивать очередь в zookeeper быстрее,
+        # чем реплики успевают её выполнять
+        high_water = self.retry.get("ddl_queue_high_water")
+        match = ON_CLUSTER.search(query) if high_water else None
+        if not match:
+            return
+        cluster = self.expand_macros(next(name for name in match.groups() if name))
+        if self.ddl_queue is None:
+            self.ddl_queue = {"cluster": cluster, "high_water": high_water, "depth": 0, "max_depth": 0,
+                              "checks": 0, "waits": 0, "waited": 0.0}
+        deadline = time.monotonic() + self.retry["ddl_queue_max_wait"]
+        attempt = 0
+        while True:
+            depth = self.ddl_queue_depth(cluster)
+            self.ddl_queue["checks"] += 1
+            self.ddl_queue["depth"] = depth
+            self.ddl_queue["max_depth"] = max(self.ddl_queue["max_depth"], depth)
+            if depth < high_water:
+                return
+            attempt += 1
+            delay = random.uniform(0, min(self.retry["retry_max_delay"], self.retry["retry_base_delay"] * 2 ** attempt))
+            delay = max(delay, self.retry["retry_base_delay"])
+            if time.monotonic() + delay > deadline:
+                raise QueryError(f"Distributed DDL queue of cluster {cluster} has {depth} unfinished entries, "
+                                 f"high water mark is {high_water}", query=query)
+            self.ddl_queue["waits"] += 1
+            self.ddl_queue["waited"] = round(self.ddl_queue["waited"] + delay, 3)
+            time.sleep(delay)
+
+    def ddl_queue_report(self):
+        return {"ddl_queue": self.ddl_queue} if self.ddl_queue else {}
+
+    def wait_ddl_task(self, entry, query, exc):
+        attempt = 0
+        while True:
+            rows = self._client.query(
+                "SELECT count(), countIf(coalesce(toString(status), 'Inactive') NOT IN ('Finished', 'Removing')), "
+                f"max(exception_code), any(exception_text) FROM system.distributed_ddl_queue WHERE entry = '{entry}'").result_rows
+            total, unfinished, code, text = rows[0] if rows else (0, 0, 0, "")
+            if not total:
+                # задача уже удалена из очереди или ещё не видна этому хосту - результат неизвестен
+                raise QueryError(f"{exc} (DDL task {entry} not found in system.distributed_ddl_queue, state is unknown)",
+                                 code=TIMEOUT_EXCEEDED, query=query)
+            if not unfinished:
+                if code:
+                    raise QueryError(f"Code: {code}. {text}", code=code, query=query)
+                return None
+            attempt += 1
+            delay = min(self.retry["retry_max_delay"], self.retry["retry_base_delay"] * 2 ** attempt)
+            if delay > self._remaining():
+                raise QueryError(f"{exc} ({unfinished} hosts unfinished)", code=TIMEOUT_EXCEEDED, query=query)
+            time.sleep(delay)
+
+
+def connect(**kwargs):
+    # clickhouse_connect проверяет настройки подключения при соединении, а пользователю с readonly = 1
+    # нельзя менять никакие настройки: для него подключение открывается без пометки log_comment
+    try:
+        return clickhouse_connect.get_client(**dict(kwargs, settings=dict({"log_comment": LOG_COMMENT}, **(kwargs.get("settings") or {}))))
+    except Exception as e:
+        if "log_comment" not in str(e):
+            raise
+    return clickhouse_connect.get_client(**kwargs)
+
+
+def get_client(retry=None, **kwargs):
+    retry = retry or retry_params({})
+    host = kwargs.get("host") or "localhost"
+    return Client(host, kwargs.get("port"), retry, lambda: connect(**kwargs))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import re
+
+NUMBER = re.compile(r"^-?\d+(\.\d+)?$")
+
+
+def quote(value):
+    # строковый литерал clickhouse
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def format_setting(value):
+    # значение настройки в SETTINGS: числа и булевы значения как есть, строки - литералом.
+    # Значения, уже переданные в кавычках ("'value'"), и числа в виде строк не изменяются
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return str(value)
+    value = str(value)
+    if NUMBER.match(value) or (len(value) > 1 and value[0] == value[-1] == "'"):
+        return value
+    return quote(value)
+
+
+def quote_identifier(name):
+    # идентификатор clickhouse в обратных кавычках
+    return "`" + str(name).replace('\\', '\\\\').replace('`', '\\`') + "`"